@@ -1,15 +1,14 @@
 # coding: utf-8
 import os
-import pymongo
 import logging
 
-from datetime import datetime, timedelta
-
-from pyramid.events import NewRequest, NewResponse
 from pyramid.config import Configurator
+from pyramid.events import NewRequest
+from pyramid.settings import asbool
 
-from .sync import do_sync
-from .utils import get_db_connection
+from .utils import read_preference_name
+from .storage import StorageError, get_storage
+from .scheduler import start_on_request
 
 
 DEFAULT_SETTINGS = [
@@ -17,12 +16,74 @@ DEFAULT_SETTINGS = [
             'mongodb://localhost:27017/scielobooks_oai'),
         ('scielo_uri', 'BOOKSOAI_SCIELO_URI', str,
             'http://books.scielo.org/api/v1'),
-        ('auto_sync', 'BOOKSOAI_AUTO_SYNC', bool,
+        ('auto_sync', 'BOOKSOAI_AUTO_SYNC', asbool,
             True),
         ('auto_sync_interval', 'BOOKSOAI_AUTO_SYNC_INTERVAL', int,
             60*60*12),
+        ('auto_sync_jitter', 'BOOKSOAI_AUTO_SYNC_JITTER', float,
+            0.1),
+        ('sync_lease_ttl', 'BOOKSOAI_SYNC_LEASE_TTL', int,
+            300),
+        ('sync_concurrency', 'BOOKSOAI_SYNC_CONCURRENCY', int,
+            4),
+        ('sync_page_size', 'BOOKSOAI_SYNC_PAGE_SIZE', int,
+            1000),
+        ('sync_batch_size', 'BOOKSOAI_SYNC_BATCH_SIZE', int,
+            500),
+        ('sync_write_concern', 'BOOKSOAI_SYNC_WRITE_CONCERN', str,
+            '1'),
+        ('sync_runs_keep', 'BOOKSOAI_SYNC_RUNS_KEEP', int,
+            100),
+        ('sync_follow', 'BOOKSOAI_SYNC_FOLLOW', asbool,
+            False),
+        ('follow_batch_size', 'BOOKSOAI_FOLLOW_BATCH_SIZE', int,
+            100),
+        ('follow_flush_interval', 'BOOKSOAI_FOLLOW_FLUSH_INTERVAL', int,
+            1000),
+        ('follow_timeout', 'BOOKSOAI_FOLLOW_TIMEOUT', int,
+            5000),
+        ('follow_refresh_interval', 'BOOKSOAI_FOLLOW_REFRESH_INTERVAL', int,
+            60),
+        ('api_connect_timeout', 'BOOKSOAI_API_CONNECT_TIMEOUT', float,
+            5),
+        ('api_read_timeout', 'BOOKSOAI_API_READ_TIMEOUT', float,
+            30),
+        ('api_retries', 'BOOKSOAI_API_RETRIES', int,
+            3),
+        ('api_backoff', 'BOOKSOAI_API_BACKOFF', float,
+            0.5),
+        ('api_circuit_threshold', 'BOOKSOAI_API_CIRCUIT_THRESHOLD', int,
+            5),
+        ('api_circuit_reset', 'BOOKSOAI_API_CIRCUIT_RESET', float,
+            60),
         ('items_per_page', 'BOOKSOAI_ITEMS_PER_PAGE', int,
             100),
+        ('mongo_max_pool_size', 'BOOKSOAI_MONGO_MAX_POOL_SIZE', int,
+            100),
+        ('mongo_connect_timeout_ms', 'BOOKSOAI_MONGO_CONNECT_TIMEOUT_MS', int,
+            20000),
+        ('mongo_socket_timeout_ms', 'BOOKSOAI_MONGO_SOCKET_TIMEOUT_MS', int,
+            30000),
+        ('mongo_wait_queue_timeout_ms', 'BOOKSOAI_MONGO_WAIT_QUEUE_TIMEOUT_MS', int,
+            5000),
+        ('mongo_read_preference', 'BOOKSOAI_MONGO_READ_PREFERENCE', read_preference_name,
+            'primary'),
+        ('mongo_max_staleness_seconds', 'BOOKSOAI_MONGO_MAX_STALENESS_SECONDS', int,
+            0),
+        ('storage_backend', 'BOOKSOAI_STORAGE_BACKEND', str,
+            'mongodb'),
+        ('sqlite_path', 'BOOKSOAI_SQLITE_PATH', str,
+            'booksoai.sqlite'),
+        ('ensure_indexes', 'BOOKSOAI_ENSURE_INDEXES', asbool,
+            True),
+        ('set_descriptions', 'BOOKSOAI_SET_DESCRIPTIONS', asbool,
+            False),
+        ('id_filter', 'BOOKSOAI_ID_FILTER', asbool,
+            True),
+        ('id_filter_refresh_interval', 'BOOKSOAI_ID_FILTER_REFRESH_INTERVAL', int,
+            60),
+        ('id_filter_error_rate', 'BOOKSOAI_ID_FILTER_ERROR_RATE', float,
+            0.01),
         ]
 
 
@@ -50,40 +111,34 @@ def main(global_config, **settings):
     config = Configurator(settings=parse_settings(settings))
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('oai_pmh', '/oai-pmh')
+    config.add_route('sync_status', '/sync-status')
+    config.add_route('sync_runs', '/sync-runs')
     config.add_renderer('oai', factory='booksoai.renderers.oai_factory')
 
-    # Starts sync process on new requests
-    def start_sync(event):
-        settings = event.request.registry.settings
-        if settings['auto_sync']:
-            db = event.request.db
-            interval = settings['auto_sync_interval']
-            try:
-                update = db.updates.find_one()
-                if update:
-                    last_update = update['updated_at']
-                    next_update = last_update + timedelta(seconds=interval)
-                    if next_update < datetime.now():
-                        do_sync(settings)
-                else:
-                    do_sync(settings)
-            except pymongo.errors.AutoReconnect as e:
-                logging.getLogger(__name__).error('MongoDB: %s' % e.message)
-
-
-    def create_db_conn(event):
-        settings = event.request.registry.settings
-        db = get_db_connection(settings)
-        event.request.db = db
-
-    def close_db_conn(event):
+    settings = config.registry.settings
+    if settings['ensure_indexes']:
         try:
-            event.request.db.connection.close()
-        except TypeError:
-            pass
-     
-    config.add_subscriber(create_db_conn, NewRequest)
-    config.add_subscriber(close_db_conn, NewResponse)
-    config.add_subscriber(start_sync, NewRequest)
+            storage = get_storage(settings)
+            storage.ensure_indexes()
+            # books synced before `set` was stored would match no set
+            storage.backfill_sets()
+            # ListSets only reads the materialized sets
+            storage.ensure_sets()
+        except StorageError as e:
+            logging.getLogger(__name__).error('%s' % e)
+
+    # Sync runs in a background thread, never in the request path. It is
+    # started by the first request of each process, since threads started
+    # here wouldn't survive servers forking their workers after loading the
+    # app.
+    if settings['auto_sync']:
+        config.add_subscriber(start_on_request, NewRequest)
+
+    # The storage (and its connection pool) is shared by every request
+    # served by the process
+    def storage(request):
+        return get_storage(request.registry.settings)
+
+    config.add_request_method(storage, 'storage', reify=True)
     config.scan(ignore='booksoai.tests')
     return config.make_wsgi_app()
@@ -0,0 +1,162 @@
+import os
+import time
+import random
+import logging
+import requests
+import threading
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, ConnectionError, Timeout
+
+
+logger = logging.getLogger(__name__)
+
+# upper bound of a single backoff delay, in seconds
+MAX_BACKOFF = 30
+
+# requests < 2.4 only accepts a single timeout, used for the connection and
+# for each read
+SPLIT_TIMEOUTS = tuple(int(n) for n in requests.__version__.split('.')[:2]) >= (2, 4)
+
+
+class CircuitOpenError(ConnectionError):
+    """The books API failed too many times in a row; no request was sent."""
+
+
+class CircuitBreaker(object):
+    """
+    Opens after ``threshold`` consecutive failures and rejects requests for
+    ``reset_timeout`` seconds. After that, requests go through again, and a
+    single failure opens it once more.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+
+            if time.time() - self.opened_at >= self.reset_timeout:
+                self.opened_at = None
+                self.failures = self.threshold - 1
+                return True
+
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened_at is None:
+                logger.error('Books API circuit opened after %s failures' % self.failures)
+                self.opened_at = time.time()
+
+
+def is_retriable(error):
+    """
+    Tell whether a failed request may succeed later. Responses other than
+    5xx mean the API is up and answered for good.
+    """
+    if isinstance(error, HTTPError):
+        return error.response is None or error.response.status_code >= 500
+    return True
+
+
+class BooksAPIClient(object):
+    """
+    Client of the SciELO Books API, safe to share between threads.
+
+    Connections are kept alive in a pool of ``pool_size`` connections per
+    host. Connection errors, timeouts and 5xx responses are retried
+    ``retries`` times, waiting an exponential backoff with full jitter
+    between attempts.
+    """
+
+    def __init__(self, connect_timeout=5, read_timeout=30, retries=3, backoff=0.5,
+                 pool_size=10, breaker=None):
+        if SPLIT_TIMEOUTS:
+            self.timeout = (connect_timeout, read_timeout)
+        else:
+            self.timeout = max(connect_timeout, read_timeout)
+
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _delay(self, attempt):
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+    def get_json(self, uri, params=None):
+        if not self.breaker.allow():
+            raise CircuitOpenError('Books API circuit is open, %s not requested' % uri)
+
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(uri, params=params, timeout=self.timeout)
+                response.raise_for_status()
+            except (HTTPError, ConnectionError, Timeout) as e:
+                if not is_retriable(e):
+                    self.breaker.success()
+                    raise
+
+                if attempt >= self.retries:
+                    self.breaker.failure()
+                    raise
+
+                delay = self._delay(attempt)
+                logger.warning('%s (%s), retrying in %.2fs' % (uri, e, delay))
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self.breaker.success()
+                return response.json()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_api_client(settings):
+    """
+    Return the books API client shared by the current process.
+
+    :param settings: App settings, as returned by ``parse_settings``.
+    :returns: BooksAPIClient.
+    """
+    options = {
+        'connect_timeout': settings.get('api_connect_timeout', 5),
+        'read_timeout': settings.get('api_read_timeout', 30),
+        'retries': settings.get('api_retries', 3),
+        'backoff': settings.get('api_backoff', 0.5),
+        'pool_size': max(settings.get('sync_concurrency', 4), 10),
+    }
+    breaker_options = (settings.get('api_circuit_threshold', 5),
+                       settings.get('api_circuit_reset', 60))
+    key = (os.getpid(), tuple(sorted(options.items())), breaker_options)
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            for stale_key in [k for k in _clients if k[0] != key[0]]:
+                del _clients[stale_key]
+
+            client = BooksAPIClient(breaker=CircuitBreaker(*breaker_options), **options)
+            _clients[key] = client
+
+    return client
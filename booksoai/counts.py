@@ -0,0 +1,63 @@
+import threading
+
+
+class CountCache(object):
+    """
+    Per-process cache of list sizes keyed by a normalized query signature.
+
+    Every entry is bound to the sync sequence number it was computed at, so
+    the whole cache is invalidated as soon as sync moves forward.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._seq = None
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def get(self, signature, seq, compute):
+        """
+        Return the cached count for ``signature`` or store ``compute()``.
+
+        :param signature: Hashable query signature.
+        :param seq: Current sync sequence number.
+        :param compute: Callable returning the count on cache misses.
+        """
+        with self._lock:
+            if seq != self._seq:
+                self._seq = seq
+                self._counts = {}
+            elif signature in self._counts:
+                return self._counts[signature]
+
+        count = compute()
+
+        with self._lock:
+            if seq == self._seq:
+                if len(self._counts) >= self.maxsize:
+                    self._counts = {}
+                self._counts[signature] = count
+
+        return count
+
+    def clear(self):
+        with self._lock:
+            self._seq = None
+            self._counts = {}
+
+
+_cache = CountCache()
+
+
+def query_signature(filters):
+    """Normalized signature of the filters that select a list of books."""
+    return (filters.get('set'), filters.get('from'), filters.get('until'))
+
+
+def count_books(storage, filters):
+    """
+    Return the number of books matching ``filters``, cached until the next
+    sync run.
+    """
+    return _cache.get(query_signature(filters), storage.get_sync_seq(),
+                      lambda: storage.count_books(filters))
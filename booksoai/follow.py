@@ -0,0 +1,162 @@
+import time
+import logging
+import itertools
+import threading
+
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from requests.exceptions import HTTPError, ConnectionError
+
+from .lease import Lease
+from .telemetry import SyncRun
+from .apiclient import get_api_client
+from .storage import get_storage
+from .sync import SYNC_LEASE, BatchWriter, apply_updates, fetch_update, get_updates
+from .sync import get_feed_head
+from .sync import new_stats, parse_write_concern, record_sync_run, refresh_repository
+
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait before following the feed again, after the lease was found
+# taken or the books API failed
+FOLLOW_RETRY = 30
+
+# longest a changes request may be held, in milliseconds. The loop only sees
+# a stop between polls, so it must stay well below the grace period of the
+# process manager, or the process is killed holding the lease.
+MAX_POLL_TIMEOUT = 5000
+
+
+def poll_timeout(settings, writer):
+    """
+    Milliseconds the books API may hold the next changes request.
+
+    It stays below ``MAX_POLL_TIMEOUT`` and the read timeout of the client,
+    and wakes up in time to flush the changes pending in ``writer``.
+    """
+    timeout = min(settings.get('follow_timeout', 5000), MAX_POLL_TIMEOUT,
+                  int(settings.get('api_read_timeout', 30) * 1000 * 0.8))
+
+    if writer.age is not None:
+        remaining = settings.get('follow_flush_interval', 1000) - writer.age * 1000
+        timeout = min(timeout, int(remaining))
+
+    return max(timeout, 1)
+
+
+def follow_changes(settings, stopped=None, stats=None):
+    """
+    Apply the books API changes as they arrive, long-polling the changes feed
+    until ``stopped`` is set.
+
+    Changes are written in micro-batches, every `follow_batch_size` changes
+    or `follow_flush_interval` milliseconds after the oldest pending one.
+    At most every `follow_refresh_interval` seconds, the repository stats
+    and sets are refreshed and the changes applied since the last refresh
+    are recorded as a run in `sync_runs`.
+
+    Like ``sync.update_from_api``, it only runs in the worker holding the
+    `sync` lease, which it keeps while following.
+
+    :param stopped: threading.Event that ends the loop.
+    :param stats: Dict that receives the counters of the whole session, as
+                  in ``sync.update_from_api``.
+    :returns: True once stopped, False if it failed and None if another
+              worker holds the lease.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(new_stats())
+    stopped = stopped or threading.Event()
+    run = SyncRun(new_stats())
+    storage = None
+
+    try:
+        storage = get_storage(settings)
+        lease = Lease(storage, SYNC_LEASE, settings.get('sync_lease_ttl', 300))
+        if not lease.acquire():
+            logger.info('Follow skipped, another worker holds the lease')
+            return None
+
+        try:
+            api_uri = settings.get('scielo_uri')
+            client = get_api_client(settings)
+            batch_size = settings.get('follow_batch_size', 100)
+            write_concern = parse_write_concern(settings.get('sync_write_concern'))
+            flush_interval = settings.get('follow_flush_interval', 1000) / 1000.0
+            refresh_interval = settings.get('follow_refresh_interval', 60)
+            keep = settings.get('sync_runs_keep', 100)
+
+            concurrency = settings.get('sync_concurrency', 4)
+            pool = ThreadPool(concurrency) if concurrency > 1 else None
+            imap = pool.imap if pool else itertools.imap
+
+            def start_run():
+                new_run = SyncRun(new_stats())
+                fetch = partial(fetch_update, api_uri, client=client,
+                                latency=new_run.http_latency)
+                writer = BatchWriter(storage, batch_size, write_concern, new_run.stats,
+                                     new_run.batch_latency)
+                return new_run, fetch, writer
+
+            def publish(run):
+                run.api_seq = get_feed_head(api_uri, client)
+                refresh_repository(storage)
+                record_sync_run(storage, run, 'ok', keep)
+                for key, value in run.stats.items():
+                    stats[key] += value
+
+            try:
+                last_update = storage.get_last_update()
+                since = last_update['last_seq'] if last_update else 0
+                run, fetch, writer = start_run()
+                refreshed_at = time.time()
+
+                while not stopped.is_set():
+                    lease.check()
+                    started = time.time()
+                    page = get_updates(api_uri, storage, since, client, batch_size,
+                                       poll_timeout(settings, writer))
+                    run.poll_latency.time(started)
+
+                    if page:
+                        since = page[-1]['seq']
+                        apply_updates(page, storage, writer, imap, fetch, lease, run.stats)
+
+                    if writer.age is not None and (not page or writer.age >= flush_interval):
+                        lease.check()
+                        writer.flush()
+
+                    if run.stats['changes'] and writer.age is None and \
+                            time.time() - refreshed_at >= refresh_interval:
+                        publish(run)
+                        run, fetch, writer = start_run()
+                        refreshed_at = time.time()
+
+                lease.check()
+                writer.flush()
+                if run.stats['changes']:
+                    publish(run)
+            finally:
+                if pool:
+                    pool.terminate()
+                    pool.join()
+        finally:
+            lease.release()
+
+        return True
+
+    except (HTTPError, ConnectionError) as e:
+        logger.exception('%s: %s' % (e.__class__.__name__, e.message))
+        run.error = '%s: %s' % (e.__class__.__name__, e)
+
+    except Exception as e:
+        logger.exception('%s' % e.message)
+        run.error = '%s: %s' % (e.__class__.__name__, e)
+
+    if storage is not None:
+        record_sync_run(storage, run, 'failed', settings.get('sync_runs_keep', 100))
+        for key, value in run.stats.items():
+            stats[key] += value
+
+    return False
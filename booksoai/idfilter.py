@@ -0,0 +1,133 @@
+import math
+import time
+import struct
+import hashlib
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter(object):
+    """
+    Probabilistic set membership: never gives false negatives, and gives
+    false positives at about ``error_rate``.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        # double hashing: k positions out of two 64-bit hashes
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+
+class IdentifierFilter(object):
+    """
+    Per-process bloom filter of every stored book identifier.
+
+    The filter is built in a background thread and remembers the books
+    version (see ``Storage.get_books_version``) it was built at. An
+    identifier missing from the filter is only reported as missing while
+    the version, read from the primary, hasn't changed; otherwise the
+    storage is asked. The filter is rebuilt every ``refresh_interval``
+    seconds, and at most that often when the version changes.
+    """
+
+    def __init__(self, refresh_interval=60, error_rate=0.01):
+        self.refresh_interval = refresh_interval
+        self.error_rate = error_rate
+        # (bloom filter, books version it was built at)
+        self._state = None
+        self._building = False
+        self._started_at = None
+        self._lock = threading.Lock()
+
+    def build(self, storage):
+        # read first: books written after it change the version
+        version = storage.get_books_version()
+        count = storage.count_books()
+        bloom = BloomFilter(int(count * 1.2) + 1000, self.error_rate)
+
+        for identifier in storage.iter_identifiers():
+            bloom.add(identifier)
+
+        logger.info('Identifier filter rebuilt with %s books' % count)
+        return bloom, version
+
+    def _rebuild(self, storage):
+        try:
+            self._state = self.build(storage)
+        except Exception as e:
+            logger.exception('Identifier filter rebuild failed: %s' % e)
+        finally:
+            self._building = False
+
+    def refresh(self, storage):
+        """
+        Rebuild the filter in a background thread, unless a rebuild is running
+        or started less than ``refresh_interval`` seconds ago.
+
+        :returns: the rebuild thread, or None.
+        """
+        with self._lock:
+            if self._building or (self._started_at is not None and
+                                  time.time() - self._started_at < self.refresh_interval):
+                return None
+            self._building = True
+            self._started_at = time.time()
+
+        thread = threading.Thread(target=self._rebuild, args=(storage,),
+                                  name='identifier-filter')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def might_exist(self, storage, identifier):
+        state = self._state
+        if state is None or time.time() - self._started_at >= self.refresh_interval:
+            self.refresh(storage)
+        if state is None:
+            return True
+
+        bloom, version = state
+        if identifier in bloom:
+            return True
+
+        # books written after the build aren't in the filter
+        if storage.get_books_version() == version:
+            return False
+
+        self.refresh(storage)
+        return True
+
+
+_filter = None
+
+
+def might_exist(storage, identifier, settings):
+    """
+    Tell whether ``identifier`` may be stored, without querying the books
+    when the answer is no.
+    """
+    global _filter
+    if _filter is None:
+        _filter = IdentifierFilter(settings.get('id_filter_refresh_interval', 60),
+                                   settings.get('id_filter_error_rate', 0.01))
+
+    return _filter.might_exist(storage, identifier)
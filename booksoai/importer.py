@@ -0,0 +1,142 @@
+import logging
+import itertools
+
+from multiprocessing.pool import ThreadPool
+
+from bson import json_util
+
+from .sync import adapt_data, content_hash
+from .storage import StorageError
+
+
+logger = logging.getLogger(__name__)
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class DumpReader(object):
+    """
+    Iterates over the adapted books of a JSON-lines dump.
+
+    Each line holds a books API document or a list of them, in MongoDB
+    extended JSON. Documents that already have an `identifier` (exports of
+    the `books` collection, like ``tests/fixtures/books.bson``) are kept as
+    they are; the others go through ``sync.adapt_data``. A line holding only
+    a `last_seq` records the seq of the changes feed the dump was taken at.
+
+    Each identifier is yielded once. Later copies of a book are collected in
+    `duplicates`, which holds the last copy of each, to be stored in place
+    of the first one once the dump is read.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.last_seq = None
+        self.duplicates = {}
+        self._seen = set()
+
+    def _adapt(self, document):
+        if 'identifier' not in document:
+            document = adapt_data(document)
+        else:
+            document.pop('_id', None)
+
+        document['content_hash'] = content_hash(document)
+        return document
+
+    def __iter__(self):
+        for line in self.lines:
+            line = line.strip()
+            if not line:
+                continue
+
+            data = json_util.loads(line)
+            if isinstance(data, dict) and data.keys() == ['last_seq']:
+                self.last_seq = data['last_seq']
+                continue
+
+            for document in data if isinstance(data, list) else [data]:
+                document = self._adapt(document)
+                if document['identifier'] in self._seen:
+                    self.duplicates[document['identifier']] = document
+                    continue
+
+                self._seen.add(document['identifier'])
+                yield document
+
+
+def import_books(books, storage, batch_size=1000, workers=4, write_concern=None):
+    """
+    Insert ``books`` in batches of ``batch_size``, with ``workers`` batches
+    in flight; with a single worker they are inserted by the calling thread,
+    as ``:memory:`` SQLite databases require. At most ``2 * workers`` batches
+    are read ahead, so memory doesn't grow with the size of the dump.
+
+    :returns: The number of books inserted.
+    """
+    def insert(batch):
+        storage.insert_books(batch, write_concern)
+        return len(batch)
+
+    pool = ThreadPool(workers) if workers > 1 else None
+    imap = pool.imap_unordered if pool else itertools.imap
+    count = 0
+    try:
+        for window in _chunks(_chunks(books, batch_size), max(workers, 1) * 2):
+            for inserted in imap(insert, window):
+                count += inserted
+            logger.info('Imported %s books' % count)
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    return count
+
+
+def import_dump(lines, storage, last_seq=None, batch_size=1000, workers=4,
+                write_concern=None):
+    """
+    Bootstrap an empty storage from a dump: insert its books, build the
+    indexes afterwards, and record the dump seq so the incremental sync
+    resumes from it. A book listed more than once is stored as its last copy.
+
+    :param last_seq: Seq of the changes feed the dump was taken at; takes
+                     precedence over a `last_seq` line of the dump.
+    :returns: (count, last_seq) tuple. `last_seq` is None when neither
+              the dump nor the caller gives it; 0 is recorded then.
+    :raises StorageError: if an index could not be built; the sync seq is
+                          not recorded then.
+    """
+    reader = DumpReader(lines)
+    count = import_books(reader, storage, batch_size, workers, write_concern)
+
+    if reader.duplicates:
+        logger.warning('%s books are listed more than once; keeping their last copy'
+                       % len(reader.duplicates))
+        for batch in _chunks(reader.duplicates.values(), batch_size):
+            storage.replace_books(batch, write_concern)
+
+    report = storage.ensure_indexes()
+    failed = (set(report['missing']) - set(report['created'])) | set(report['mismatched'])
+    if failed:
+        raise StorageError('Could not build the indexes %s' % ', '.join(
+            '%s.%s' % index for index in sorted(failed)))
+
+    if last_seq is None:
+        last_seq = reader.last_seq
+    if last_seq is None:
+        logger.warning('The dump has no last_seq; the next sync starts from 0')
+    # recorded even without a seq, so the sync checkpoint reflects the load
+    storage.set_last_seq(last_seq or 0)
+
+    storage.refresh_repository_stats(last_seq or 0)
+    storage.refresh_sets()
+    return count, last_seq
@@ -0,0 +1,109 @@
+import logging
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+
+logger = logging.getLogger(__name__)
+
+# (collection, keys, options) tuples describing every index the app relies on.
+# The list indexes hold every header field, so ListIdentifiers is a covered query.
+INDEXES = (
+    ('books', [('identifier', ASCENDING)], {'unique': True}),
+    ('books', [('set', ASCENDING), ('updated', ASCENDING), ('identifier', ASCENDING),
+               ('deleted', ASCENDING)], {}),
+    ('books', [('updated', ASCENDING), ('identifier', ASCENDING), ('set', ASCENDING),
+               ('deleted', ASCENDING)], {}),
+    # only deleted books hold the field, so the count of deleted records in the
+    # repository stats reads a small index instead of scanning the collection
+    ('books', [('deleted', ASCENDING)], {'sparse': True}),
+    ('sync_runs', [('started_at', DESCENDING)], {}),
+)
+
+# options that must match for an existing index to satisfy the spec
+COMPARED_OPTIONS = ('unique', 'sparse')
+
+
+def index_name(keys):
+    """Default index name, as generated by MongoDB: ``field_direction``."""
+    return '_'.join('%s_%s' % (field, direction) for field, direction in keys)
+
+
+def check_indexes(db, spec=INDEXES):
+    """
+    Compare the indexes of ``db`` against ``spec``.
+
+    Every existing index that is not declared (except ``_id_``) is reported as
+    redundant. Indexes declared with a key that already exists with different
+    options are reported as mismatched, since MongoDB won't build a second
+    index for the same key.
+
+    :param db: pymongo.database.Database.
+    :param spec: Iterable of (collection, keys, options) tuples.
+    :returns: dict with `missing`, `existing`, `mismatched` and `redundant`
+              lists of (collection, index name) tuples.
+    """
+    report = {'missing': [], 'existing': [], 'mismatched': [], 'redundant': []}
+    declared = {}
+    for collection, keys, options in spec:
+        declared.setdefault(collection, []).append((keys, options))
+
+    for collection, indexes in declared.items():
+        current = db[collection].index_information()
+        by_key = dict((tuple(info['key']), (name, info)) for name, info in current.items())
+
+        for keys, options in indexes:
+            name = index_name(keys)
+            if tuple(keys) not in by_key:
+                report['missing'].append((collection, name))
+                continue
+
+            current_name, info = by_key[tuple(keys)]
+            if any(bool(info.get(opt)) != bool(options.get(opt)) for opt in COMPARED_OPTIONS):
+                report['mismatched'].append((collection, current_name))
+            else:
+                report['existing'].append((collection, current_name))
+
+        declared_keys = [tuple(keys) for keys, options in indexes]
+        for name, info in current.items():
+            if name == '_id_' or tuple(info['key']) in declared_keys:
+                continue
+            report['redundant'].append((collection, name))
+
+    return report
+
+
+def ensure_indexes(db, spec=INDEXES):
+    """
+    Idempotently build the missing indexes declared in ``spec``.
+
+    Redundant and mismatched indexes are only reported, never dropped.
+
+    :param db: pymongo.database.Database.
+    :param spec: Iterable of (collection, keys, options) tuples.
+    :returns: The ``check_indexes`` report plus a `created` list.
+    """
+    report = check_indexes(db, spec)
+    report['created'] = []
+    missing = set(report['missing'])
+
+    for collection, keys, options in spec:
+        name = index_name(keys)
+        if (collection, name) not in missing:
+            continue
+
+        try:
+            db[collection].create_index(keys, name=name, background=True, **options)
+        except OperationFailure as e:
+            logger.error('Could not build index %s.%s: %s' % (collection, name, e))
+        else:
+            report['created'].append((collection, name))
+            logger.info('Built index %s.%s' % (collection, name))
+
+    for collection, name in report['mismatched']:
+        logger.warning('Index %s.%s does not match the declared options' % (collection, name))
+
+    for collection, name in report['redundant']:
+        logger.warning('Index %s.%s is not declared and may be redundant' % (collection, name))
+
+    return report
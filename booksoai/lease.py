@@ -0,0 +1,80 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLostError(Exception):
+    """The lease expired or was taken by another owner while held."""
+
+
+class Lease(object):
+    """
+    Cluster-wide lease kept in the storage, renewed by a heartbeat thread
+    every third of its ``ttl`` while held.
+
+    A holder that dies stops renewing, so its lease expires after ``ttl``
+    seconds and another owner can take it. Expiration uses the clock of each
+    node, so ``ttl`` must stay well above the clock skew between them.
+    """
+
+    def __init__(self, storage, name, ttl, owner=None):
+        self.storage = storage
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner or '%s:%s:%s' % (socket.gethostname(), os.getpid(),
+                                            uuid.uuid4().hex[:8])
+        self.lost = False
+        self._renewed_at = None
+        self._stopped = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self):
+        if not self.storage.acquire_lease(self.name, self.owner, self.ttl):
+            return False
+
+        self.lost = False
+        self._renewed_at = time.time()
+        self._stopped.clear()
+        self._heartbeat = threading.Thread(target=self._renew,
+                                           name='lease-%s' % self.name)
+        self._heartbeat.daemon = True
+        self._heartbeat.start()
+        return True
+
+    def _renew(self):
+        while not self._stopped.wait(self.ttl / 3.0):
+            try:
+                renewed = self.storage.renew_lease(self.name, self.owner, self.ttl)
+            except Exception as e:
+                logger.warning('Could not renew lease %s: %s' % (self.name, e))
+                # the lease is still valid until ttl after the last renewal
+                renewed = time.time() - self._renewed_at < self.ttl
+                if renewed:
+                    continue
+
+            if renewed:
+                self._renewed_at = time.time()
+            else:
+                logger.error('Lease %s lost by %s' % (self.name, self.owner))
+                self.lost = True
+                return
+
+    def check(self):
+        """Raise ``LeaseLostError`` if the lease is no longer held."""
+        if self.lost:
+            raise LeaseLostError('Lease %s lost by %s' % (self.name, self.owner))
+
+    def release(self):
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+        if not self.lost:
+            self.storage.release_lease(self.name, self.owner)
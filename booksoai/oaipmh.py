@@ -33,6 +33,12 @@ class BadResumptionTokenError(Exception):
     """Raised when invalid resumption token is used"""
 
 
+# Book fields loaded from the database by each verb
+HEADER_FIELDS = ('identifier', 'updated', 'set', 'deleted')
+RECORD_FIELDS = HEADER_FIELDS + ('publisher', 'title', 'creators', 'description',
+                                 'date', 'formats', 'language')
+
+
 class IdentifyVerb(object):
     data = {
         'repositoryName': 'SciELO Books',
@@ -43,14 +49,16 @@ class IdentifyVerb(object):
     }
     allowed_args = set(('verb',))
 
-    def __init__(self, last_book, request_kwargs, base_url):
+    def __init__(self, stats, request_kwargs, base_url):
 
         if set(request_kwargs) != self.allowed_args:
             raise BadArgumentError()
 
+        self.data = dict(self.data)
         self.data['request'] = request_kwargs
         self.data['baseURL'] = base_url
-        self.data['earliestDatestamp'] = last_book.get('updated', datetime.now().date().isoformat())
+        self.data['earliestDatestamp'] = (stats.get('earliest_datestamp') or
+                                          datetime.now().date().isoformat())
 
     def __str__(self):
         ppl = plumber.Pipeline(
@@ -103,9 +111,10 @@ class ListMetadataFormatsVerb(object):
 
 class ListIdentifiersVerb(object):
 
+    fields = HEADER_FIELDS
     allowed_args = set(('from', 'until', 'set', 'resumptionToken', 'metadataPrefix', 'verb'))
 
-    def __init__(self, books, request_kwargs, base_url):
+    def __init__(self, books, request_kwargs, base_url, resumption=None):
         request_set = set(request_kwargs)
         diff = request_set - self.allowed_args
 
@@ -119,6 +128,7 @@ class ListIdentifiersVerb(object):
             'request': request_kwargs,
             'baseURL': base_url,
             'books': books,
+            'resumption': resumption,
         }
 
     def __str__(self):
@@ -139,7 +149,7 @@ class ListSetsVerb(object):
 
     allowed_args = set(('resumptionToken', 'verb'))
 
-    def __init__(self, books, request_kwargs, base_url):
+    def __init__(self, sets, request_kwargs, base_url, resumption=None):
         diff = set(request_kwargs) - self.allowed_args
         if diff:
             raise BadArgumentError()
@@ -147,7 +157,8 @@ class ListSetsVerb(object):
         self.data = {
             'request': request_kwargs,
             'baseURL': base_url,
-            'books': books.distinct('publisher'),
+            'sets': sets,
+            'resumption': resumption,
         }
 
     def __str__(self):
@@ -166,9 +177,10 @@ class ListSetsVerb(object):
 
 class GetRecordVerb(object):
 
+    fields = RECORD_FIELDS
     required_args = set(('identifier', 'metadataPrefix', 'verb'))
 
-    def __init__(self, books, request_kwargs, base_url):
+    def __init__(self, books, request_kwargs, base_url, resumption=None):
 
         if set(request_kwargs) != self.required_args:
             raise BadArgumentError()
@@ -195,9 +207,10 @@ class GetRecordVerb(object):
 
 class ListRecordsVerb(object):
 
+    fields = RECORD_FIELDS
     allowed_args = set(('from', 'until', 'set', 'resumptionToken', 'metadataPrefix', 'verb'))
 
-    def __init__(self, books, request_kwargs, base_url):
+    def __init__(self, books, request_kwargs, base_url, resumption=None):
         request_set = set(request_kwargs)
         diff = request_set - self.allowed_args
 
@@ -211,6 +224,7 @@ class ListRecordsVerb(object):
             'request': request_kwargs,
             'baseURL': base_url,
             'books': books,
+            'resumption': resumption,
         }
 
     def __str__(self):
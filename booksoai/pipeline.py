@@ -2,7 +2,6 @@ from __future__ import unicode_literals
 
 import logging
 import plumber
-import pyramid
 
 from lxml import etree
 from plumber import precondition
@@ -121,8 +120,9 @@ class HeaderPipe(plumber.Pipe):
         datestamp = etree.SubElement(header, 'datestamp')
         datestamp.text = data.get('updated')
 
+        # books synced before 'set' was stored fall back to the publisher
         set_spec = etree.SubElement(header, 'setSpec')
-        set_spec.text = slugfy(data.get('publisher', ''))
+        set_spec.text = data.get('set') or slugfy(data.get('publisher', ''))
 
         return (xml, data)
 
@@ -157,14 +157,32 @@ class ListIdentifiersPipe(plumber.Pipe):
 
 
 class SetPipe(plumber.Pipe):
+    xmlns = "http://www.openarchives.org/OAI/2.0/oai_dc/"
+    dc = "http://purl.org/dc/elements/1.1/"
+    xsi = "http://www.w3.org/2001/XMLSchema-instance"
+    schemaLocation = "http://www.openarchives.org/OAI/2.0/oai_dc/"
+    schemaLocation += " http://www.openarchives.org/OAI/2.0/oai_dc.xsd"
+    attrib = {"{%s}schemaLocation" % xsi: schemaLocation}
+
     def transform(self, data):
         sets = etree.Element('set')
 
         set_spec = etree.SubElement(sets, 'setSpec')
-        set_spec.text = slugfy(data)
+        set_spec.text = data.get('set')
 
         set_name = etree.SubElement(sets, 'setName')
-        set_name.text = data
+        set_name.text = data.get('name')
+
+        # counts are only loaded when set descriptions are enabled
+        if 'total_records' in data:
+            set_description = etree.SubElement(sets, 'setDescription')
+            oai_dc = etree.SubElement(set_description, '{%s}dc' % self.xmlns,
+                nsmap={'oai_dc': self.xmlns, 'dc': self.dc, 'xsi': self.xsi},
+                attrib=self.attrib
+            )
+            description = etree.SubElement(oai_dc, '{%s}description' % self.dc)
+            description.text = '%s records, from %s to %s' % (data['total_records'],
+                data.get('earliest_datestamp'), data.get('latest_datestamp'))
 
         return sets
 
@@ -177,7 +195,7 @@ class ListSetsPipe(plumber.Pipe):
         ppl = plumber.Pipeline(
             SetPipe()
         )
-        sets = data.get('books')
+        sets = data.get('sets')
         results = ppl.run(sets)
 
         for _set in results:
@@ -314,18 +332,13 @@ class ResumptionTokenPipe(plumber.Pipe):
         xml, data = item
         sub = etree.SubElement(xml, 'resumptionToken')
 
-        try:
-            total_books = data.get('books').count()
-        except (AttributeError, TypeError):
-            total_books = len(data.get('books', []))
-
-        settings = pyramid.threadlocal.get_current_registry().settings
-        items_per_page = int(settings['items_per_page'])
-        resumption_token = int(data['request'].get('resumptionToken', 0))
-        finished = items_per_page * (resumption_token + 1) >= total_books
+        resumption = data.get('resumption') or {}
+        for attr in ('completeListSize', 'cursor'):
+            if resumption.get(attr) is not None:
+                sub.attrib[attr] = str(resumption[attr])
 
-        if not finished:
-            sub.text = str(resumption_token + 1)
+        if resumption.get('token'):
+            sub.text = resumption['token']
 
         return (xml, data)
 
@@ -0,0 +1,54 @@
+import json
+import base64
+
+
+# (state key, token key) pairs; short keys keep the tokens compact.
+TOKEN_FIELDS = (
+    ('args', 'a'),
+    ('after', 'k'),
+    ('cursor', 'c'),
+    ('total', 't'),
+)
+
+
+def encode_token(state):
+    """
+    Serialize the state of a list request into an opaque resumption token.
+
+    :param state: dict with the original request `args` (set, from, until,
+                  metadataPrefix), the `after` key (a list) of the last item
+                  sent, the `cursor` of the next page and the `total` size.
+    :returns: URL-safe string.
+    """
+    payload = dict((short, state[key]) for key, short in TOKEN_FIELDS if key in state)
+    payload = json.dumps(payload, separators=(',', ':'), sort_keys=True)
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_token(token):
+    """
+    Restore the state serialized by ``encode_token``.
+
+    :param token: Resumption token sent by the harvester.
+    :returns: dict.
+    :raises: ValueError if the token is malformed.
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        state = dict((key, payload[short]) for key, short in TOKEN_FIELDS if short in payload)
+    except (TypeError, ValueError, UnicodeError, AttributeError):
+        raise ValueError('Invalid resumption token: %r' % token)
+
+    if not isinstance(state.get('args'), dict):
+        raise ValueError('Invalid resumption token: %r' % token)
+
+    after = state.get('after')
+    if after is not None and not isinstance(after, list):
+        raise ValueError('Invalid resumption token: %r' % token)
+
+    for key in ('cursor', 'total'):
+        if state.get(key) is not None and not isinstance(state[key], (int, long)):
+            raise ValueError('Invalid resumption token: %r' % token)
+
+    return state
@@ -0,0 +1,167 @@
+import os
+import random
+import logging
+import threading
+
+from datetime import datetime, timedelta
+
+from .sync import update_from_api
+from .follow import follow_changes, FOLLOW_RETRY
+from .storage import get_storage
+
+
+logger = logging.getLogger(__name__)
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+class SyncScheduler(threading.Thread):
+    """
+    Daemon thread that runs ``sync.update_from_api`` every
+    `auto_sync_interval` seconds.
+
+    Each delay is stretched by up to `auto_sync_jitter` times the interval, so
+    processes started together don't hit the books API at the same moment.
+    The first run is scheduled from the `updated_at` of the last sync.
+
+    With `sync_follow`, each run follows the changes feed until the
+    scheduler stops, and a run that ends, because another worker holds the
+    lease or the books API failed, is retried after ``FOLLOW_RETRY``
+    seconds.
+    """
+
+    def __init__(self, settings):
+        super(SyncScheduler, self).__init__(name='booksoai-sync')
+        self.daemon = True
+        self.settings = settings
+        self.follow = settings.get('sync_follow', False)
+        self.interval = FOLLOW_RETRY if self.follow else settings['auto_sync_interval']
+        self.jitter = settings.get('auto_sync_jitter', 0.1)
+        self.pid = os.getpid()
+
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._state = {
+            'running': False,
+            'runs': 0,
+            'failures': 0,
+            'last_started_at': None,
+            'last_finished_at': None,
+            'last_result': None,
+            'next_run_at': None,
+        }
+
+    def _update_state(self, **state):
+        with self._lock:
+            self._state.update(state)
+
+    def _delay(self, base):
+        return base + random.uniform(0, self.interval * self.jitter)
+
+    def first_delay(self):
+        if self.follow:
+            return self._delay(0)
+
+        try:
+            update = get_storage(self.settings).get_last_update()
+        except Exception as e:
+            logger.exception('Could not read the last sync: %s' % e)
+            update = None
+
+        base = 0
+        if update:
+            elapsed = datetime.now() - update['updated_at']
+            base = max(self.interval - elapsed.total_seconds(), 0)
+
+        return self._delay(base)
+
+    def run_once(self):
+        self._update_state(running=True, last_started_at=datetime.now())
+        try:
+            if self.follow:
+                succeeded = follow_changes(self.settings, self._stopped)
+            else:
+                succeeded = update_from_api(self.settings)
+        except Exception as e:
+            logger.exception('Sync run failed: %s' % e)
+            succeeded = False
+
+        with self._lock:
+            self._state['running'] = False
+            self._state['runs'] += 1
+            self._state['last_finished_at'] = datetime.now()
+            if succeeded is None:
+                self._state['last_result'] = 'skipped'
+            elif succeeded:
+                self._state['last_result'] = 'ok'
+            else:
+                self._state['last_result'] = 'failed'
+                self._state['failures'] += 1
+
+    def run(self):
+        delay = self.first_delay()
+        while True:
+            self._update_state(next_run_at=datetime.now() + timedelta(seconds=delay))
+            if self._stopped.wait(delay):
+                break
+
+            self.run_once()
+            delay = self._delay(self.interval)
+
+    def stop(self):
+        self._stopped.set()
+
+    def state(self):
+        """Return the scheduler state, with dates as ISO 8601 strings."""
+        with self._lock:
+            state = dict(self._state)
+
+        for key in ('last_started_at', 'last_finished_at', 'next_run_at'):
+            state[key] = _isoformat(state[key])
+
+        state['interval'] = self.interval
+        state['mode'] = 'follow' if self.follow else 'interval'
+        state['alive'] = self.is_alive() and self.pid == os.getpid()
+        return state
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def start_scheduler(settings):
+    """
+    Start the sync scheduler of the current process, unless it is already
+    running.
+
+    Threads don't survive ``fork``, so a scheduler started before the server
+    forks its workers (e.g. gunicorn with ``preload``) only runs in the
+    parent process; ``start_on_request`` starts it in the process serving
+    requests instead.
+    """
+    global _scheduler
+    if get_scheduler() is not None:
+        return _scheduler
+
+    with _scheduler_lock:
+        if _scheduler is None or _scheduler.pid != os.getpid():
+            _scheduler = SyncScheduler(settings)
+            _scheduler.start()
+
+    return _scheduler
+
+
+def get_scheduler():
+    """Return the scheduler started in this process, or None."""
+    if _scheduler is not None and _scheduler.pid == os.getpid():
+        return _scheduler
+
+
+def start_on_request(event):
+    """
+    ``NewRequest`` subscriber that starts the scheduler in the process
+    serving the request, the first time it serves one.
+    """
+    start_scheduler(event.request.registry.settings)
@@ -0,0 +1,147 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+from pymongo import uri_parser
+
+from booksoai import parse_settings
+from booksoai.standin import BooksAPIStandIn
+from booksoai.storage import get_storage
+from booksoai.sync import update_from_api
+
+
+# storage methods that write, counted as round trips to the backend
+WRITE_METHODS = ('write_books', 'set_revisions', 'set_last_seq',
+                 'refresh_repository_stats', 'refresh_sets', 'add_sync_run')
+
+
+def is_benchmark_database(mongo_uri):
+    """Tell whether ``mongo_uri`` names a database the benchmark may drop."""
+    return (uri_parser.parse_uri(mongo_uri)['database'] or '').endswith('benchmark')
+
+
+def count_writes(storage):
+    """
+    Count the calls to the write methods of ``storage``.
+
+    :returns: dict of calls per method, updated as they happen.
+    """
+    counts = dict((name, 0) for name in WRITE_METHODS)
+    lock = threading.Lock()
+
+    def counted(name, method):
+        def wrapper(*args, **kwargs):
+            with lock:
+                counts[name] += 1
+            return method(*args, **kwargs)
+        return wrapper
+
+    for name in WRITE_METHODS:
+        setattr(storage, name, counted(name, getattr(storage, name)))
+
+    return counts
+
+
+def run_pass(settings, api, writes, since=None):
+    """Run a sync against ``api`` and report its throughput and round trips."""
+    requests_before = dict(api.requests)
+    writes_before = dict(writes)
+    stats = {}
+
+    started = time.time()
+    result = update_from_api(settings, since=since, stats=stats)
+    elapsed = time.time() - started
+
+    report = {
+        'result': result,
+        'seconds': elapsed,
+        'books_per_second': stats['books'] / elapsed if elapsed else 0,
+        'http': dict((kind, api.requests[kind] - requests_before[kind])
+                     for kind in api.requests),
+        'writes': dict((name, writes[name] - writes_before[name]) for name in writes),
+    }
+    report.update(stats)
+    return report
+
+
+def print_report(title, report):
+    print('%s: %s' % (title, 'ok' if report['result'] else 'failed'))
+    print('  %(changes)s changes, %(books)s books, %(unchanged)s unchanged, '
+          '%(not_modified)s not modified, %(errors)s errors' % report)
+    print('  %.2fs, %.1f books/s' % (report['seconds'], report['books_per_second']))
+    print('  http round trips: %(changes)s changes, %(book)s books, '
+          '%(errors)s failed' % report['http'])
+    print('  storage writes: %s (%s)' % (
+        sum(report['writes'].values()),
+        ', '.join('%s %s' % (name, count)
+                  for name, count in sorted(report['writes'].items()) if count)))
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the sync against a local stand-in of the books API. '
+                    'The benchmark database is dropped before and after the run, '
+                    'so its name must end with "benchmark".')
+    parser.add_argument('--books', type=int, default=1000, help='corpus size (default: 1000)')
+    parser.add_argument('--latency', type=float, default=0,
+        help='milliseconds added to every API response')
+    parser.add_argument('--error-rate', type=float, default=0,
+        help='fraction of the API requests answered with a 503')
+    parser.add_argument('--storage', choices=('mongodb', 'sqlite'), default='mongodb')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/booksoai-benchmark')
+    parser.add_argument('--concurrency', type=int, help='sync_concurrency')
+    parser.add_argument('--page-size', type=int, help='sync_page_size')
+    parser.add_argument('--batch-size', type=int, help='sync_batch_size')
+    parser.add_argument('--replay', action='store_true',
+        help='sync the whole feed again after the first pass')
+    args = parser.parse_args(argv[1:])
+
+    if args.storage == 'mongodb' and not is_benchmark_database(args.mongo_uri):
+        parser.error('refusing to drop %s: the name of the benchmark database '
+                     'must end with "benchmark"' % args.mongo_uri)
+
+    settings = parse_settings({})
+    tmpdir = tempfile.mkdtemp()
+    api = BooksAPIStandIn(args.books, args.latency / 1000.0, args.error_rate).start()
+
+    # set after parsing, so BOOKSOAI_* variables never point the benchmark
+    # to a real database or API
+    settings.update(scielo_uri=api.uri, storage_backend=args.storage,
+                    mongo_uri=args.mongo_uri,
+                    sqlite_path=os.path.join(tmpdir, 'benchmark.db'),
+                    api_backoff=0.01)
+    for option, name in (('concurrency', 'sync_concurrency'),
+                         ('page_size', 'sync_page_size'),
+                         ('batch_size', 'sync_batch_size')):
+        if getattr(args, option) is not None:
+            settings[name] = getattr(args, option)
+
+    storage = get_storage(settings)
+    if args.storage == 'mongodb':
+        storage.db.connection.drop_database(storage.db.name)
+
+    try:
+        storage.ensure_indexes()
+        writes = count_writes(storage)
+
+        print('%s books, %sms latency, %s error rate, %s storage, concurrency %s' % (
+            args.books, args.latency, args.error_rate, args.storage,
+            settings['sync_concurrency']))
+        print_report('sync', run_pass(settings, api, writes))
+        if args.replay:
+            print_report('replay', run_pass(settings, api, writes, since=0))
+    finally:
+        api.stop()
+        if args.storage == 'mongodb':
+            storage.db.connection.drop_database(storage.db.name)
+        shutil.rmtree(tmpdir)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
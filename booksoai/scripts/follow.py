@@ -0,0 +1,44 @@
+import sys
+import signal
+import argparse
+import threading
+
+from pyramid.paster import get_appsettings, setup_logging
+
+from booksoai import parse_settings
+from booksoai.follow import follow_changes, FOLLOW_RETRY
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description='Apply the changes of the SciELO Books API as they arrive, '
+                    'until interrupted.')
+    parser.add_argument('config_uri', help='app configuration file, e.g. production.ini')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = parse_settings(get_appsettings(args.config_uri))
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+
+    while not stopped.is_set():
+        stats = {}
+        result = follow_changes(settings, stopped, stats)
+
+        if result is None:
+            print('another worker holds the sync lease, retrying in %ss' % FOLLOW_RETRY)
+        elif not result:
+            print('following failed after %s changes, retrying in %ss' % (
+                stats['changes'], FOLLOW_RETRY))
+        else:
+            print('stopped after %s changes (%s books, %s deleted, %s errors)' % (
+                stats['changes'], stats['books'], stats['deleted'], stats['errors']))
+
+        stopped.wait(FOLLOW_RETRY)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
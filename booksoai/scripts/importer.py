@@ -0,0 +1,53 @@
+import sys
+import argparse
+
+from pyramid.paster import get_appsettings, setup_logging
+
+from booksoai import parse_settings
+from booksoai.storage import StorageError, get_storage
+from booksoai.sync import parse_write_concern
+from booksoai.importer import import_dump
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description='Bootstrap an empty storage from a JSON-lines dump of '
+                    'the books API.')
+    parser.add_argument('config_uri', help='app configuration file, e.g. production.ini')
+    parser.add_argument('dump', help='JSON-lines dump, or - for stdin')
+    parser.add_argument('--last-seq', type=int, metavar='SEQ',
+        help='seq of the changes feed the dump was taken at')
+    parser.add_argument('--batch-size', type=int, default=1000,
+        help='books per insert batch (default: 1000)')
+    parser.add_argument('--workers', type=int, default=4,
+        help='batches inserted in parallel (default: 4)')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = parse_settings(get_appsettings(args.config_uri))
+    storage = get_storage(settings)
+
+    count = storage.count_books()
+    if count:
+        print('the storage already holds %s books; the import only loads '
+              'empty storages' % count)
+        return 1
+
+    dump = sys.stdin if args.dump == '-' else open(args.dump)
+    try:
+        imported, last_seq = import_dump(
+            dump, storage, args.last_seq, args.batch_size, args.workers,
+            parse_write_concern(settings.get('sync_write_concern')))
+    except StorageError as e:
+        print('import failed: %s' % e)
+        return 1
+    finally:
+        if dump is not sys.stdin:
+            dump.close()
+
+    print('imported %s books, sync resumes after seq %s' % (imported, last_seq or 0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
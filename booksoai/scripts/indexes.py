@@ -0,0 +1,42 @@
+import sys
+import argparse
+
+from pyramid.paster import get_appsettings, setup_logging
+
+from booksoai import parse_settings
+from booksoai.storage import get_storage
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description='Build the storage indexes declared by booksoai, and store '
+                    'the set of the books synced before sets were stored.')
+    parser.add_argument('config_uri', help='app configuration file, e.g. production.ini')
+    parser.add_argument('--check', action='store_true',
+        help='only report missing and redundant indexes')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = parse_settings(get_appsettings(args.config_uri))
+    storage = get_storage(settings)
+
+    if args.check:
+        report = storage.check_indexes()
+    else:
+        report = storage.ensure_indexes()
+        backfilled = storage.backfill_sets()
+        print('backfilled the set of %s books' % backfilled)
+        if storage.ensure_sets():
+            print('materialized the sets')
+
+    for status in ('created', 'existing', 'missing', 'mismatched', 'redundant'):
+        for collection, name in report.get(status, []):
+            print('%-10s %s.%s' % (status, collection, name))
+
+    if args.check and (report['missing'] or report['mismatched']):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+import sys
+import time
+import signal
+import argparse
+
+from pyramid.paster import get_appsettings, setup_logging
+
+from booksoai import parse_settings
+from booksoai.sync import update_from_api
+from booksoai.scheduler import SyncScheduler
+
+
+def schedule(settings):
+    """
+    Run the sync scheduler in the foreground until SIGTERM or SIGINT, as the
+    one process that syncs a deployment.
+    """
+    scheduler = SyncScheduler(settings)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: scheduler.stop())
+
+    print('syncing in %s mode every %ss' % (
+        'follow' if scheduler.follow else 'interval', scheduler.interval))
+    scheduler.start()
+    # joined with a timeout, so the signals are handled
+    while scheduler.is_alive():
+        scheduler.join(1)
+
+    return 0
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        description='Sync the books from the SciELO Books API once, or on a '
+                    'schedule with --schedule.')
+    parser.add_argument('config_uri', help='app configuration file, e.g. production.ini')
+    parser.add_argument('--since', type=int, metavar='SEQ',
+        help='sync the changes after SEQ instead of the last synced seq')
+    parser.add_argument('--dry-run', action='store_true',
+        help='fetch and adapt the changes without writing them, and report '
+             'the throughput')
+    parser.add_argument('--schedule', action='store_true',
+        help='keep syncing every auto_sync_interval seconds, or following the '
+             'changes feed with sync_follow, until interrupted')
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = parse_settings(get_appsettings(args.config_uri))
+
+    if args.schedule:
+        return schedule(settings)
+
+    stats = {}
+    started = time.time()
+    result = update_from_api(settings, since=args.since, dry_run=args.dry_run, stats=stats)
+    elapsed = time.time() - started
+
+    if result is None:
+        print('skipped: another worker holds the sync lease')
+        return 0
+
+    print('%s changes (%s books, %s unchanged, %s not modified, %s deleted, '
+          '%s errors, %s duplicates skipped) in %.2fs, %.1f changes/s' % (
+        stats['changes'], stats['books'], stats['unchanged'], stats['not_modified'],
+        stats['deleted'], stats['errors'], stats['duplicates'], elapsed,
+        stats['changes'] / elapsed if elapsed else 0))
+
+    return 0 if result else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,237 @@
+"""
+Local stand-in for the SciELO Books API, for benchmarks and end-to-end tests.
+
+It serves ``/changes/`` and ``/book/<id>/`` from a generated corpus, with
+the CouchDB semantics the sync relies on: every book is listed once in the
+changes feed, at the seq of its latest change, and ``feed=longpoll`` holds
+the request until a change arrives or ``timeout`` milliseconds pass.
+"""
+import sys
+import json
+import time
+import bisect
+import random
+import urlparse
+import argparse
+import threading
+
+from SocketServer import ThreadingMixIn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+PUBLISHERS = ('EDUFBA', 'Editora UNESP', 'Editora FIOCRUZ', 'EDUERJ', 'Editora UFMG')
+
+
+def make_book(identifier, rev):
+    index = abs(hash(identifier))
+    return {
+        '_id': identifier,
+        '_rev': rev,
+        'title': 'Book %s, revision %s' % (identifier, rev),
+        'publisher': PUBLISHERS[index % len(PUBLISHERS)],
+        'language': 'pt',
+        'year': str(1990 + index % 25),
+        'synopsis': 'Synopsis of book %s. ' % identifier * 10,
+        'creators': {'individual_author': [['Author %s' % index, None]]},
+        'updated': '2014-%02d-%02dT10:00:00.000000' % (index % 12 + 1, index % 28 + 1),
+        'pdf_file': {'uri': 'http://books.scielo.org/id/%s/pdf' % identifier},
+        'epub_file': {'uri': 'http://books.scielo.org/id/%s/epub' % identifier},
+    }
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        api = self.server.api
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        parts = [part for part in url.path.split('/') if part]
+
+        if api.latency:
+            time.sleep(api.latency)
+
+        if parts == ['changes']:
+            kind = 'changes'
+        elif len(parts) == 2 and parts[0] == 'book':
+            kind = 'book'
+        else:
+            return self._send(404, {'error': 'not_found'})
+
+        if api.fail():
+            api.count('errors')
+            return self._send(503, {'error': 'unavailable'})
+
+        api.count(kind)
+        if kind == 'changes':
+            self._send(200, api.changes(int(params.get('since', 0)),
+                                        int(params['limit']) if 'limit' in params else None,
+                                        params.get('feed') == 'longpoll',
+                                        int(params.get('timeout', 60000)) / 1000.0,
+                                        params.get('descending') == 'true'))
+        else:
+            book = api.book(parts[1], params.get('rev'))
+            if book is None:
+                self._send(404, {'error': 'not_found'})
+            else:
+                self._send(200, book)
+
+
+class BooksAPIStandIn(object):
+    """
+    Books API served from a corpus of ``books`` generated books.
+
+    :param latency: Seconds added to every response.
+    :param error_rate: Fraction of the requests answered with a 503.
+    :param seed: Seed of the errors, so runs are reproducible.
+    """
+
+    def __init__(self, books=1000, latency=0, error_rate=0, seed=0,
+                 host='127.0.0.1', port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = {'changes': 0, 'book': 0, 'errors': 0}
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._revisions = {}
+        self._seqs = []
+        self._feed = []
+        self._latest = {}
+        self._deleted = set()
+
+        for index in range(books):
+            self._change('%st' % index)
+
+        self.server = ThreadingHTTPServer((host, port), StandInHandler)
+        self.server.api = self
+        self._thread = None
+
+    @property
+    def uri(self):
+        return 'http://%s:%s' % self.server.server_address
+
+    @property
+    def last_seq(self):
+        with self._lock:
+            return self._seqs[-1] if self._seqs else 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name='books-api-standin')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+    def count(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _change(self, identifier, deleted=False):
+        # called with the lock held, or before the server starts
+        seq = len(self._feed) + 1
+        if deleted:
+            self._deleted.add(identifier)
+        else:
+            self._deleted.discard(identifier)
+            generation = len(self._revisions.get(identifier, [])) + 1
+            self._revisions.setdefault(identifier, []).append('%s-%08x' % (generation, seq))
+
+        self._seqs.append(seq)
+        self._feed.append(identifier)
+        self._latest[identifier] = seq
+
+    def update_books(self, identifiers, deleted=False):
+        """Add a change for each of ``identifiers`` to the feed."""
+        with self._changed:
+            for identifier in identifiers:
+                self._change(identifier, deleted)
+            self._changed.notify_all()
+
+    def _results(self, since, limit, descending=False):
+        results = []
+        indexes = range(bisect.bisect_right(self._seqs, since), len(self._seqs))
+        for index in reversed(indexes) if descending else indexes:
+            seq, identifier = self._seqs[index], self._feed[index]
+            if self._latest[identifier] != seq:
+                continue
+
+            change = {'seq': seq, 'id': identifier}
+            if identifier in self._deleted:
+                change['deleted'] = True
+            else:
+                change['changes'] = [{'rev': self._revisions[identifier][-1]}]
+            results.append(change)
+
+            if limit and len(results) >= limit:
+                break
+        return results
+
+    def changes(self, since, limit=None, longpoll=False, timeout=60, descending=False):
+        if descending:
+            # the latest changes first, as CouchDB lists them
+            with self._lock:
+                results = self._results(0, limit, descending=True)
+            return {'results': results, 'last_seq': results[-1]['seq'] if results else 0}
+
+        deadline = time.time() + timeout
+        with self._changed:
+            results = self._results(since, limit)
+            while longpoll and not results and time.time() < deadline:
+                self._changed.wait(deadline - time.time())
+                results = self._results(since, limit)
+
+            last_seq = results[-1]['seq'] if results else max(since, 0)
+            return {'results': results, 'last_seq': last_seq}
+
+    def book(self, identifier, rev=None):
+        with self._lock:
+            revisions = self._revisions.get(identifier)
+            if not revisions or (rev is not None and rev not in revisions):
+                return None
+
+            rev = rev or revisions[-1]
+            return make_book(identifier, rev)
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description='Serve a stand-in of the SciELO Books API.')
+    parser.add_argument('--books', type=int, default=1000, help='corpus size (default: 1000)')
+    parser.add_argument('--latency', type=float, default=0,
+        help='milliseconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0,
+        help='fraction of the requests answered with a 503')
+    parser.add_argument('--port', type=int, default=6544)
+    args = parser.parse_args(argv[1:])
+
+    api = BooksAPIStandIn(args.books, args.latency / 1000.0, args.error_rate, port=args.port)
+    print('serving %s books at %s' % (args.books, api.uri))
+    api.server.serve_forever()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,243 @@
+from __future__ import absolute_import
+
+import os
+import threading
+
+
+class StorageError(Exception):
+    """The backend failed or could not be reached."""
+
+
+class Storage(object):
+    """
+    Operations the OAI-PMH verbs and the sync process need from a backend.
+
+    Books are dicts shaped like the output of ``sync.adapt_data``. List
+    queries receive normalized ``filters`` (`set`, `from` and `until`, the
+    dates as YYYY-MM-DD strings) and return books sorted by
+    (updated, identifier), resuming after the ``after`` key when given.
+    Sets are dicts with `set`, `name`, `total_records`, `deleted_records`,
+    `earliest_datestamp` and `latest_datestamp`.
+    """
+
+    # Books
+
+    def find_book(self, identifier, fields=None):
+        """Return the book with ``identifier`` or None."""
+        raise NotImplementedError
+
+    def find_books(self, filters, after=None, limit=None, fields=None):
+        """Return a list of at most ``limit`` books matching ``filters``."""
+        raise NotImplementedError
+
+    def count_books(self, filters=None):
+        raise NotImplementedError
+
+    def iter_identifiers(self):
+        """Iterate over every stored identifier, reading only the index."""
+        raise NotImplementedError
+
+    def upsert_book(self, book):
+        """Insert ``book`` or update the stored fields of the same identifier."""
+        raise NotImplementedError
+
+    def mark_as_deleted(self, identifier, datestamp):
+        raise NotImplementedError
+
+    def insert_books(self, books, write_concern=None):
+        """
+        Insert new ``books`` in a single round trip, without the lookups of
+        an upsert. Meant for loading an empty storage.
+        """
+        raise NotImplementedError
+
+    def replace_books(self, books, write_concern=None):
+        """
+        Store ``books`` in place of the stored books with the same identifiers,
+        dropping the fields they don't have.
+        """
+        raise NotImplementedError
+
+    def get_content_hashes(self, identifiers):
+        """
+        Return a dict of the `content_hash` of the stored books among
+        ``identifiers``. Deleted books and books without a hash are left out.
+        """
+        raise NotImplementedError
+
+    def get_revisions(self, identifiers):
+        """
+        Return a dict of the books API `revision` of the stored books among
+        ``identifiers``. Deleted books and books without a revision are left
+        out.
+        """
+        raise NotImplementedError
+
+    def set_revisions(self, revisions, write_concern=None):
+        """
+        Store the `revision` of each identifier of the ``revisions`` dict,
+        leaving the other fields, and the datestamp, untouched.
+        """
+        raise NotImplementedError
+
+    def write_books(self, books, deleted, datestamp, write_concern=None):
+        """
+        Upsert ``books`` and mark the ``deleted`` identifiers as deleted in as
+        few round trips as the backend allows. An identifier appears at most
+        once per call, since the writes may be applied in any order.
+        """
+        raise NotImplementedError
+
+    # Sets
+
+    def find_sets(self, after=None, limit=None, fields=None):
+        """Return sets sorted by slug, resuming after the ``after`` slug."""
+        raise NotImplementedError
+
+    def count_sets(self):
+        raise NotImplementedError
+
+    def refresh_sets(self):
+        """Rebuild the materialized sets from the stored books."""
+        raise NotImplementedError
+
+    def ensure_sets(self):
+        """
+        Materialize the sets of a repository that has none, e.g. one that was
+        not synced since sets were materialized. Returns True if they were
+        refreshed.
+
+        :raises StorageError: if the backend fails.
+        """
+        raise NotImplementedError
+
+    def backfill_sets(self):
+        """
+        Store the `set` slug of the books synced before it was introduced,
+        from their publisher, and refresh the sets when any was updated.
+        Returns the number of books updated.
+
+        :raises StorageError: if the backend fails.
+        """
+        raise NotImplementedError
+
+    # Repository
+
+    def get_repository_stats(self):
+        """
+        Return the repository stats: `earliest_datestamp`, `latest_datestamp`,
+        `total_records`, `deleted_records` and `last_seq`.
+        """
+        raise NotImplementedError
+
+    def refresh_repository_stats(self, last_seq):
+        raise NotImplementedError
+
+    def get_sync_seq(self):
+        """Return the `last_seq` recorded in the repository stats, or None."""
+        raise NotImplementedError
+
+    # Sync state
+
+    def get_last_update(self):
+        """Return a dict with the sync `last_seq` and `updated_at`, or None."""
+        raise NotImplementedError
+
+    def set_last_seq(self, seq):
+        raise NotImplementedError
+
+    def get_books_version(self):
+        """
+        Return a counter, read from the primary, that changes whenever books
+        are written by ``upsert_book``, ``insert_books``, ``replace_books`` or
+        ``write_books``; 0 before the first write.
+        """
+        raise NotImplementedError
+
+    def add_sync_run(self, run, keep=None):
+        """
+        Record the telemetry of a sync run, a dict with its `started_at`
+        datetime. Only the last ``keep`` runs are kept, when given.
+        """
+        raise NotImplementedError
+
+    def find_sync_runs(self, limit=10):
+        """Return the last ``limit`` sync runs, the latest first."""
+        raise NotImplementedError
+
+    # Leases
+
+    def acquire_lease(self, name, owner, ttl):
+        """
+        Take the lease ``name`` for ``ttl`` seconds if it is free, expired or
+        already held by ``owner``. Returns whether ``owner`` holds it.
+        """
+        raise NotImplementedError
+
+    def renew_lease(self, name, owner, ttl):
+        """Extend a lease held by ``owner``; returns False if it was lost."""
+        raise NotImplementedError
+
+    def release_lease(self, name, owner):
+        raise NotImplementedError
+
+    # Maintenance
+
+    def check_indexes(self):
+        raise NotImplementedError
+
+    def ensure_indexes(self):
+        """
+        Idempotently build the indexes; returns an ``indexes`` report.
+
+        :raises StorageError: if the backend fails.
+        """
+        raise NotImplementedError
+
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage(settings):
+    """
+    Return the storage backend configured by `storage_backend`, shared by the
+    current process.
+
+    :param settings: App settings, as returned by ``parse_settings``.
+    :returns: Storage.
+    """
+    backend = settings.get('storage_backend', 'mongodb')
+    if backend == 'mongodb':
+        location = settings['mongo_uri']
+    elif backend == 'sqlite':
+        location = settings['sqlite_path']
+    else:
+        raise ValueError('Unknown storage backend: %s' % backend)
+
+    key = (os.getpid(), backend, location)
+    with _storages_lock:
+        storage = _storages.get(key)
+        if storage is None:
+            for stale_key in [k for k in _storages if k[0] != key[0]]:
+                del _storages[stale_key]
+
+            if backend == 'mongodb':
+                from pymongo.read_preferences import ReadPreference
+                from .mongodb import MongoStorage
+                from ..utils import get_db_connection, get_read_preference
+
+                db = read_db = get_db_connection(settings)
+                read_preference = get_read_preference(settings)
+                if read_preference != ReadPreference.PRIMARY:
+                    read_db = get_db_connection(settings, read_preference)
+
+                storage = MongoStorage(db, read_db,
+                                       settings.get('mongo_max_staleness_seconds', 0))
+            else:
+                from .sqlite import SQLiteStorage
+                storage = SQLiteStorage(location)
+
+            _storages[key] = storage
+
+    return storage
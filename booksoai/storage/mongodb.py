@@ -0,0 +1,413 @@
+from __future__ import absolute_import
+
+import time
+import logging
+import functools
+
+from datetime import datetime, timedelta
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from simpleslug import slugfy
+
+from . import Storage, StorageError
+from .. import indexes
+from ..utils import replication_lag
+
+
+logger = logging.getLogger(__name__)
+
+REPOSITORY_STATS_ID = 'repository'
+BOOKS_VERSION_ID = 'books_version'
+UPDATES_ID = 1
+
+# seconds between checks of the replication lag, when reads have a maximum
+# staleness
+STALENESS_CHECK_INTERVAL = 10
+
+# must match the compound indexes declared in `indexes.INDEXES`; projections
+# limited to fields of those indexes are served as covered queries
+BOOKS_SORT = [('updated', ASCENDING), ('identifier', ASCENDING)]
+
+
+def _versioned(method):
+    """
+    Bump the books version before and after ``method`` writes books, so a
+    reader that saw the version before the write, or during it, sees it
+    change once the books are stored.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._bump_books_version()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._bump_books_version()
+    return wrapper
+
+
+def _projection(fields):
+    if fields is None:
+        return None
+
+    projection = dict((field, 1) for field in fields)
+    projection['_id'] = 0
+    return projection
+
+
+def _set_from_document(document):
+    document = dict(document)
+    document['set'] = document.pop('_id')
+    return document
+
+
+class MongoStorage(Storage):
+    """
+    Storage backed by the `books`, `sets`, `stats` and `updates` collections
+    of a MongoDB database.
+
+    Harvest queries go through ``read_db``, usually a handle with a secondary
+    read preference, while the sync reads and writes through ``db`` on the
+    primary. When ``max_staleness`` is set, harvest queries fall back to the
+    primary while any secondary lags further behind (or the lag is unknown).
+    """
+
+    def __init__(self, db, read_db=None, max_staleness=0):
+        self.db = db
+        self.read_db = read_db if read_db is not None else db
+        self.max_staleness = max_staleness
+        self._stale = False
+        self._staleness_checked_at = 0
+
+    @property
+    def reads(self):
+        if self.read_db is self.db or not self.max_staleness:
+            return self.read_db
+
+        if time.time() - self._staleness_checked_at > STALENESS_CHECK_INTERVAL:
+            self._staleness_checked_at = time.time()
+            lag = replication_lag(self.db.connection)
+            stale = lag is None or lag > self.max_staleness
+
+            if stale and not self._stale:
+                logger.warning('Replication lag of %s seconds, reading from primary' % lag)
+            self._stale = stale
+
+        return self.db if self._stale else self.read_db
+
+    def _search(self, filters):
+        search = {}
+        filters = filters or {}
+
+        if filters.get('set'):
+            search['set'] = filters['set']
+
+        if filters.get('from'):
+            search['updated'] = {'$gte': filters['from']}
+
+        if filters.get('until'):
+            search.setdefault('updated', {})['$lte'] = filters['until']
+
+        return search
+
+    # Books
+
+    def find_book(self, identifier, fields=None):
+        return self.reads.books.find_one({'identifier': identifier}, _projection(fields))
+
+    def find_books(self, filters, after=None, limit=None, fields=None):
+        search = self._search(filters)
+
+        if after is not None:
+            updated, identifier = after
+            search['$or'] = [
+                {'updated': {'$gt': updated}},
+                {'updated': updated, 'identifier': {'$gt': identifier}},
+            ]
+
+        books = self.reads.books.find(search, _projection(fields)).sort(BOOKS_SORT)
+        if limit is not None:
+            books = books.limit(limit)
+
+        return list(books)
+
+    def count_books(self, filters=None):
+        return self.reads.books.find(self._search(filters)).count()
+
+    def iter_identifiers(self):
+        books = self.reads.books.find({}, {'identifier': 1, '_id': 0})
+        for book in books.hint([('identifier', ASCENDING)]):
+            yield book['identifier']
+
+    @_versioned
+    def upsert_book(self, book):
+        self.db.books.update({
+            'identifier': book['identifier']
+        }, {
+            '$set': book
+        }, upsert=True)
+
+    def mark_as_deleted(self, identifier, datestamp):
+        self.db.books.update({
+            'identifier': identifier
+        }, {
+            '$set': {
+                'deleted': True,
+                'datestamp': datestamp
+            }
+        })
+
+    @_versioned
+    def insert_books(self, books, write_concern=None):
+        if not books:
+            return
+
+        bulk = self.db.books.initialize_unordered_bulk_op()
+        for book in books:
+            bulk.insert(book)
+        bulk.execute(write_concern)
+
+    @_versioned
+    def replace_books(self, books, write_concern=None):
+        if not books:
+            return
+
+        bulk = self.db.books.initialize_unordered_bulk_op()
+        for book in books:
+            bulk.find({'identifier': book['identifier']}).upsert().replace_one(book)
+        bulk.execute(write_concern)
+
+    def get_content_hashes(self, identifiers):
+        books = self.db.books.find({
+            'identifier': {'$in': list(identifiers)},
+            'deleted': {'$ne': True},
+            'content_hash': {'$exists': True}
+        }, {'identifier': 1, 'content_hash': 1, '_id': 0})
+
+        return dict((book['identifier'], book['content_hash']) for book in books)
+
+    def get_revisions(self, identifiers):
+        books = self.db.books.find({
+            'identifier': {'$in': list(identifiers)},
+            'deleted': {'$ne': True},
+            'revision': {'$exists': True}
+        }, {'identifier': 1, 'revision': 1, '_id': 0})
+
+        return dict((book['identifier'], book['revision']) for book in books)
+
+    def set_revisions(self, revisions, write_concern=None):
+        if not revisions:
+            return
+
+        bulk = self.db.books.initialize_unordered_bulk_op()
+        for identifier, revision in revisions.items():
+            bulk.find({'identifier': identifier}).update({'$set': {'revision': revision}})
+        bulk.execute(write_concern)
+
+    @_versioned
+    def write_books(self, books, deleted, datestamp, write_concern=None):
+        if not books and not deleted:
+            return
+
+        bulk = self.db.books.initialize_unordered_bulk_op()
+        for book in books:
+            bulk.find({'identifier': book['identifier']}).upsert().update({'$set': book})
+        for identifier in deleted:
+            bulk.find({'identifier': identifier}).update({
+                '$set': {'deleted': True, 'datestamp': datestamp}
+            })
+
+        bulk.execute(write_concern)
+
+    # Sets
+
+    def find_sets(self, after=None, limit=None, fields=None):
+        search = {}
+        if after is not None:
+            search['_id'] = {'$gt': after}
+
+        sets = self.reads.sets.find(search, list(fields) if fields else None)
+        sets = sets.sort('_id', ASCENDING)
+        if limit is not None:
+            sets = sets.limit(limit)
+
+        return [_set_from_document(document) for document in sets]
+
+    def count_sets(self):
+        return self.reads.sets.count()
+
+    def _datestamp(self, direction, search=None):
+        books = self.db.books.find(search or {}, {'updated': 1, '_id': 0})
+        for book in books.sort('updated', direction).limit(1):
+            return book.get('updated')
+
+    def _set_stats(self, set_spec):
+        # sets are few, so each one is computed from indexed queries instead
+        # of grouping all books
+        search = {'set': set_spec}
+        latest = self.db.books.find(search, {'publisher': 1, '_id': 0})
+        latest = latest.sort('updated', DESCENDING).limit(1)
+
+        return {
+            '_id': set_spec,
+            'name': next(iter(latest), {}).get('publisher', set_spec),
+            'total_records': self.db.books.find(search).count(),
+            'deleted_records': self.db.books.find(dict(search, deleted=True)).count(),
+            'earliest_datestamp': self._datestamp(ASCENDING, search),
+            'latest_datestamp': self._datestamp(DESCENDING, search),
+        }
+
+    def refresh_sets(self):
+        set_specs = [spec for spec in self.db.books.distinct('set') if spec]
+
+        for set_spec in set_specs:
+            self.db.sets.save(self._set_stats(set_spec))
+
+        self.db.sets.remove({'_id': {'$nin': set_specs}})
+        return set_specs
+
+
+    def ensure_sets(self):
+        try:
+            # the primary, so a lagging secondary doesn't trigger a refresh
+            if self.db.sets.count():
+                return False
+            self.refresh_sets()
+        except PyMongoError as e:
+            raise StorageError('MongoDB: %s' % e)
+
+        return True
+    def backfill_sets(self):
+        try:
+            books = self.db.books.find({
+                'set': {'$exists': False},
+                'publisher': {'$exists': True}
+            }, {'identifier': 1, 'publisher': 1, '_id': 0})
+
+            count = 0
+            bulk = self.db.books.initialize_unordered_bulk_op()
+            for book in books:
+                bulk.find({'identifier': book['identifier']}).update(
+                    {'$set': {'set': slugfy(book['publisher'])}})
+                count += 1
+
+            if count:
+                bulk.execute()
+                self.refresh_sets()
+        except PyMongoError as e:
+            raise StorageError('MongoDB: %s' % e)
+
+        return count
+
+    # Repository
+
+    def _repository_stats(self):
+        return {
+            'earliest_datestamp': self._datestamp(ASCENDING),
+            'latest_datestamp': self._datestamp(DESCENDING),
+            'total_records': self.db.books.count(),
+            'deleted_records': self.db.books.find({'deleted': True}).count(),
+        }
+
+    def get_repository_stats(self):
+        stats = self.reads.stats.find_one({'_id': REPOSITORY_STATS_ID}, {'_id': 0})
+        if stats is None:
+            # repositories that were not synced since the document was introduced
+            stats = self._repository_stats()
+            stats['last_seq'] = 0
+
+        return stats
+
+    def refresh_repository_stats(self, last_seq):
+        stats = self._repository_stats()
+        stats['last_seq'] = last_seq
+        stats['updated_at'] = datetime.now()
+
+        self.db.stats.update({'_id': REPOSITORY_STATS_ID}, {'$set': stats}, upsert=True)
+        return stats
+
+    def get_sync_seq(self):
+        stats = self.reads.stats.find_one({'_id': REPOSITORY_STATS_ID}, {'last_seq': 1})
+        return stats.get('last_seq') if stats else None
+
+    # Sync state
+
+    def get_last_update(self):
+        return self.db.updates.find_one()
+
+    def set_last_seq(self, seq):
+        self.db.updates.update({
+            '_id': UPDATES_ID
+        }, {
+            '$set': {
+                'last_seq': seq,
+                'updated_at': datetime.now()
+            }
+        }, upsert=True)
+
+    def _bump_books_version(self):
+        self.db.stats.update({'_id': BOOKS_VERSION_ID}, {'$inc': {'version': 1}}, upsert=True)
+
+    def get_books_version(self):
+        version = self.db.stats.find_one({'_id': BOOKS_VERSION_ID})
+        return version['version'] if version else 0
+
+    def add_sync_run(self, run, keep=None):
+        self.db.sync_runs.insert(dict(run))
+
+        if keep:
+            stale = self.db.sync_runs.find({}, {'_id': 1}).sort(
+                'started_at', DESCENDING).skip(keep)
+            stale_ids = [document['_id'] for document in stale]
+            if stale_ids:
+                self.db.sync_runs.remove({'_id': {'$in': stale_ids}})
+
+    def find_sync_runs(self, limit=10):
+        runs = self.reads.sync_runs.find({}, {'_id': 0}).sort('started_at', DESCENDING)
+        return list(runs.limit(limit))
+
+    # Leases
+
+    def acquire_lease(self, name, owner, ttl):
+        now = datetime.utcnow()
+        try:
+            # the upsert inserts a second `_id` (and fails) when the lease
+            # is held by someone else and still valid
+            self.db.leases.update({
+                '_id': name,
+                '$or': [{'owner': owner}, {'expires_at': {'$lt': now}}]
+            }, {
+                '$set': {
+                    'owner': owner,
+                    'expires_at': now + timedelta(seconds=ttl)
+                }
+            }, upsert=True)
+        except DuplicateKeyError:
+            return False
+
+        return True
+
+    def renew_lease(self, name, owner, ttl):
+        result = self.db.leases.update({
+            '_id': name,
+            'owner': owner
+        }, {
+            '$set': {
+                'expires_at': datetime.utcnow() + timedelta(seconds=ttl)
+            }
+        })
+        return result['n'] == 1
+
+    def release_lease(self, name, owner):
+        self.db.leases.remove({'_id': name, 'owner': owner})
+
+    # Maintenance
+
+    def check_indexes(self):
+        return indexes.check_indexes(self.db)
+
+    def ensure_indexes(self):
+        try:
+            return indexes.ensure_indexes(self.db)
+        except PyMongoError as e:
+            raise StorageError('MongoDB: %s' % e)
@@ -0,0 +1,446 @@
+from __future__ import absolute_import
+
+import time
+import sqlite3
+import threading
+
+from datetime import datetime
+
+from bson import json_util
+from simpleslug import slugfy
+
+from . import Storage, StorageError
+
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS books (
+        identifier TEXT PRIMARY KEY,
+        updated TEXT,
+        set_spec TEXT,
+        publisher TEXT,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        document TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS sets (
+        set_spec TEXT PRIMARY KEY,
+        name TEXT,
+        total_records INTEGER,
+        deleted_records INTEGER,
+        earliest_datestamp TEXT,
+        latest_datestamp TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS state (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS sync_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started_at TEXT NOT NULL,
+        document TEXT NOT NULL
+    )""",
+)
+
+# (name, table, columns) of the indexes backing the list queries; as in the
+# MongoDB spec, they hold every header field.
+INDEXES = (
+    ('books_updated', 'books', ('updated', 'identifier', 'set_spec', 'deleted')),
+    ('books_set', 'books', ('set_spec', 'updated', 'identifier', 'deleted')),
+)
+
+SET_FIELDS = ('name', 'total_records', 'deleted_records',
+              'earliest_datestamp', 'latest_datestamp')
+
+
+def _dumps(value):
+    return json_util.dumps(value, sort_keys=True)
+
+
+def _loads(value):
+    return json_util.loads(value)
+
+
+def _project(document, fields):
+    if fields is None:
+        return document
+    return dict((field, document[field]) for field in fields if field in document)
+
+
+class SQLiteStorage(Storage):
+    """
+    Embedded storage backed by a SQLite database file.
+
+    Each thread gets its own connection, so ``:memory:`` databases are only
+    visible to the thread that created them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            self._create_schema(conn)
+        return conn
+
+    def _create_schema(self, conn):
+        with conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def _where(self, filters):
+        clauses, params = [], []
+        filters = filters or {}
+
+        if filters.get('set'):
+            clauses.append('set_spec = ?')
+            params.append(filters['set'])
+
+        if filters.get('from'):
+            clauses.append('updated >= ?')
+            params.append(filters['from'])
+
+        if filters.get('until'):
+            clauses.append('updated <= ?')
+            params.append(filters['until'])
+
+        return clauses, params
+
+    def _get_state(self, key):
+        row = self.conn.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return _loads(row['value']) if row else None
+
+    def _set_state(self, key, value):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                              (key, _dumps(value)))
+
+    # Books
+
+    def find_book(self, identifier, fields=None):
+        row = self.conn.execute('SELECT document FROM books WHERE identifier = ?',
+                                (identifier,)).fetchone()
+        return _project(_loads(row['document']), fields) if row else None
+
+    def find_books(self, filters, after=None, limit=None, fields=None):
+        clauses, params = self._where(filters)
+
+        if after is not None:
+            updated, identifier = after
+            clauses.append('(updated > ? OR (updated = ? AND identifier > ?))')
+            params.extend([updated, updated, identifier])
+
+        sql = 'SELECT document FROM books'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY updated, identifier'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        rows = self.conn.execute(sql, params)
+        return [_project(_loads(row['document']), fields) for row in rows]
+
+    def count_books(self, filters=None):
+        clauses, params = self._where(filters)
+        sql = 'SELECT COUNT(*) FROM books'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        return self.conn.execute(sql, params).fetchone()[0]
+
+    def iter_identifiers(self):
+        for row in self.conn.execute('SELECT identifier FROM books'):
+            yield row['identifier']
+
+    def _save_book(self, document, verb='INSERT OR REPLACE'):
+        self.conn.execute(
+            verb + ' INTO books '
+            '(identifier, updated, set_spec, publisher, deleted, document) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (document['identifier'], document.get('updated'), document.get('set'),
+             document.get('publisher'), 1 if document.get('deleted') else 0,
+             _dumps(document)))
+
+    def _upsert_book(self, book):
+        # same semantics as a MongoDB $set: stored fields not in book are kept
+        document = self.find_book(book['identifier']) or {}
+        document.update(book)
+        self._save_book(document)
+
+    def _mark_as_deleted(self, identifier, datestamp):
+        document = self.find_book(identifier)
+        if document is not None:
+            document.update({'deleted': True, 'datestamp': datestamp})
+            self._save_book(document)
+
+    def _bump_books_version(self):
+        # called in the transaction of the write, so readers see both at once
+        self.conn.execute("INSERT OR IGNORE INTO state (key, value) VALUES ('books_version', '0')")
+        self.conn.execute("UPDATE state SET value = CAST(value AS INTEGER) + 1 "
+                          "WHERE key = 'books_version'")
+
+    def upsert_book(self, book):
+        with self.conn:
+            self._upsert_book(book)
+            self._bump_books_version()
+
+    def mark_as_deleted(self, identifier, datestamp):
+        with self.conn:
+            self._mark_as_deleted(identifier, datestamp)
+
+    def insert_books(self, books, write_concern=None):
+        # like the unique index of MongoDB, duplicates fail the insert
+        with self.conn:
+            for book in books:
+                self._save_book(book, 'INSERT')
+            self._bump_books_version()
+
+    def replace_books(self, books, write_concern=None):
+        with self.conn:
+            for book in books:
+                self._save_book(book)
+            self._bump_books_version()
+
+    def get_content_hashes(self, identifiers):
+        identifiers = list(identifiers)
+        if not identifiers:
+            return {}
+
+        rows = self.conn.execute(
+            'SELECT document FROM books WHERE deleted = 0 AND identifier IN (%s)'
+            % ', '.join('?' * len(identifiers)), identifiers)
+
+        hashes = {}
+        for row in rows:
+            document = _loads(row['document'])
+            if document.get('content_hash'):
+                hashes[document['identifier']] = document['content_hash']
+        return hashes
+
+    def get_revisions(self, identifiers):
+        identifiers = list(identifiers)
+        if not identifiers:
+            return {}
+
+        rows = self.conn.execute(
+            'SELECT document FROM books WHERE deleted = 0 AND identifier IN (%s)'
+            % ', '.join('?' * len(identifiers)), identifiers)
+
+        revisions = {}
+        for row in rows:
+            document = _loads(row['document'])
+            if document.get('revision'):
+                revisions[document['identifier']] = document['revision']
+        return revisions
+
+    def set_revisions(self, revisions, write_concern=None):
+        with self.conn:
+            for identifier, revision in revisions.items():
+                document = self.find_book(identifier)
+                if document is not None:
+                    document['revision'] = revision
+                    self._save_book(document)
+
+    def write_books(self, books, deleted, datestamp, write_concern=None):
+        # a single transaction, so a single commit (and fsync) per batch
+        with self.conn:
+            for book in books:
+                self._upsert_book(book)
+            for identifier in deleted:
+                self._mark_as_deleted(identifier, datestamp)
+            self._bump_books_version()
+
+    # Sets
+
+    def find_sets(self, after=None, limit=None, fields=None):
+        columns = ['set_spec'] + [f for f in (fields or SET_FIELDS) if f in SET_FIELDS]
+        sql = 'SELECT %s FROM sets' % ', '.join(columns)
+        params = []
+
+        if after is not None:
+            sql += ' WHERE set_spec > ?'
+            params.append(after)
+        sql += ' ORDER BY set_spec'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        sets = []
+        for row in self.conn.execute(sql, params):
+            _set = dict((column, row[column]) for column in columns[1:])
+            _set['set'] = row['set_spec']
+            sets.append(_set)
+        return sets
+
+    def count_sets(self):
+        return self.conn.execute('SELECT COUNT(*) FROM sets').fetchone()[0]
+
+    def refresh_sets(self):
+        with self.conn:
+            self.conn.execute('DELETE FROM sets')
+            self.conn.execute(
+                'INSERT INTO sets (set_spec, name, total_records, deleted_records, '
+                'earliest_datestamp, latest_datestamp) '
+                'SELECT set_spec, '
+                '(SELECT publisher FROM books AS latest WHERE latest.set_spec = books.set_spec '
+                ' ORDER BY updated DESC LIMIT 1), '
+                'COUNT(*), SUM(deleted), MIN(updated), MAX(updated) '
+                'FROM books WHERE set_spec IS NOT NULL AND set_spec != \'\' '
+                'GROUP BY set_spec')
+
+        return [row['set_spec'] for row in self.conn.execute('SELECT set_spec FROM sets')]
+
+
+    def ensure_sets(self):
+        try:
+            if self.count_sets():
+                return False
+            self.refresh_sets()
+        except sqlite3.Error as e:
+            raise StorageError('SQLite: %s' % e)
+
+        return True
+    def backfill_sets(self):
+        try:
+            rows = self.conn.execute('SELECT document FROM books WHERE set_spec IS NULL '
+                                     'AND publisher IS NOT NULL').fetchall()
+            with self.conn:
+                for row in rows:
+                    document = _loads(row['document'])
+                    document['set'] = slugfy(document['publisher'])
+                    self._save_book(document)
+
+            if rows:
+                self.refresh_sets()
+        except sqlite3.Error as e:
+            raise StorageError('SQLite: %s' % e)
+
+        return len(rows)
+
+    # Repository
+
+    def _repository_stats(self):
+        row = self.conn.execute(
+            'SELECT MIN(updated), MAX(updated), COUNT(*), SUM(deleted) FROM books').fetchone()
+        return {
+            'earliest_datestamp': row[0],
+            'latest_datestamp': row[1],
+            'total_records': row[2],
+            'deleted_records': row[3] or 0,
+        }
+
+    def get_repository_stats(self):
+        stats = self._get_state('repository_stats')
+        if stats is None:
+            stats = self._repository_stats()
+            stats['last_seq'] = 0
+
+        return stats
+
+    def refresh_repository_stats(self, last_seq):
+        stats = self._repository_stats()
+        stats['last_seq'] = last_seq
+        stats['updated_at'] = datetime.now()
+
+        self._set_state('repository_stats', stats)
+        return stats
+
+    def get_sync_seq(self):
+        stats = self._get_state('repository_stats')
+        return stats.get('last_seq') if stats else None
+
+    # Sync state
+
+    def get_last_update(self):
+        return self._get_state('updates')
+
+    def set_last_seq(self, seq):
+        self._set_state('updates', {'last_seq': seq, 'updated_at': datetime.now()})
+
+    def get_books_version(self):
+        return self._get_state('books_version') or 0
+
+    def add_sync_run(self, run, keep=None):
+        with self.conn:
+            self.conn.execute('INSERT INTO sync_runs (started_at, document) VALUES (?, ?)',
+                              (run['started_at'].isoformat(), _dumps(run)))
+            if keep:
+                self.conn.execute(
+                    'DELETE FROM sync_runs WHERE id NOT IN ('
+                    'SELECT id FROM sync_runs ORDER BY started_at DESC, id DESC LIMIT ?)',
+                    (keep,))
+
+    def find_sync_runs(self, limit=10):
+        rows = self.conn.execute(
+            'SELECT document FROM sync_runs ORDER BY started_at DESC, id DESC LIMIT ?',
+            (limit,))
+        return [_loads(row['document']) for row in rows]
+
+    # Leases
+
+    def acquire_lease(self, name, owner, ttl):
+        now = time.time()
+        with self.conn:
+            cursor = self.conn.execute(
+                'UPDATE leases SET owner = ?, expires_at = ? '
+                'WHERE name = ? AND (owner = ? OR expires_at < ?)',
+                (owner, now + ttl, name, owner, now))
+            if cursor.rowcount == 0:
+                cursor = self.conn.execute(
+                    'INSERT OR IGNORE INTO leases (name, owner, expires_at) '
+                    'VALUES (?, ?, ?)', (name, owner, now + ttl))
+
+        return cursor.rowcount == 1
+
+    def renew_lease(self, name, owner, ttl):
+        with self.conn:
+            cursor = self.conn.execute(
+                'UPDATE leases SET expires_at = ? WHERE name = ? AND owner = ?',
+                (time.time() + ttl, name, owner))
+        return cursor.rowcount == 1
+
+    def release_lease(self, name, owner):
+        with self.conn:
+            self.conn.execute('DELETE FROM leases WHERE name = ? AND owner = ?',
+                              (name, owner))
+
+    # Maintenance
+
+    def _index_report(self):
+        rows = self.conn.execute("SELECT name, tbl_name FROM sqlite_master "
+                                 "WHERE type = 'index' AND sql IS NOT NULL")
+        current = set((row['tbl_name'], row['name']) for row in rows)
+        declared = set((table, name) for name, table, columns in INDEXES)
+
+        return {
+            'missing': sorted(declared - current),
+            'existing': sorted(declared & current),
+            'mismatched': [],
+            'redundant': sorted(current - declared),
+        }
+
+    def check_indexes(self):
+        return self._index_report()
+
+    def ensure_indexes(self):
+        try:
+            report = self._index_report()
+            report['created'] = report['missing']
+
+            with self.conn:
+                for name, table, columns in INDEXES:
+                    self.conn.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)'
+                                      % (name, table, ', '.join(columns)))
+        except sqlite3.Error as e:
+            raise StorageError('SQLite: %s' % e)
+
+        return report
@@ -1,19 +1,41 @@
+import json
+import time
+import hashlib
 import logging
 import requests
+import itertools
 
 from datetime import datetime
-from multiprocessing import Process
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from requests.exceptions import HTTPError, ConnectionError
+from simpleslug import slugfy
 
-from .utils import get_db_connection
+from .lease import Lease
+from .telemetry import SyncRun
+from .oaipmh import RECORD_FIELDS
+from .apiclient import get_api_client, is_retriable
+from .storage import get_storage
 
 
 logging.basicConfig()
 logger = logging.getLogger('Sync')
 
+# name of the lease held while syncing
+SYNC_LEASE = 'sync'
+
+# adapted fields rendered over OAI-PMH whose changes must reach harvesters;
+# `updated` is left out, so new API revisions that don't change them don't
+# bump the OAI datestamp
+CONTENT_FIELDS = tuple(f for f in RECORD_FIELDS if f not in ('updated', 'deleted'))
+
+# returned by `fetch_update` in place of the data of revisions already stored
+NOT_MODIFIED = object()
+
 FIELD_MAP = (
     ('publisher', 'publisher'),
     ('_id', 'identifier'),
+    ('_rev', 'revision'),
     ('language', 'language'),
     ('synopsis', 'description'),
     ('year', 'date'),
@@ -31,7 +53,8 @@ def adapt_data(data):
 
     It uses 'FIELD_MAP' (from/to tuples) to ignore don't needed fields and
     adapt keys. If the 'to' element of 'FIELD_MAP' was a tuple, it uses the
-    second value as a default value.
+    second value as a default value. The OAI setSpec slug of the publisher is
+    stored as 'set', so sets are matched and rendered without slugifying.
 
     :param data: Data from books API.
     :type data: dict.
@@ -48,90 +71,406 @@ def adapt_data(data):
                     adapted[to] = data[_from][0:10]
                 else:
                     adapted[to] = data[_from]
+
+    if 'publisher' in adapted:
+        adapted['set'] = slugfy(adapted['publisher'])
+
     return adapted
 
 
-def mark_as_deleted(update, db):
-    _id = update['id']
-    db.books.update({
-        'identifier': _id
-    }, {
-        '$set': {
-            'deleted': True,
-            'datestamp': datetime.now()
-        }
-    })
-    logger.info('Mark book as deleted. ID: %s' % update['id'])
+def content_hash(adapted):
+    """Stable hash of the `CONTENT_FIELDS` of an adapted book."""
+    content = dict((field, adapted.get(field)) for field in CONTENT_FIELDS)
+    return hashlib.sha1(json.dumps(content, sort_keys=True)).hexdigest()
+
+
+def persists_batch(books, deleted, storage, write_concern=None):
+    storage.write_books(books, deleted, datetime.now(), write_concern)
+    logger.info('Saved %s books, marked %s as deleted' % (len(books), len(deleted)))
+
+
+def parse_write_concern(value):
+    """Write concern of a `w` value such as ``1`` or ``majority``."""
+    if value is None or value == '':
+        return None
+
+    value = str(value)
+    return {'w': int(value) if value.isdigit() else value}
+
+
+class BatchWriter(object):
+    """
+    Collects the writes of a sync and sends them to the storage every
+    ``size`` changes, checkpointing `last_seq` once per batch.
+
+    A batch is flushed early when an identifier shows up twice, since the
+    writes of a batch may be applied in any order. Books whose `content_hash`
+    matches the stored one are not written, and are counted as `unchanged`
+    in ``stats``; only their `revision` is stored when it changed. The
+    duration of each write goes to the ``latency`` histogram.
+    """
+
+    def __init__(self, storage, size=500, write_concern=None, stats=None, latency=None):
+        self.storage = storage
+        self.size = max(size, 1)
+        self.write_concern = write_concern
+        self.latency = latency
+        self.stats = stats if stats is not None else {}
+        self.stats.setdefault('unchanged', 0)
+        self._reset()
+
+    def _reset(self):
+        self.books = []
+        self.deleted = []
+        self.identifiers = set()
+        self.seq = None
+        self.pending_since = None
+
+    @property
+    def age(self):
+        """Seconds the oldest pending change has been waiting, or None."""
+        if self.pending_since is None:
+            return None
+        return time.time() - self.pending_since
+
+    def _add(self, identifier, seq):
+        if identifier in self.identifiers:
+            self.flush()
+
+        self.identifiers.add(identifier)
+        self.seq = seq
+        if self.pending_since is None:
+            self.pending_since = time.time()
+
+    def add_book(self, book, seq):
+        self._add(book['identifier'], seq)
+        self.books.append(book)
+        if len(self.identifiers) >= self.size:
+            self.flush()
+
+    def add_deletion(self, identifier, seq):
+        self._add(identifier, seq)
+        self.deleted.append(identifier)
+        if len(self.identifiers) >= self.size:
+            self.flush()
+
+    def add_unmodified(self, seq):
+        """Checkpoint the ``seq`` of a change that needs no write."""
+        self.seq = seq
+        if self.pending_since is None:
+            self.pending_since = time.time()
 
+    def _changed_books(self):
+        if not self.books:
+            return []
 
-def persists_data(data, db):
-    db.books.update({
-        'identifier': data['identifier']
-    }, {
-        '$set': data
-    }, upsert=True)
-    logger.info('Saved book. ID: %s' % data['identifier'])
+        stored = self.storage.get_content_hashes(book['identifier'] for book in self.books)
+        changed, revisions = [], {}
+        for book in self.books:
+            if book.get('content_hash') is None or \
+                    stored.get(book['identifier']) != book['content_hash']:
+                changed.append(book)
+            elif book.get('revision'):
+                revisions[book['identifier']] = book['revision']
 
+        if revisions:
+            # so the next replays of these changes skip the fetch
+            self.storage.set_revisions(revisions, self.write_concern)
+
+        self.stats['unchanged'] += len(self.books) - len(changed)
+        return changed
+
+    def flush(self):
+        if self.identifiers:
+            books = self._changed_books()
+            if books or self.deleted:
+                started = time.time()
+                persists_batch(books, self.deleted, self.storage, self.write_concern)
+                if self.latency is not None:
+                    self.latency.time(started)
+
+        if self.seq is not None:
+            update_last_seq(self.storage, self.seq)
+
+        self._reset()
+
+
+def get_data_from_api(uri, revision=None, client=None):
+    if client is not None:
+        return client.get_json(uri, revision)
 
-def get_data_from_api(uri, revision=None):
     req = requests.get(uri, params=revision)
     req.raise_for_status()
     data = req.json()
     return data
 
 
-def get_updates(api_uri, db):
-    update = db.updates.find_one()
-    last_change = update['last_seq'] if update else 0
+def get_updates(api_uri, storage, since=None, client=None, limit=None, longpoll=None):
+    """
+    :param longpoll: Milliseconds the API may hold the request waiting for
+                     changes after ``since``, instead of answering at once.
+    """
+    if since is None:
+        update = storage.get_last_update()
+        since = update['last_seq'] if update else 0
 
-    changes_uri = '%s/changes/?since=%s' % (api_uri, last_change)
-    data = get_data_from_api(changes_uri)
+    changes_uri = '%s/changes/?since=%s' % (api_uri, since)
+    if limit:
+        changes_uri += '&limit=%s' % limit
+    if longpoll:
+        changes_uri += '&feed=longpoll&timeout=%s' % longpoll
+    data = get_data_from_api(changes_uri, client=client)
 
     return data['results']
 
 
-def update_last_seq(db, seq):
-    db.updates.update({
-        '_id': 1
-    }, {
-        '$set': {
-            'last_seq': seq,
-            'updated_at': datetime.now()
-        }
-    }, upsert=True)
+def get_feed_head(api_uri, client=None):
+    """
+    Return the seq of the latest change of the feed, or None if it can't be
+    read. It only feeds the sync telemetry, so failing to read it doesn't
+    fail the run.
+    """
+    try:
+        data = get_data_from_api('%s/changes/?descending=true&limit=1' % api_uri,
+                                 client=client)
+        return data['results'][0]['seq'] if data['results'] else data.get('last_seq')
+    except Exception as e:
+        logger.warning('Could not read the head of the changes feed: %s' % e)
+        return None
+
+
+def iter_update_pages(api_uri, storage, since=None, client=None, limit=None,
+                      latency=None):
+    """
+    Read the changes feed in pages of at most ``limit`` changes, resuming
+    each page after the seq of the last change of the previous one, so a
+    big backlog is never held in memory at once.
+
+    :param latency: Histogram that receives the duration of each request.
+    """
+    while True:
+        started = time.time()
+        updates = get_updates(api_uri, storage, since, client, limit)
+        if latency is not None:
+            latency.time(started)
+
+        if updates:
+            yield updates
+
+        if not limit or len(updates) < limit:
+            return
+
+        since = updates[-1]['seq']
+
+
+def coalesce_updates(updates):
+    """
+    Keep only the last change of each book, so a book listed many times in
+    the changes feed (e.g. updated and then deleted) is fetched and written
+    once, in its final state.
+
+    The last change of the feed is always kept, so checkpointing the seq of
+    the kept changes still reaches the end of the feed.
+
+    :returns: (updates, skipped) tuple, with the kept changes in the feed
+              order and the number of changes dropped.
+    """
+    last = dict((update['id'], index) for index, update in enumerate(updates))
+    coalesced = [update for index, update in enumerate(updates)
+                 if last[update['id']] == index]
+
+    return coalesced, len(updates) - len(coalesced)
+
 
+def fetch_update(api_uri, update, client=None, latency=None, revisions=None):
+    """
+    Fetch the book revision of a change, unless it is already stored.
+
+    :param latency: Histogram that receives the duration of the request.
+    :param revisions: Dict of the stored revision of the books, as returned
+                      by ``Storage.get_revisions``.
+    :returns: (update, data, error) tuple; `data` is `NOT_MODIFIED` for
+              revisions already stored, and None for deletions and for
+              revisions the API refused, in which case `error` holds the
+              HTTPError.
+    :raises HTTPError: if the API failed with a 5xx after every retry, so
+                       the run stops before checkpointing past the change.
+    """
+    if update.get('deleted'):
+        return update, None, None
 
-def update_from_api(settings):
+    revision = update['changes'][-1]
+    if revisions and revision.get('rev') is not None and \
+            revisions.get(update['id']) == revision['rev']:
+        return update, NOT_MODIFIED, None
+
+    uri = '%s/book/%s/' % (api_uri, update['id'])
+
+    started = time.time()
     try:
-        db = get_db_connection(settings)
-        api_uri = settings.get('scielo_uri')
-        updates = get_updates(api_uri, db)
+        return update, get_data_from_api(uri, revision, client), None
+    except HTTPError as e:
+        if is_retriable(e):
+            raise
+        return update, None, e
+    finally:
+        if latency is not None:
+            latency.time(started)
 
-        for update in updates:
-            if update.get('deleted'):
-                mark_as_deleted(update, db)
-            else:
-                revision = update['changes'][-1]
-                uri = '%s/book/%s/' % (api_uri, update['id'])
 
-                try:
-                    data = get_data_from_api(uri, revision)
-                except HTTPError as e:
-                    logger.error('[ID %s] %s' % (update['id'], e.message))
-                    continue
+def update_last_seq(storage, seq):
+    storage.set_last_seq(seq)
+
+
+def apply_updates(page, storage, writer, imap, fetch, lease, stats, dry_run=False):
+    """
+    Fetch the revisions of a page of changes and hand them to ``writer`` in
+    the feed order.
+
+    :param imap: ``imap`` of the pool that fetches the revisions.
+    :param fetch: ``fetch_update`` with the api_uri, client and latency bound.
+    """
+    updates, duplicates = coalesce_updates(page)
+    stats['duplicates'] += duplicates
+
+    revisions = storage.get_revisions(
+        update['id'] for update in updates if not update.get('deleted'))
+
+    # revisions are fetched ahead by the pool, but imap yields them in the
+    # changes order, so last_seq is only checkpointed after every previous
+    # change was persisted
+    for update, data, error in imap(partial(fetch, revisions=revisions), updates):
+        # never write after another worker took over the sync
+        lease.check()
+        stats['changes'] += 1
+
+        if update.get('deleted'):
+            if not dry_run:
+                writer.add_deletion(update['id'], update.get('seq'))
+            stats['deleted'] += 1
+        elif data is NOT_MODIFIED:
+            if not dry_run:
+                writer.add_unmodified(update['seq'])
+            stats['not_modified'] += 1
+        elif error is not None:
+            logger.error('[ID %s] %s' % (update['id'], error.message))
+            stats['errors'] += 1
+        else:
+            adapted = adapt_data(data)
+            if 'revision' not in adapted and update['changes'][-1].get('rev'):
+                adapted['revision'] = update['changes'][-1]['rev']
+            adapted['content_hash'] = content_hash(adapted)
+            if not dry_run:
+                writer.add_book(adapted, update['seq'])
+            stats['books'] += 1
+
+
+def refresh_repository(storage):
+    """Refresh the repository stats and the sets after a sync."""
+    last_update = storage.get_last_update()
+    storage.refresh_repository_stats(last_update['last_seq'] if last_update else 0)
+    storage.refresh_sets()
+
+
+def new_stats():
+    return dict(changes=0, books=0, deleted=0, errors=0, duplicates=0, unchanged=0,
+                not_modified=0)
+
+
+def record_sync_run(storage, run, result, keep=None):
+    """
+    Store the telemetry of a finished run in `sync_runs`. Failures are only
+    logged, so they never change the outcome of the sync.
+    """
+    try:
+        last_update = storage.get_last_update()
+        last_seq = last_update['last_seq'] if last_update else None
+        storage.add_sync_run(run.as_dict(result, last_seq), keep)
+    except Exception as e:
+        logger.exception('Could not record the sync run: %s' % e)
+
+
+def update_from_api(settings, since=None, dry_run=False, stats=None):
+    """
+    Apply the books API changes since the last sync.
+
+    Only the worker holding the `sync` lease runs it; the others return
+    right away. Dry runs fetch and adapt the changes without the lease and
+    without writing anything.
+
+    :param since: Sync the changes after this seq instead of the stored one.
+    :param dry_run: Don't write to the storage.
+    :param stats: Dict that receives the `changes`, `books`, `deleted`,
+                  `errors`, `duplicates`, `unchanged` and `not_modified`
+                  counters of the run.
+    :returns: True if the sync ran, False if it failed and None if it was
+              skipped because another worker holds the lease.
+
+    Changes to revisions already stored are not fetched, so replaying the
+    feed after resetting `last_seq` costs one lookup per page.
+
+    Runs that are not dry runs record their telemetry in `sync_runs`,
+    keeping the last `sync_runs_keep` of them.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(new_stats())
+    run = SyncRun(stats, since, dry_run)
+    storage = None
+
+    try:
+        storage = get_storage(settings)
+        lease = Lease(storage, SYNC_LEASE, settings.get('sync_lease_ttl', 300))
+        if not dry_run and not lease.acquire():
+            logger.info('Sync skipped, another worker holds the lease')
+            return None
+
+        try:
+            api_uri = settings.get('scielo_uri')
+            client = get_api_client(settings)
+            pages = iter_update_pages(api_uri, storage, since, client,
+                                      settings.get('sync_page_size', 1000),
+                                      run.http_latency)
+
+            concurrency = settings.get('sync_concurrency', 4)
+            pool = ThreadPool(concurrency) if concurrency > 1 else None
+            imap = pool.imap if pool else itertools.imap
+            fetch = partial(fetch_update, api_uri, client=client, latency=run.http_latency)
+            writer = BatchWriter(storage, settings.get('sync_batch_size', 500),
+                                 parse_write_concern(settings.get('sync_write_concern')),
+                                 stats, run.batch_latency)
+
+            try:
+                for page in pages:
+                    apply_updates(page, storage, writer, imap, fetch, lease, stats, dry_run)
+
+                lease.check()
+                writer.flush()
+                run.api_seq = get_feed_head(api_uri, client)
+            finally:
+                if pool:
+                    pool.terminate()
+                    pool.join()
+
+            if not dry_run:
+                refresh_repository(storage)
+        finally:
+            if not dry_run:
+                lease.release()
 
-                adapted = adapt_data(data)
-                persists_data(adapted, db)
-                update_last_seq(db, update['seq'])
+        succeeded = True
 
     except (HTTPError, ConnectionError) as e:
         logger.exception('%s: %s' % (e.__class__.__name__, e.message))
+        run.error = '%s: %s' % (e.__class__.__name__, e)
+        succeeded = False
 
     except Exception as e:
         logger.exception('%s' % e.message)
+        run.error = '%s: %s' % (e.__class__.__name__, e)
+        succeeded = False
 
+    if storage is not None and not dry_run:
+        record_sync_run(storage, run, 'ok' if succeeded else 'failed',
+                        settings.get('sync_runs_keep', 100))
 
-def do_sync(settings):
-    process = Process(target=update_from_api, args=[settings])
-    process.daemon = True
-    process.start()
+    return succeeded
@@ -0,0 +1,121 @@
+import time
+import threading
+
+from datetime import datetime
+
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram(object):
+    """
+    Latency histogram with fixed buckets, safe to share between threads.
+    Values above the last bound go to an overflow bucket.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = len(self.bounds)
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                index = i
+                break
+
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def time(self, started):
+        """Observe the seconds elapsed since the ``started`` timestamp."""
+        self.observe(time.time() - started)
+
+    def as_dict(self):
+        """
+        Summary of the histogram. Each bucket counts the values up to its
+        `le` bound; the last one, with `le` None, counts the values above
+        every bound.
+        """
+        with self._lock:
+            bounds = self.bounds + (None,)
+            return {
+                'count': self.count,
+                'total': round(self.total, 6),
+                'mean': round(self.total / self.count, 6) if self.count else None,
+                'max': round(self.max, 6),
+                'buckets': [{'le': bound, 'count': count}
+                            for bound, count in zip(bounds, self.counts)],
+            }
+
+
+def seq_lag(head, seq):
+    """
+    Number of changes between the ``head`` of the changes feed and ``seq``,
+    or None if either is unknown or not numeric.
+    """
+    try:
+        return max(int(head) - int(seq or 0), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class SyncRun(object):
+    """
+    Telemetry of a sync run: the counters of ``stats`` plus the latency of
+    the books API requests and of the storage writes. The long polls of the
+    changes feed, which wait for changes to arrive, go to `poll_latency`
+    instead of `http_latency`.
+    """
+
+    def __init__(self, stats, since=None, dry_run=False):
+        self.stats = stats
+        self.since = since
+        self.dry_run = dry_run
+        self.started_at = datetime.now()
+        self.http_latency = Histogram()
+        self.poll_latency = Histogram()
+        self.batch_latency = Histogram()
+        # seq of the latest change of the feed, read at the end of the run
+        self.api_seq = None
+        self.error = None
+
+    def lag(self, last_seq):
+        return seq_lag(self.api_seq, last_seq) if self.api_seq is not None else None
+
+    def as_dict(self, result, last_seq=None):
+        """
+        Document of the finished run, as stored in `sync_runs`.
+
+        :param result: `ok` or `failed`.
+        :param last_seq: `last_seq` stored at the end of the run.
+        """
+        finished_at = datetime.now()
+        run = {
+            'started_at': self.started_at,
+            'finished_at': finished_at,
+            'duration': (finished_at - self.started_at).total_seconds(),
+            'result': result,
+            'error': self.error,
+            'dry_run': self.dry_run,
+            'since': self.since,
+            'last_seq': last_seq,
+            'api_seq': self.api_seq,
+            'lag': self.lag(last_seq),
+            'http_latency': self.http_latency.as_dict(),
+            'poll_latency': self.poll_latency.as_dict(),
+            'batch_latency': self.batch_latency.as_dict(),
+        }
+        run.update(self.stats)
+        if not self.dry_run:
+            run['written'] = self.stats.get('books', 0) - self.stats.get('unchanged', 0)
+
+        return run
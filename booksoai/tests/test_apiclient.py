@@ -0,0 +1,107 @@
+import unittest
+
+from mock import patch, Mock
+from requests.exceptions import HTTPError, ConnectionError
+
+from booksoai import apiclient
+from booksoai.apiclient import BooksAPIClient, CircuitBreaker, CircuitOpenError
+
+
+def response(status_code=200, data=None):
+    resp = Mock(status_code=status_code)
+    resp.json.return_value = data
+    if status_code >= 400:
+        resp.raise_for_status.side_effect = HTTPError('%s Error' % status_code, response=resp)
+    return resp
+
+
+@patch('booksoai.apiclient.time.sleep')
+class BooksAPIClientTests(unittest.TestCase):
+
+    def setUp(self):
+        self.client = BooksAPIClient(retries=2, backoff=1)
+        self.client.session = Mock()
+
+    def test_get_json(self, mock_sleep):
+        self.client.session.get.return_value = response(data={'_id': '1t'})
+
+        self.assertEqual(self.client.get_json('http://api/book/1t/', {'rev': '1'}), {'_id': '1t'})
+        self.client.session.get.assert_called_once_with(
+            'http://api/book/1t/', params={'rev': '1'}, timeout=self.client.timeout)
+
+    def test_retries_server_errors(self, mock_sleep):
+        self.client.session.get.side_effect = [response(503), response(data={})]
+
+        self.assertEqual(self.client.get_json('http://api/book/1t/'), {})
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    def test_retries_connection_errors_until_exhausted(self, mock_sleep):
+        self.client.session.get.side_effect = ConnectionError('refused')
+
+        self.assertRaises(ConnectionError, self.client.get_json, 'http://api/book/1t/')
+        self.assertEqual(self.client.session.get.call_count, 3)
+        self.assertEqual(self.client.breaker.failures, 1)
+
+    def test_client_errors_are_not_retried(self, mock_sleep):
+        self.client.session.get.return_value = response(404)
+
+        self.assertRaises(HTTPError, self.client.get_json, 'http://api/book/1t/')
+        self.assertEqual(self.client.session.get.call_count, 1)
+        self.assertEqual(self.client.breaker.failures, 0)
+
+    @patch('booksoai.apiclient.random.uniform')
+    def test_backoff_is_exponential_with_jitter(self, mock_uniform, mock_sleep):
+        mock_uniform.side_effect = lambda low, high: high
+
+        self.assertEqual([self.client._delay(n) for n in range(3)], [1, 2, 4])
+        self.assertEqual(self.client._delay(10), apiclient.MAX_BACKOFF)
+
+    def test_open_circuit_rejects_requests(self, mock_sleep):
+        self.client.breaker = CircuitBreaker(threshold=1)
+        self.client.session.get.side_effect = ConnectionError('refused')
+
+        self.assertRaises(ConnectionError, self.client.get_json, 'http://api/book/1t/')
+        self.assertRaises(CircuitOpenError, self.client.get_json, 'http://api/book/2t/')
+        self.assertEqual(self.client.session.get.call_count, 3)
+
+
+class CircuitBreakerTests(unittest.TestCase):
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(threshold=2)
+
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+
+    @patch('booksoai.apiclient.time.time')
+    def test_lets_requests_through_after_reset_timeout(self, mock_time):
+        mock_time.return_value = 1000
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        breaker.failure()
+        breaker.failure()
+
+        mock_time.return_value = 1060
+        self.assertTrue(breaker.allow())
+
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+
+
+class GetAPIClientTests(unittest.TestCase):
+
+    def tearDown(self):
+        apiclient._clients.clear()
+
+    def test_client_is_shared_in_process(self):
+        self.assertIs(apiclient.get_api_client({}), apiclient.get_api_client({}))
+
+    def test_client_uses_settings(self):
+        client = apiclient.get_api_client({'api_retries': 7, 'api_circuit_threshold': 2})
+
+        self.assertEqual(client.retries, 7)
+        self.assertEqual(client.breaker.threshold, 2)
@@ -0,0 +1,49 @@
+import unittest
+
+from mock import Mock
+
+from booksoai.counts import CountCache, query_signature
+
+
+class CountCacheTests(unittest.TestCase):
+
+    def test_get_computes_count_on_miss(self):
+        cache = CountCache()
+        compute = Mock(return_value=10)
+
+        self.assertEqual(cache.get(query_signature({'set': 'edufba'}), 1, compute), 10)
+        self.assertEqual(compute.call_count, 1)
+
+    def test_get_returns_cached_count_for_same_signature_and_seq(self):
+        cache = CountCache()
+        compute = Mock(return_value=10)
+
+        cache.get(query_signature({'set': 'edufba'}), 1, compute)
+        cache.get(query_signature({'set': 'edufba'}), 1, compute)
+
+        self.assertEqual(compute.call_count, 1)
+
+    def test_get_keeps_signatures_apart(self):
+        cache = CountCache()
+
+        cache.get(query_signature({'set': 'edufba'}), 1, lambda: 10)
+        count = cache.get(query_signature({'set': 'edufba', 'from': '2014-01-01'}), 1, lambda: 3)
+
+        self.assertEqual(count, 3)
+
+    def test_get_invalidates_counts_when_seq_changes(self):
+        cache = CountCache()
+        compute = Mock(return_value=10)
+
+        cache.get(query_signature({}), 1, compute)
+        cache.get(query_signature({}), 2, compute)
+
+        self.assertEqual(compute.call_count, 2)
+
+    def test_get_is_bounded_by_maxsize(self):
+        cache = CountCache(maxsize=2)
+
+        for _set in ('a', 'b', 'c'):
+            cache.get(query_signature({'set': _set}), 1, lambda: 1)
+
+        self.assertEqual(len(cache._counts), 1)
@@ -0,0 +1,111 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from mock import patch, Mock
+from requests.exceptions import ConnectionError
+
+from booksoai.follow import follow_changes, poll_timeout, MAX_POLL_TIMEOUT
+from booksoai.storage import get_storage
+from booksoai.sync import SYNC_LEASE, BatchWriter
+
+
+class FollowTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings = {
+            'storage_backend': 'sqlite',
+            'sqlite_path': os.path.join(self.tmpdir, 'books.db'),
+            'scielo_uri': 'http://books.scielo.org/api/v1',
+            'sync_concurrency': 1,
+            'follow_refresh_interval': 0,
+        }
+        self.storage = get_storage(self.settings)
+        self.stopped = threading.Event()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def feed(self, *pages):
+        """Serve ``pages`` to the long polls, then stop following."""
+        pages = list(pages)
+
+        def get_updates(api_uri, storage, since, client, limit, longpoll):
+            if pages:
+                return pages.pop(0)
+            self.stopped.set()
+            return []
+
+        return get_updates
+
+    @patch('booksoai.sync.get_data_from_api')
+    @patch('booksoai.follow.get_updates')
+    def test_follow_applies_changes_as_they_arrive(self, mock_update, mock_api_data):
+        mock_update.side_effect = self.feed(
+            [{'seq': 1, 'id': 'f1', 'changes': [{'rev': '1-a'}]}],
+            [],
+            [{'seq': 2, 'id': 'f2', 'changes': [{'rev': '1-b'}]},
+             {'seq': 3, 'id': 'f1', 'deleted': True}],
+        )
+        mock_api_data.side_effect = lambda uri, revision, client: {
+            '_id': uri.rstrip('/').split('/')[-1], 'publisher': 'EDUFBA'}
+        stats = {}
+
+        self.assertTrue(follow_changes(self.settings, self.stopped, stats))
+
+        self.assertEqual(self.storage.get_last_update()['last_seq'], 3)
+        self.assertTrue(self.storage.find_book('f1')['deleted'])
+        self.assertEqual(self.storage.find_book('f2')['revision'], '1-b')
+        self.assertEqual((stats['changes'], stats['books'], stats['deleted']), (3, 2, 1))
+        # each burst is recorded once the feed is caught up
+        self.assertEqual(len(self.storage.find_sync_runs()), 2)
+        # the long polls are timed apart from the book requests
+        run = self.storage.find_sync_runs(1)[0]
+        self.assertEqual(run['http_latency']['count'], 1)
+        self.assertGreater(run['poll_latency']['count'], 0)
+        self.assertEqual(self.storage.count_sets(), 1)
+        since, longpoll = mock_update.call_args_list[1][0][2], mock_update.call_args_list[1][0][5]
+        self.assertEqual(since, 1)
+        self.assertTrue(longpoll)
+
+    @patch('booksoai.follow.get_updates')
+    def test_follow_skipped_when_lease_is_held(self, mock_update):
+        self.storage.acquire_lease(SYNC_LEASE, 'other-worker', 60)
+
+        self.assertIsNone(follow_changes(self.settings, self.stopped))
+        self.assertFalse(mock_update.called)
+
+    @patch('booksoai.follow.get_updates')
+    def test_follow_failure_is_recorded(self, mock_update):
+        mock_update.side_effect = ConnectionError('refused')
+
+        self.assertFalse(follow_changes(self.settings, self.stopped))
+
+        run = self.storage.find_sync_runs(1)[0]
+        self.assertEqual(run['result'], 'failed')
+        self.assertEqual(run['error'], 'ConnectionError: refused')
+
+    def test_poll_timeout_fits_read_timeout(self):
+        writer = BatchWriter(Mock())
+
+        self.assertEqual(poll_timeout({'follow_timeout': 4000, 'api_read_timeout': 3},
+                                      writer), 2400)
+
+    def test_poll_timeout_is_capped_so_stops_are_seen(self):
+        writer = BatchWriter(Mock())
+
+        self.assertEqual(poll_timeout({'follow_timeout': 60000, 'api_read_timeout': 120},
+                                      writer), MAX_POLL_TIMEOUT)
+
+    def test_poll_timeout_wakes_up_to_flush_pending_changes(self):
+        writer = BatchWriter(Mock())
+        writer.add_unmodified(1)
+        writer.pending_since = time.time() - 0.4
+
+        timeout = poll_timeout({'follow_flush_interval': 1000}, writer)
+
+        self.assertAlmostEqual(timeout, 600, delta=50)
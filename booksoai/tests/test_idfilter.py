@@ -0,0 +1,107 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from booksoai.storage.sqlite import SQLiteStorage
+from booksoai.idfilter import BloomFilter, IdentifierFilter
+from booksoai.importer import import_dump
+
+
+class BloomFilterTests(unittest.TestCase):
+
+    def test_added_keys_are_members(self):
+        bloom = BloomFilter(100)
+        for i in range(100):
+            bloom.add('%st' % i)
+
+        self.assertTrue(all('%st' % i in bloom for i in range(100)))
+
+    def test_false_positive_rate_is_bounded(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add('%st' % i)
+
+        false_positives = sum(1 for i in range(1000, 11000) if '%st' % i in bloom)
+
+        self.assertLess(false_positives, 300)
+
+    def test_unicode_and_bytes_keys_match(self):
+        bloom = BloomFilter(10)
+        bloom.add(u'37t')
+
+        self.assertIn(b'37t', bloom)
+
+
+class IdentifierFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        # a file, so the background rebuild sees the same database
+        self.tmpdir = tempfile.mkdtemp()
+        self.storage = SQLiteStorage(os.path.join(self.tmpdir, 'books.db'))
+        self.storage.upsert_book({'identifier': '1t'})
+        self.storage.upsert_book({'identifier': '2t'})
+        self.storage.set_last_seq(5)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def build(self, id_filter):
+        id_filter.refresh(self.storage).join()
+
+    def test_might_exist_for_stored_identifiers(self):
+        id_filter = IdentifierFilter()
+        self.build(id_filter)
+
+        self.assertTrue(id_filter.might_exist(self.storage, '1t'))
+        self.assertFalse(id_filter.might_exist(self.storage, 'xxx'))
+
+    def test_might_exist_until_the_filter_is_built(self):
+        id_filter = IdentifierFilter()
+
+        with patch.object(id_filter, 'refresh') as mock_refresh:
+            self.assertTrue(id_filter.might_exist(self.storage, 'xxx'))
+
+        mock_refresh.assert_called_once_with(self.storage)
+
+    @patch('booksoai.idfilter.time.time')
+    def test_miss_is_confirmed_after_books_are_written(self, mock_time):
+        mock_time.return_value = 1000
+        id_filter = IdentifierFilter(refresh_interval=60)
+        self.build(id_filter)
+
+        # written without moving the sync checkpoint
+        self.storage.insert_books([{'identifier': '3t'}])
+        self.assertTrue(id_filter.might_exist(self.storage, '3t'))
+        # rebuilds wait for the refresh interval
+        self.assertIsNone(id_filter.refresh(self.storage))
+
+        mock_time.return_value = 1061
+        self.build(id_filter)
+        self.assertTrue(id_filter.might_exist(self.storage, '3t'))
+        self.assertFalse(id_filter.might_exist(self.storage, 'xxx'))
+
+    @patch('booksoai.idfilter.time.time')
+    def test_filter_is_rebuilt_every_refresh_interval(self, mock_time):
+        mock_time.return_value = 1000
+        id_filter = IdentifierFilter(refresh_interval=60)
+        self.build(id_filter)
+
+        with patch.object(id_filter, 'refresh') as mock_refresh:
+            id_filter.might_exist(self.storage, '1t')
+            self.assertFalse(mock_refresh.called)
+
+            mock_time.return_value = 1060
+            id_filter.might_exist(self.storage, '1t')
+            mock_refresh.assert_called_once_with(self.storage)
+
+    def test_import_without_last_seq_is_seen(self):
+        id_filter = IdentifierFilter()
+        self.build(id_filter)
+
+        import_dump([json.dumps({'_id': '9t', 'publisher': 'EDUFBA'})], self.storage, workers=1)
+
+        self.assertTrue(id_filter.might_exist(self.storage, '9t'))
@@ -0,0 +1,129 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from booksoai.importer import DumpReader, import_books, import_dump
+from booksoai.storage import StorageError
+from booksoai.storage.sqlite import SQLiteStorage
+from booksoai.sync import content_hash
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'books.bson')
+
+API_BOOK = {
+    '_id': '1t',
+    'publisher': 'EDUFBA',
+    'title': 'Teste',
+    'updated': '2014-02-03T10:00:00',
+}
+
+
+class DumpReaderTests(unittest.TestCase):
+
+    def test_adapts_api_documents(self):
+        books = list(DumpReader([json.dumps(API_BOOK)]))
+
+        self.assertEqual(len(books), 1)
+        self.assertEqual(books[0]['identifier'], '1t')
+        self.assertEqual(books[0]['updated'], '2014-02-03')
+        self.assertEqual(books[0]['content_hash'], content_hash(books[0]))
+
+    def test_keeps_adapted_documents(self):
+        with open(FIXTURE) as dump:
+            books = list(DumpReader(dump))
+
+        self.assertEqual(len(books), 5)
+        self.assertTrue(all('content_hash' in book for book in books))
+        self.assertTrue(all('_id' not in book for book in books))
+
+    def test_yields_each_identifier_once(self):
+        reader = DumpReader([json.dumps(API_BOOK), json.dumps([API_BOOK, API_BOOK])])
+
+        self.assertEqual(len(list(reader)), 1)
+        self.assertEqual(reader.duplicates.keys(), ['1t'])
+
+    def test_reads_last_seq_and_skips_blank_lines(self):
+        reader = DumpReader([json.dumps(API_BOOK), '', json.dumps({'last_seq': 42})])
+
+        self.assertEqual(len(list(reader)), 1)
+        self.assertEqual(reader.last_seq, 42)
+
+
+class ImportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = SQLiteStorage(':memory:')
+
+    def test_import_books_in_batches(self):
+        books = [{'identifier': '%st' % i} for i in range(7)]
+
+        count = import_books(iter(books), self.storage, batch_size=3, workers=1)
+
+        self.assertEqual(count, 7)
+        self.assertEqual(self.storage.count_books(), 7)
+
+    def test_import_dump_records_last_seq(self):
+        with open(FIXTURE) as dump:
+            lines = list(dump) + [json.dumps({'last_seq': 42})]
+
+        count, last_seq = import_dump(lines, self.storage, workers=1)
+
+        self.assertEqual((count, last_seq), (5, 42))
+        self.assertEqual(self.storage.get_last_update()['last_seq'], 42)
+        self.assertTrue(self.storage.count_sets())
+
+    def test_import_dump_last_seq_overrides_the_dump(self):
+        lines = [json.dumps(API_BOOK), json.dumps({'last_seq': 42})]
+
+        import_dump(lines, self.storage, last_seq=50, workers=1)
+
+        self.assertEqual(self.storage.get_last_update()['last_seq'], 50)
+
+    def test_import_dump_keeps_the_last_copy_of_a_book(self):
+        last = dict(API_BOOK, title='Last')
+        lines = [json.dumps(dict(API_BOOK, synopsis='First')), json.dumps(last)]
+
+        count, last_seq = import_dump(lines, self.storage, workers=1)
+
+        self.assertEqual(count, 1)
+        book = self.storage.find_book('1t')
+        self.assertEqual(book['title'], 'Last')
+        self.assertNotIn('description', book)
+
+    def test_import_dump_fails_when_an_index_is_not_built(self):
+        report = {'missing': [('books', 'identifier_1')], 'created': [], 'mismatched': []}
+
+        with patch.object(self.storage, 'ensure_indexes', return_value=report):
+            self.assertRaises(StorageError, import_dump, [json.dumps(API_BOOK)],
+                              self.storage, 42, workers=1)
+
+        self.assertIsNone(self.storage.get_last_update())
+
+    def test_import_dump_without_last_seq(self):
+        count, last_seq = import_dump([json.dumps(API_BOOK)], self.storage, workers=1)
+
+        self.assertEqual((count, last_seq), (1, None))
+        self.assertEqual(self.storage.get_last_update()['last_seq'], 0)
+
+
+class ParallelImportTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storage = SQLiteStorage(os.path.join(self.tmpdir, 'books.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_import_books_with_many_workers(self):
+        books = [{'identifier': '%st' % i} for i in range(50)]
+
+        count = import_books(iter(books), self.storage, batch_size=4, workers=3)
+
+        self.assertEqual(count, 50)
+        self.assertEqual(sorted(self.storage.iter_identifiers()),
+                         sorted(b['identifier'] for b in books))
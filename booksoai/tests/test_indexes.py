@@ -0,0 +1,57 @@
+import unittest
+
+from pymongo import ASCENDING
+
+from booksoai.utils import get_db_connection
+from booksoai.indexes import INDEXES, check_indexes, ensure_indexes
+
+
+settings = {}
+settings['mongo_uri'] = 'mongodb://localhost:27017/scielobooks-test'
+
+
+class IndexesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = get_db_connection(settings)
+
+    def tearDown(self):
+        self.db.connection.drop_database(self.db.name)
+
+    def test_check_indexes_reports_missing_indexes(self):
+        report = check_indexes(self.db)
+
+        self.assertEqual(len(report['missing']), len(INDEXES))
+        self.assertIn(('books', 'identifier_1'), report['missing'])
+
+    def test_ensure_indexes_builds_declared_indexes(self):
+        report = ensure_indexes(self.db)
+        info = self.db.books.index_information()
+
+        self.assertEqual(len(report['created']), len(INDEXES))
+        self.assertTrue(info['identifier_1']['unique'])
+        self.assertIn('set_1_updated_1_identifier_1_deleted_1', info)
+        self.assertIn('updated_1_identifier_1_set_1_deleted_1', info)
+        self.assertTrue(info['deleted_1']['sparse'])
+
+    def test_ensure_indexes_is_idempotent(self):
+        ensure_indexes(self.db)
+        report = ensure_indexes(self.db)
+
+        self.assertEqual(report['created'], [])
+        self.assertEqual(len(report['existing']), len(INDEXES))
+
+    def test_check_indexes_reports_redundant_indexes(self):
+        self.db.books.create_index([('updated', ASCENDING), ('identifier', ASCENDING)])
+
+        report = check_indexes(self.db)
+
+        self.assertEqual(report['redundant'], [('books', 'updated_1_identifier_1')])
+
+    def test_check_indexes_reports_mismatched_options(self):
+        self.db.books.create_index([('identifier', ASCENDING)])
+
+        report = check_indexes(self.db)
+
+        self.assertIn(('books', 'identifier_1'), report['mismatched'])
+        self.assertNotIn(('books', 'identifier_1'), report['missing'])
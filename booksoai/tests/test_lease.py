@@ -0,0 +1,69 @@
+import unittest
+
+from mock import Mock, patch
+
+from booksoai.lease import Lease, LeaseLostError
+
+
+class LeaseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Mock()
+        self.storage.acquire_lease.return_value = True
+        self.storage.renew_lease.return_value = True
+
+    def test_acquire_lease_held_by_another_owner(self):
+        self.storage.acquire_lease.return_value = False
+        lease = Lease(self.storage, 'sync', 300, owner='a')
+
+        self.assertFalse(lease.acquire())
+        self.storage.acquire_lease.assert_called_once_with('sync', 'a', 300)
+
+    def test_release_stops_heartbeat_and_frees_lease(self):
+        lease = Lease(self.storage, 'sync', 300, owner='a')
+
+        lease.acquire()
+        lease.release()
+
+        self.assertIsNone(lease._heartbeat)
+        self.storage.release_lease.assert_called_once_with('sync', 'a')
+
+    def test_heartbeat_renews_lease(self):
+        lease = Lease(self.storage, 'sync', 0.03, owner='a')
+
+        lease.acquire()
+        lease._stopped.wait(0.1)
+        lease.release()
+
+        self.assertTrue(self.storage.renew_lease.called)
+        self.assertFalse(lease.lost)
+
+    def test_lost_lease_raises_on_check(self):
+        self.storage.renew_lease.return_value = False
+        lease = Lease(self.storage, 'sync', 0.03, owner='a')
+
+        lease.acquire()
+        lease._heartbeat.join(1)
+
+        self.assertTrue(lease.lost)
+        self.assertRaises(LeaseLostError, lease.check)
+
+        lease.release()
+        self.assertFalse(self.storage.release_lease.called)
+
+    @patch('booksoai.lease.time.time')
+    def test_renewal_errors_lose_lease_after_ttl(self, mock_time):
+        self.storage.renew_lease.side_effect = Exception('timeout')
+        mock_time.return_value = 1000
+        lease = Lease(self.storage, 'sync', 0.03, owner='a')
+
+        lease.acquire()
+        mock_time.return_value = 1001
+        lease._heartbeat.join(1)
+
+        self.assertTrue(lease.lost)
+
+    def test_owner_defaults_to_host_and_pid(self):
+        lease = Lease(self.storage, 'sync', 300)
+
+        self.assertEqual(len(lease.owner.split(':')), 3)
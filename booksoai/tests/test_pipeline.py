@@ -1,6 +1,5 @@
 import unittest
 from datetime import datetime
-from pyramid.registry import Registry
 
 from lxml import etree
 from mock import patch
@@ -177,6 +176,19 @@ class TestHeaderPipe(unittest.TestCase):
 
         self.assertEqual(etree.tostring(xml), xml_str)
 
+    def test_header_pipe_use_stored_set_slug(self):
+        data = {
+            'identifier': 'xpto',
+            'updated': '2014-02-12',
+            'publisher': 'Teste OAI-PMH',
+            'set': 'stored-slug'
+        }
+        root = etree.Element('root')
+        pipe = pipeline.HeaderPipe()
+        xml, data = pipe.transform((root, data))
+
+        self.assertIn('<setSpec>stored-slug</setSpec>', etree.tostring(xml))
+
 
 class TestListIdentifiersPipe(unittest.TestCase):
 
@@ -222,7 +234,7 @@ class TestListIdentifiersPipe(unittest.TestCase):
 class TestSetPipe(unittest.TestCase):
 
     def test_set_pipe_add_set_with_two_subelements(self):
-        data = 'Editora UNESP'
+        data = {'set': 'editora-unesp', 'name': 'Editora UNESP'}
 
         pipe = pipeline.SetPipe()
         xml = pipe.transform(data)
@@ -234,6 +246,21 @@ class TestSetPipe(unittest.TestCase):
 
         self.assertEqual(etree.tostring(xml), xml_str)
 
+    def test_set_pipe_add_description_with_counts(self):
+        data = {
+            'set': 'editora-unesp',
+            'name': 'Editora UNESP',
+            'total_records': 12,
+            'earliest_datestamp': '2014-01-02',
+            'latest_datestamp': '2014-03-04'
+        }
+
+        pipe = pipeline.SetPipe()
+        xml = pipe.transform(data)
+
+        description = xml.find('setDescription/{%s}dc/{%s}description' % (pipe.xmlns, pipe.dc))
+        self.assertEqual(description.text, '12 records, from 2014-01-02 to 2014-03-04')
+
 
 class TestListSetsPipe(unittest.TestCase):
 
@@ -241,7 +268,10 @@ class TestListSetsPipe(unittest.TestCase):
         data = {
             'verb': 'ListIdentifiers',
             'baseURL': 'http://books.scielo.org/oai/',
-            'books': ['Teste OAI-PMH', 'OAI-PMH SciELO']
+            'sets': [
+                {'set': 'teste-oai-pmh', 'name': 'Teste OAI-PMH'},
+                {'set': 'oai-pmh-scielo', 'name': 'OAI-PMH SciELO'}
+            ]
         }
         root = etree.Element('root')
 
@@ -951,13 +981,12 @@ class TestListRecordsPipe(unittest.TestCase):
 
 
 class TestResumptionTokenPipe(unittest.TestCase):
-    
-    @patch.object(Registry, 'settings')
-    def test_resumption_token_add_next_token_if_not_finished(self, mock_settings):
-        mock_settings.return_value = {'items_per_page': '2'}
+
+    def test_resumption_token_add_next_token_if_not_finished(self):
         data = {
             'books': [{}, {}],
-            'request': {}
+            'request': {},
+            'resumption': {'token': 'eyJhIjp7fX0', 'cursor': 0, 'completeListSize': 3}
         }
         root = etree.Element('root')
 
@@ -965,17 +994,16 @@ class TestResumptionTokenPipe(unittest.TestCase):
         xml, data = pipe.transform((root, data))
 
         xml_str = '<root>'
-        xml_str += '<resumptionToken>1</resumptionToken>'
+        xml_str += '<resumptionToken completeListSize="3" cursor="0">eyJhIjp7fX0</resumptionToken>'
         xml_str += '</root>'
 
         self.assertEqual(etree.tostring(xml), xml_str)
 
-    @patch.object(Registry, 'settings')
-    def test_resumption_token_empty_if_finished(self, mock_settings):
-        mock_settings.return_value = {'items_per_page': '2'}
+    def test_resumption_token_empty_if_finished(self):
         data = {
             'books': [{}, {}],
-            'request': {'resumptionToken': '1'}
+            'request': {'resumptionToken': 'eyJhIjp7fX0'},
+            'resumption': {'token': None, 'cursor': 2, 'completeListSize': 4}
         }
         root = etree.Element('root')
 
@@ -983,7 +1011,7 @@ class TestResumptionTokenPipe(unittest.TestCase):
         xml, data = pipe.transform((root, data))
 
         xml_str = '<root>'
-        xml_str += '<resumptionToken/>'
+        xml_str += '<resumptionToken completeListSize="4" cursor="2"/>'
         xml_str += '</root>'
 
-        self.assertEqual(etree.tostring(xml), xml_str)
\ No newline at end of file
+        self.assertEqual(etree.tostring(xml), xml_str)
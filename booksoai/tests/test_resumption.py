@@ -0,0 +1,44 @@
+import unittest
+
+from booksoai.resumption import encode_token, decode_token
+
+
+class ResumptionTokenTests(unittest.TestCase):
+
+    def test_token_round_trip(self):
+        state = {
+            'args': {'set': 'edufba', 'from': '2014-02-01', 'metadataPrefix': 'oai_dc'},
+            'after': ['2014-02-04', '39t'],
+            'cursor': 100,
+            'total': 1234,
+        }
+
+        self.assertEqual(decode_token(encode_token(state)), state)
+
+    def test_token_is_url_safe(self):
+        token = encode_token({'args': {'set': '???>>>'}, 'after': ['2014-02-04', '~~~']})
+
+        self.assertNotIn('=', token)
+        self.assertNotIn('+', token)
+        self.assertNotIn('/', token)
+
+    def test_decode_token_raises_value_error_for_page_numbers(self):
+        self.assertRaises(ValueError, decode_token, '3')
+
+    def test_decode_token_raises_value_error_for_garbage(self):
+        self.assertRaises(ValueError, decode_token, 'not a token!')
+
+    def test_decode_token_raises_value_error_without_args(self):
+        token = encode_token({'after': ['2014-02-04', '39t']})
+
+        self.assertRaises(ValueError, decode_token, token)
+
+    def test_decode_token_raises_value_error_for_invalid_key(self):
+        token = encode_token({'args': {}, 'after': '2014-02-04'})
+
+        self.assertRaises(ValueError, decode_token, token)
+
+    def test_decode_token_raises_value_error_for_invalid_cursor(self):
+        token = encode_token({'args': {}, 'after': ['2014-02-04', '39t'], 'cursor': '10'})
+
+        self.assertRaises(ValueError, decode_token, token)
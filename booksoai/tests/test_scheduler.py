@@ -0,0 +1,137 @@
+import unittest
+from datetime import datetime, timedelta
+
+from mock import patch, Mock
+
+from booksoai import scheduler
+from booksoai.scheduler import SyncScheduler
+
+
+settings = {}
+settings['auto_sync_interval'] = 100
+settings['auto_sync_jitter'] = 0
+
+
+class SyncSchedulerTests(unittest.TestCase):
+
+    @patch('booksoai.scheduler.get_storage')
+    def test_first_delay_waits_for_the_rest_of_the_interval(self, mock_storage):
+        last_sync = datetime.now() - timedelta(seconds=40)
+        mock_storage.return_value.get_last_update.return_value = {'updated_at': last_sync}
+
+        delay = SyncScheduler(settings).first_delay()
+
+        self.assertAlmostEqual(delay, 60, delta=1)
+
+    @patch('booksoai.scheduler.get_storage')
+    def test_first_delay_without_previous_sync_runs_now(self, mock_storage):
+        mock_storage.return_value.get_last_update.return_value = None
+
+        self.assertEqual(SyncScheduler(settings).first_delay(), 0)
+
+    @patch('booksoai.scheduler.random.uniform')
+    def test_delay_adds_jitter(self, mock_uniform):
+        mock_uniform.return_value = 7
+        sync_scheduler = SyncScheduler(dict(settings, auto_sync_jitter=0.1))
+
+        self.assertEqual(sync_scheduler._delay(100), 107)
+        mock_uniform.assert_called_once_with(0, 10.0)
+
+    @patch('booksoai.scheduler.update_from_api')
+    def test_run_once_records_state(self, mock_update):
+        mock_update.return_value = True
+        sync_scheduler = SyncScheduler(settings)
+
+        sync_scheduler.run_once()
+        state = sync_scheduler.state()
+
+        self.assertEqual(state['runs'], 1)
+        self.assertEqual(state['failures'], 0)
+        self.assertEqual(state['last_result'], 'ok')
+        self.assertFalse(state['running'])
+        self.assertIsNotNone(state['last_finished_at'])
+
+    @patch('booksoai.scheduler.update_from_api')
+    def test_run_once_counts_failures(self, mock_update):
+        mock_update.side_effect = [False, Exception('boom')]
+        sync_scheduler = SyncScheduler(settings)
+
+        sync_scheduler.run_once()
+        sync_scheduler.run_once()
+
+        self.assertEqual(sync_scheduler.state()['failures'], 2)
+        self.assertEqual(sync_scheduler.state()['last_result'], 'failed')
+
+    @patch('booksoai.scheduler.update_from_api')
+    def test_run_once_records_skipped_runs(self, mock_update):
+        mock_update.return_value = None
+        sync_scheduler = SyncScheduler(settings)
+
+        sync_scheduler.run_once()
+
+        self.assertEqual(sync_scheduler.state()['last_result'], 'skipped')
+        self.assertEqual(sync_scheduler.state()['failures'], 0)
+
+    @patch('booksoai.scheduler.follow_changes')
+    @patch('booksoai.scheduler.update_from_api')
+    def test_run_once_follows_changes_in_follow_mode(self, mock_update, mock_follow):
+        mock_follow.return_value = True
+        sync_scheduler = SyncScheduler(dict(settings, sync_follow=True))
+
+        sync_scheduler.run_once()
+
+        mock_follow.assert_called_once_with(sync_scheduler.settings, sync_scheduler._stopped)
+        self.assertFalse(mock_update.called)
+        self.assertEqual(sync_scheduler.state()['mode'], 'follow')
+        self.assertEqual(sync_scheduler.first_delay(), 0)
+
+    @patch('booksoai.scheduler.update_from_api')
+    @patch('booksoai.scheduler.get_storage')
+    def test_stopped_scheduler_does_not_sync(self, mock_storage, mock_update):
+        mock_storage.return_value.get_last_update.return_value = {'updated_at': datetime.now()}
+        sync_scheduler = SyncScheduler(settings)
+
+        sync_scheduler.start()
+        sync_scheduler.stop()
+        sync_scheduler.join(1)
+
+        self.assertFalse(sync_scheduler.is_alive())
+        self.assertFalse(mock_update.called)
+
+
+class StartSchedulerTests(unittest.TestCase):
+
+    def tearDown(self):
+        scheduler._scheduler = None
+
+    @patch('booksoai.scheduler.SyncScheduler')
+    def test_scheduler_is_started_once_per_process(self, mock_scheduler):
+        mock_scheduler.return_value = Mock(pid=scheduler.os.getpid())
+
+        first = scheduler.start_scheduler(settings)
+        second = scheduler.start_scheduler(settings)
+
+        self.assertIs(first, second)
+        self.assertEqual(mock_scheduler.return_value.start.call_count, 1)
+        self.assertIs(scheduler.get_scheduler(), first)
+
+    @patch('booksoai.scheduler.SyncScheduler')
+    def test_forked_process_starts_its_own_scheduler(self, mock_scheduler):
+        scheduler._scheduler = Mock(pid=-1)
+
+        self.assertIsNone(scheduler.get_scheduler())
+        scheduler.start_scheduler(settings)
+
+        self.assertTrue(mock_scheduler.return_value.start.called)
+
+    @patch('booksoai.scheduler.SyncScheduler')
+    def test_first_request_of_the_process_starts_the_scheduler(self, mock_scheduler):
+        mock_scheduler.return_value = Mock(pid=scheduler.os.getpid())
+        event = Mock()
+        event.request.registry.settings = settings
+
+        scheduler.start_on_request(event)
+        scheduler.start_on_request(event)
+
+        mock_scheduler.assert_called_once_with(settings)
+        self.assertEqual(mock_scheduler.return_value.start.call_count, 1)
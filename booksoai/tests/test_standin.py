@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import requests
+
+from booksoai.standin import BooksAPIStandIn
+from booksoai.storage import get_storage
+from booksoai.sync import update_from_api
+
+
+class StandInTests(unittest.TestCase):
+
+    def setUp(self):
+        self.api = BooksAPIStandIn(books=5).start()
+
+    def tearDown(self):
+        self.api.stop()
+
+    def get(self, path, **params):
+        return requests.get(self.api.uri + path, params=params)
+
+    def test_changes_lists_each_book_once_at_its_latest_seq(self):
+        self.api.update_books(['1t'])
+        self.api.update_books(['2t'], deleted=True)
+
+        results = self.get('/changes/', since=0).json()['results']
+
+        self.assertEqual([(c['seq'], c['id']) for c in results],
+                         [(1, '0t'), (4, '3t'), (5, '4t'), (6, '1t'), (7, '2t')])
+        self.assertTrue(results[-1]['deleted'])
+
+    def test_changes_with_limit(self):
+        data = self.get('/changes/', since=1, limit=2).json()
+
+        self.assertEqual([c['seq'] for c in data['results']], [2, 3])
+        self.assertEqual(data['last_seq'], 3)
+
+    def test_changes_descending_lists_the_latest_first(self):
+        self.api.update_books(['1t'])
+
+        data = self.get('/changes/', descending='true', limit=1).json()
+
+        self.assertEqual([(c['seq'], c['id']) for c in data['results']], [(6, '1t')])
+        self.assertEqual(data['last_seq'], 6)
+
+    def test_book_revisions(self):
+        rev = self.get('/changes/', since=0).json()['results'][0]['changes'][-1]['rev']
+
+        self.assertEqual(self.get('/book/0t/', rev=rev).json()['_rev'], rev)
+        self.assertEqual(self.get('/book/0t/', rev='9-x').status_code, 404)
+        self.assertEqual(self.get('/book/xxx/').status_code, 404)
+
+    def test_error_rate(self):
+        self.api.error_rate = 1
+
+        self.assertEqual(self.get('/changes/', since=0).status_code, 503)
+        self.assertEqual(self.api.requests['errors'], 1)
+
+
+class StandInSyncTests(unittest.TestCase):
+
+    def setUp(self):
+        self.api = BooksAPIStandIn(books=20).start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings = {
+            'storage_backend': 'sqlite',
+            'sqlite_path': os.path.join(self.tmpdir, 'books.db'),
+            'scielo_uri': self.api.uri,
+            'sync_page_size': 8,
+            'sync_batch_size': 5,
+        }
+
+    def tearDown(self):
+        self.api.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_sync_and_replay(self):
+        storage = get_storage(self.settings)
+        stats = {}
+
+        self.assertTrue(update_from_api(self.settings, stats=stats))
+
+        self.assertEqual(stats['books'], 20)
+        self.assertEqual(storage.count_books(), 20)
+        self.assertEqual(storage.get_last_update()['last_seq'], 20)
+        self.assertEqual(self.api.requests['book'], 20)
+        run = storage.find_sync_runs(1)[0]
+        self.assertEqual((run['api_seq'], run['lag']), (20, 0))
+
+        self.assertTrue(update_from_api(self.settings, since=0, stats=stats))
+
+        self.assertEqual(stats['not_modified'], 20)
+        self.assertEqual(self.api.requests['book'], 20)
@@ -0,0 +1,342 @@
+import sqlite3
+import unittest
+
+from datetime import datetime
+from mock import patch, Mock
+from pymongo.errors import AutoReconnect
+
+from booksoai.utils import get_db_connection
+from booksoai.storage import StorageError
+from booksoai.storage.mongodb import MongoStorage
+from booksoai.storage.sqlite import SQLiteStorage
+
+
+settings = {}
+settings['mongo_uri'] = 'mongodb://localhost:27017/scielobooks-test'
+
+BOOKS = [
+    {'identifier': '1t', 'updated': '2014-02-03', 'set': 'edufba', 'publisher': 'EDUFBA'},
+    {'identifier': '2t', 'updated': '2014-01-01', 'deleted': True, 'set': 'edufba', 'publisher': 'EDUFBA'},
+    {'identifier': '3t', 'updated': '2014-03-10', 'set': 'editora-unesp', 'publisher': 'Editora UNESP'},
+]
+
+
+class StorageTestsMixin(object):
+    """
+    Behaviour shared by every storage backend. Subclasses return the backend
+    under test from ``get_storage``.
+    """
+
+    def setUp(self):
+        self.storage = self.get_storage()
+        for book in BOOKS:
+            self.storage.upsert_book(dict(book))
+
+    def test_find_book(self):
+        book = self.storage.find_book('3t')
+
+        self.assertEqual(book['publisher'], 'Editora UNESP')
+        self.assertIsNone(self.storage.find_book('xxx'))
+
+    def test_find_book_with_fields(self):
+        book = self.storage.find_book('3t', ['identifier', 'set'])
+
+        self.assertEqual(book, {'identifier': '3t', 'set': 'editora-unesp'})
+
+    def test_find_books_sorted_by_updated(self):
+        books = self.storage.find_books({})
+
+        self.assertEqual([b['identifier'] for b in books], ['2t', '1t', '3t'])
+
+    def test_find_books_with_filters(self):
+        books = self.storage.find_books({'set': 'edufba', 'from': '2014-02-01'})
+
+        self.assertEqual([b['identifier'] for b in books], ['1t'])
+
+    def test_find_books_after_key(self):
+        books = self.storage.find_books({}, after=['2014-01-01', '2t'], limit=1)
+
+        self.assertEqual([b['identifier'] for b in books], ['1t'])
+
+    def test_count_books(self):
+        self.assertEqual(self.storage.count_books(), 3)
+        self.assertEqual(self.storage.count_books({'until': '2014-02-03'}), 2)
+
+    def test_iter_identifiers(self):
+        self.assertEqual(sorted(self.storage.iter_identifiers()), ['1t', '2t', '3t'])
+
+    def test_upsert_book_keeps_stored_fields(self):
+        self.storage.upsert_book({'identifier': '1t', 'title': 'Teste'})
+
+        book = self.storage.find_book('1t')
+        self.assertEqual(book['title'], 'Teste')
+        self.assertEqual(book['publisher'], 'EDUFBA')
+
+    def test_mark_as_deleted(self):
+        self.storage.mark_as_deleted('1t', '2014-04-01')
+
+        book = self.storage.find_book('1t')
+        self.assertTrue(book['deleted'])
+        self.assertEqual(self.storage.count_books(), 3)
+
+    def test_write_books(self):
+        self.storage.write_books([{'identifier': '1t', 'title': 'Teste'}, {'identifier': '4t'}],
+                                 ['2t'], '2014-04-01', {'w': 1})
+
+        self.assertEqual(self.storage.find_book('1t')['publisher'], 'EDUFBA')
+        self.assertEqual(self.storage.find_book('1t')['title'], 'Teste')
+        self.assertTrue(self.storage.find_book('2t')['deleted'])
+        self.assertEqual(self.storage.count_books(), 4)
+
+    def test_write_books_without_changes(self):
+        self.storage.write_books([], [], '2014-04-01')
+
+        self.assertEqual(self.storage.count_books(), 3)
+
+    def test_insert_books(self):
+        self.storage.insert_books([{'identifier': '4t', 'set': 'edufba'},
+                                   {'identifier': '5t', 'set': 'edufba'}], {'w': 1})
+        self.storage.insert_books([])
+
+        self.assertEqual(self.storage.find_book('4t', ['identifier', 'set']),
+                         {'identifier': '4t', 'set': 'edufba'})
+        self.assertEqual(self.storage.count_books(), 5)
+
+    def test_books_version_changes_with_book_writes(self):
+        versions = [self.storage.get_books_version()]
+        self.storage.upsert_book({'identifier': '4t'})
+        versions.append(self.storage.get_books_version())
+        self.storage.insert_books([{'identifier': '5t'}])
+        versions.append(self.storage.get_books_version())
+        self.storage.replace_books([{'identifier': '5t'}])
+        versions.append(self.storage.get_books_version())
+        self.storage.write_books([{'identifier': '6t'}], [], datetime.now())
+        versions.append(self.storage.get_books_version())
+        self.storage.set_last_seq(10)
+
+        self.assertEqual(len(set(versions)), 5)
+        self.assertEqual(self.storage.get_books_version(), versions[-1])
+
+    def test_ensure_sets_only_refreshes_missing_sets(self):
+        self.assertTrue(self.storage.ensure_sets())
+        self.assertEqual(self.storage.count_sets(), 2)
+
+        self.storage.upsert_book({'identifier': '4t', 'set': 'eduerj', 'publisher': 'EDUERJ'})
+        self.assertFalse(self.storage.ensure_sets())
+        self.assertEqual(self.storage.count_sets(), 2)
+
+    def test_replace_books(self):
+        self.storage.replace_books([{'identifier': '1t', 'set': 'editora-unesp'}])
+        self.storage.replace_books([])
+
+        self.assertEqual(self.storage.find_book('1t', ['identifier', 'set', 'publisher']),
+                         {'identifier': '1t', 'set': 'editora-unesp'})
+        self.assertEqual(self.storage.count_books(), 3)
+
+    def test_get_content_hashes_of_stored_books(self):
+        self.storage.upsert_book({'identifier': '1t', 'content_hash': 'abc'})
+        self.storage.upsert_book({'identifier': '2t', 'content_hash': 'def'})
+
+        hashes = self.storage.get_content_hashes(['1t', '2t', '3t', 'xxx'])
+
+        # 2t is deleted and 3t has no hash
+        self.assertEqual(hashes, {'1t': 'abc'})
+
+    def test_refresh_sets_stores_one_set_per_slug(self):
+        self.storage.refresh_sets()
+
+        self.assertEqual(self.storage.count_sets(), 2)
+        self.assertEqual(self.storage.find_sets(after='editora-unesp'), [{
+            'set': 'edufba',
+            'name': 'EDUFBA',
+            'total_records': 2,
+            'deleted_records': 1,
+            'earliest_datestamp': '2014-01-01',
+            'latest_datestamp': '2014-02-03',
+        }])
+
+    def test_refresh_sets_removes_sets_without_books(self):
+        self.storage.refresh_sets()
+        self.storage.upsert_book({'identifier': '3t', 'set': 'edufba'})
+
+        self.storage.refresh_sets()
+
+        self.assertEqual([s['set'] for s in self.storage.find_sets()], ['edufba'])
+
+    def test_backfill_sets_of_legacy_books(self):
+        self.storage.upsert_book({'identifier': '4t', 'publisher': 'Editora FIOCRUZ'})
+        self.storage.upsert_book({'identifier': '5t'})
+
+        self.assertEqual(self.storage.backfill_sets(), 1)
+        self.assertEqual(self.storage.backfill_sets(), 0)
+
+        self.assertEqual(self.storage.find_book('4t')['set'], 'editora-fiocruz')
+        self.assertEqual(self.storage.count_books({'set': 'editora-fiocruz'}), 1)
+        self.assertIn('editora-fiocruz', [s['set'] for s in self.storage.find_sets()])
+
+    def test_find_sets_with_limit_and_fields(self):
+        self.storage.refresh_sets()
+
+        sets = self.storage.find_sets(limit=1, fields=['name'])
+
+        self.assertEqual(sets, [{'set': 'editora-unesp', 'name': 'Editora UNESP'}])
+
+    def test_refresh_repository_stats(self):
+        stats = self.storage.refresh_repository_stats(10)
+
+        self.assertEqual(stats['earliest_datestamp'], '2014-01-01')
+        self.assertEqual(stats['latest_datestamp'], '2014-03-10')
+        self.assertEqual(stats['total_records'], 3)
+        self.assertEqual(stats['deleted_records'], 1)
+        self.assertEqual(self.storage.get_sync_seq(), 10)
+
+    def test_get_repository_stats_reads_stored_stats(self):
+        self.storage.refresh_repository_stats(10)
+        self.storage.upsert_book({'identifier': '4t', 'updated': '2013-01-01'})
+
+        stats = self.storage.get_repository_stats()
+
+        self.assertEqual(stats['earliest_datestamp'], '2014-01-01')
+        self.assertEqual(stats['last_seq'], 10)
+
+    def test_get_repository_stats_computes_missing_stats(self):
+        stats = self.storage.get_repository_stats()
+
+        self.assertEqual(stats['earliest_datestamp'], '2014-01-01')
+        self.assertEqual(stats['last_seq'], 0)
+        self.assertIsNone(self.storage.get_sync_seq())
+
+    def test_set_last_seq(self):
+        self.assertIsNone(self.storage.get_last_update())
+
+        self.storage.set_last_seq(10)
+        self.storage.set_last_seq(12)
+
+        self.assertEqual(self.storage.get_last_update()['last_seq'], 12)
+
+    def test_get_and_set_revisions(self):
+        self.storage.set_revisions({'1t': '2-a', '2t': '1-b'}, {'w': 1})
+        self.storage.set_revisions({})
+
+        # 2t is deleted and 3t has no revision
+        self.assertEqual(self.storage.get_revisions(['1t', '2t', '3t', 'xxx']), {'1t': '2-a'})
+        self.assertEqual(self.storage.find_book('1t')['publisher'], 'EDUFBA')
+
+    def test_find_sync_runs_latest_first(self):
+        for day in (1, 3, 2):
+            self.storage.add_sync_run({'started_at': datetime(2014, 5, day), 'lag': day})
+
+        runs = self.storage.find_sync_runs(limit=2)
+
+        self.assertEqual([run['lag'] for run in runs], [3, 2])
+
+    def test_add_sync_run_keeps_last_runs(self):
+        for day in range(1, 5):
+            self.storage.add_sync_run({'started_at': datetime(2014, 5, day), 'lag': day}, keep=2)
+
+        self.assertEqual([run['lag'] for run in self.storage.find_sync_runs()], [4, 3])
+
+    def test_acquire_lease_held_by_another_owner(self):
+        self.assertTrue(self.storage.acquire_lease('sync', 'a', 300))
+
+        self.assertFalse(self.storage.acquire_lease('sync', 'b', 300))
+        self.assertTrue(self.storage.acquire_lease('sync', 'a', 300))
+
+    def test_acquire_expired_lease(self):
+        self.storage.acquire_lease('sync', 'a', -1)
+
+        self.assertTrue(self.storage.acquire_lease('sync', 'b', 300))
+        self.assertFalse(self.storage.renew_lease('sync', 'a', 300))
+
+    def test_renew_and_release_lease(self):
+        self.storage.acquire_lease('sync', 'a', 300)
+
+        self.assertTrue(self.storage.renew_lease('sync', 'a', 300))
+        self.assertFalse(self.storage.renew_lease('sync', 'b', 300))
+
+        self.storage.release_lease('sync', 'a')
+        self.assertTrue(self.storage.acquire_lease('sync', 'b', 300))
+
+    def test_ensure_indexes_is_idempotent(self):
+        self.storage.ensure_indexes()
+        report = self.storage.ensure_indexes()
+
+        self.assertEqual(report['missing'], [])
+        self.assertEqual(report['created'], [])
+
+
+class MongoStorageTests(StorageTestsMixin, unittest.TestCase):
+
+    def get_storage(self):
+        return MongoStorage(get_db_connection(settings))
+
+    def tearDown(self):
+        db = self.storage.db
+        db.connection.drop_database(db.name)
+
+    @patch('booksoai.storage.mongodb.indexes.ensure_indexes')
+    def test_ensure_indexes_raises_storage_error(self, mock_ensure):
+        mock_ensure.side_effect = AutoReconnect('connection refused')
+
+        self.assertRaises(StorageError, self.storage.ensure_indexes)
+
+
+class MongoStorageRoutingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = Mock()
+        self.read_db = Mock()
+
+    def test_reads_use_read_db(self):
+        storage = MongoStorage(self.db, self.read_db)
+
+        storage.count_books()
+        storage.upsert_book({'identifier': '1t'})
+
+        self.assertTrue(self.read_db.books.find.called)
+        self.assertFalse(self.db.books.find.called)
+        self.assertTrue(self.db.books.update.called)
+
+    @patch('booksoai.storage.mongodb.replication_lag')
+    def test_reads_fall_back_to_primary_when_stale(self, mock_lag):
+        mock_lag.return_value = 120
+        storage = MongoStorage(self.db, self.read_db, max_staleness=90)
+
+        self.assertIs(storage.reads, self.db)
+
+    @patch('booksoai.storage.mongodb.replication_lag')
+    def test_reads_fall_back_to_primary_when_lag_is_unknown(self, mock_lag):
+        mock_lag.return_value = None
+        storage = MongoStorage(self.db, self.read_db, max_staleness=90)
+
+        self.assertIs(storage.reads, self.db)
+
+    @patch('booksoai.storage.mongodb.time.time')
+    @patch('booksoai.storage.mongodb.replication_lag')
+    def test_lag_is_checked_once_per_interval(self, mock_lag, mock_time):
+        mock_lag.return_value = 10
+        mock_time.return_value = 1000
+        storage = MongoStorage(self.db, self.read_db, max_staleness=90)
+
+        self.assertIs(storage.reads, self.read_db)
+        mock_lag.return_value = 120
+        self.assertIs(storage.reads, self.read_db)
+
+        mock_time.return_value = 1011
+        self.assertIs(storage.reads, self.db)
+        self.assertEqual(mock_lag.call_count, 2)
+
+
+class SQLiteStorageTests(StorageTestsMixin, unittest.TestCase):
+
+    def get_storage(self):
+        return SQLiteStorage(':memory:')
+
+    def test_ensure_indexes_raises_storage_error(self):
+        storage = SQLiteStorage('/nonexistent/books.db')
+
+        self.assertRaises(StorageError, storage.ensure_indexes)
+
+    def test_insert_books_rejects_duplicates(self):
+        self.assertRaises(sqlite3.IntegrityError, self.storage.insert_books,
+                          [{'identifier': '1t'}])
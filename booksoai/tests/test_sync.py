@@ -1,23 +1,32 @@
+import time
 import unittest
 from datetime import datetime
 
 from pyramid import testing
 
-from booksoai.utils import get_db_connection
-from booksoai.sync import mark_as_deleted
-from booksoai.sync import get_updates, update_from_api, adapt_data
+from booksoai.storage import get_storage
+from booksoai.apiclient import get_api_client
+from booksoai.sync import get_updates, update_from_api, adapt_data, SYNC_LEASE
+from booksoai.sync import fetch_update, coalesce_updates, BatchWriter, parse_write_concern
+from booksoai.sync import iter_update_pages, content_hash, get_feed_head, NOT_MODIFIED
+from booksoai.telemetry import Histogram
 
-from mock import patch, call
+from mock import patch, call, Mock
+from requests.exceptions import HTTPError, ConnectionError
 
 
 settings = {}
 settings['mongo_uri'] = 'mongodb://localhost:27017/scielobooks-test'
 settings['scielo_uri'] = 'http://books.scielo.org/api/v1/'
-settings['db_conn'] = get_db_connection(settings)
+settings['storage'] = get_storage(settings)
+
+
+def http_error(status_code):
+    return HTTPError('%s Error' % status_code, response=Mock(status_code=status_code))
 
 
 def tearDownModule():
-    db = get_db_connection(settings)
+    db = settings['storage'].db
     db.connection.drop_database(db.name)
 
 
@@ -25,7 +34,12 @@ class SyncTests(unittest.TestCase):
 
     def setUp(self):
         self.config = testing.setUp()
-        self.db = get_db_connection(settings)
+        self.db = settings['storage'].db
+        # runs read the head of the feed once they are done; tests that care
+        # patch it themselves
+        head = patch('booksoai.sync.get_feed_head', return_value=None)
+        head.start()
+        self.addCleanup(head.stop)
         
     def tearDown(self):
         testing.tearDown()
@@ -34,7 +48,7 @@ class SyncTests(unittest.TestCase):
     def test_get_updates_no_updates_return_empty_list(self, mock_data):
         mock_data.return_value = {'results': [], 'last_seq':0}
  
-        resp = get_updates(settings['scielo_uri'], settings['db_conn'])
+        resp = get_updates(settings['scielo_uri'], settings['storage'])
         
         self.assertEquals(resp, [])
 
@@ -42,7 +56,7 @@ class SyncTests(unittest.TestCase):
     def test_get_updates_with_updates_return_updates_list(self, mock_data):
         mock_data.return_value = {'results': [{'seq': 2}], 'last_seq': 2}
  
-        resp = get_updates(settings['scielo_uri'], settings['db_conn'])
+        resp = get_updates(settings['scielo_uri'], settings['storage'])
         update = self.db.updates.find_one()
 
         self.assertEquals(resp, [{'seq': 2}])
@@ -54,23 +68,127 @@ class SyncTests(unittest.TestCase):
         self.db.updates.insert({'last_seq': 2}, w=1)
         mock_data.return_value = {'results': [], 'last_seq': 3}
 
-        get_updates(settings['scielo_uri'], settings['db_conn'])
+        get_updates(settings['scielo_uri'], settings['storage'])
         
-        api_data_call = call('%s/changes/?since=%s' % (settings['scielo_uri'], 2))
+        api_data_call = call('%s/changes/?since=%s' % (settings['scielo_uri'], 2), client=None)
         self.assertEquals(mock_data.call_args_list, [api_data_call])
 
+    @patch('booksoai.sync.get_data_from_api')
+    def test_get_updates_since_given_seq(self, mock_data):
+        self.db.updates.remove()
+        self.db.updates.insert({'last_seq': 2}, w=1)
+        mock_data.return_value = {'results': [], 'last_seq': 3}
+
+        get_updates(settings['scielo_uri'], settings['storage'], since=0)
+
+        api_data_call = call('%s/changes/?since=%s' % (settings['scielo_uri'], 0), client=None)
+        self.assertEquals(mock_data.call_args_list, [api_data_call])
+
+    @patch('booksoai.sync.update_last_seq')
+    @patch('booksoai.sync.persists_batch')
+    @patch('booksoai.sync.get_data_from_api')
+    @patch('booksoai.sync.get_updates')
+    def test_update_from_api_dry_run_does_not_write(self, mock_update, mock_api_data,
+            mock_persists, mock_last_seq):
+        mock_update.return_value = [
+            {'seq': 1, 'id': 1, 'changes': [{'rev': '2'}]},
+            {'seq': 2, 'id': 2, 'deleted': True},
+        ]
+        mock_api_data.return_value = {'_id': 1, 'publisher': 'teste'}
+        stats = {}
+
+        resp = update_from_api(settings, dry_run=True, stats=stats)
+
+        self.assertTrue(resp)
+        self.assertEquals(stats, {'changes': 2, 'books': 1, 'deleted': 1, 'errors': 0,
+                                  'duplicates': 0, 'unchanged': 0, 'not_modified': 0})
+        self.assertFalse(mock_persists.called)
+        self.assertFalse(mock_last_seq.called)
+
+    @patch('booksoai.sync.update_last_seq')
+    @patch('booksoai.sync.persists_batch')
+    @patch('booksoai.sync.get_data_from_api')
+    @patch('booksoai.sync.get_updates')
+    def test_update_from_api_checkpoints_concurrent_fetches_in_order(self, mock_update,
+            mock_api_data, mock_persists, mock_last_seq):
+        def slow_first_books(uri, revision, client):
+            # the first books are the last to be fetched
+            _id = int(uri.rstrip('/').split('/')[-1])
+            time.sleep((5 - _id) * 0.01)
+            return {'_id': _id}
+
+        mock_update.return_value = [
+            {'seq': seq, 'id': seq, 'changes': [{'rev': '1'}]} for seq in range(1, 5)]
+        mock_api_data.side_effect = slow_first_books
+
+        update_from_api(dict(settings, sync_concurrency=4, sync_batch_size=2))
+
+        self.assertEquals(mock_last_seq.call_args_list,
+                          [call(settings['storage'], 2), call(settings['storage'], 4)])
+        self.assertEquals([[book['identifier'] for book in c[0][0]]
+                           for c in mock_persists.call_args_list], [[1, 2], [3, 4]])
+
+    @patch('booksoai.sync.get_data_from_api')
+    def test_fetch_update_returns_http_errors(self, mock_api_data):
+        error = http_error(404)
+        mock_api_data.side_effect = error
+        update = {'seq': 1, 'id': 1, 'changes': [{'rev': '1'}]}
+
+        self.assertEquals(fetch_update(settings['scielo_uri'], update), (update, None, error))
+
+    @patch('booksoai.sync.get_data_from_api')
+    def test_fetch_update_raises_server_errors(self, mock_api_data):
+        mock_api_data.side_effect = http_error(503)
+        update = {'seq': 1, 'id': 1, 'changes': [{'rev': '1'}]}
+
+        self.assertRaises(HTTPError, fetch_update, settings['scielo_uri'], update)
+
+    @patch('booksoai.sync.update_last_seq')
+    @patch('booksoai.sync.persists_batch')
     @patch('booksoai.sync.get_data_from_api')
     @patch('booksoai.sync.get_updates')
-    def test_update_from_api_return_none_if_no_updates(self, mock_update, mock_data):
+    def test_update_from_api_stops_at_server_errors(self, mock_update, mock_api_data,
+            mock_persists, mock_last_seq):
+        mock_update.return_value = [
+            {'seq': seq, 'id': seq, 'changes': [{'rev': '1'}]} for seq in range(1, 5)]
+        mock_api_data.side_effect = [{'_id': 1}, http_error(503), {'_id': 3}, {'_id': 4}]
+
+        resp = update_from_api(dict(settings, sync_concurrency=1, sync_batch_size=1))
+
+        self.assertFalse(resp)
+        self.assertEquals(mock_last_seq.call_args_list, [call(settings['storage'], 1)])
+
+    @patch('booksoai.sync.get_data_from_api')
+    @patch('booksoai.sync.get_updates')
+    def test_update_from_api_return_true_if_no_updates(self, mock_update, mock_data):
         mock_update.return_value = []
 
         resp = update_from_api(settings)
 
-        self.assertEquals(resp, None)
+        self.assertEquals(resp, True)
         self.assertEquals(mock_data.call_count, 0)
 
+    @patch('booksoai.sync.get_updates')
+    def test_update_from_api_skipped_while_lease_is_held(self, mock_update):
+        settings['storage'].acquire_lease(SYNC_LEASE, 'other-worker', 300)
+
+        resp = update_from_api(settings)
+
+        settings['storage'].release_lease(SYNC_LEASE, 'other-worker')
+        self.assertEquals(resp, None)
+        self.assertFalse(mock_update.called)
+
+    @patch('booksoai.sync.get_updates')
+    def test_update_from_api_releases_lease(self, mock_update):
+        mock_update.return_value = []
+
+        update_from_api(settings)
+
+        self.assertTrue(settings['storage'].acquire_lease(SYNC_LEASE, 'other-worker', 300))
+        settings['storage'].release_lease(SYNC_LEASE, 'other-worker')
+
     @patch('booksoai.sync.datetime')
-    @patch('booksoai.sync.persists_data')
+    @patch('booksoai.sync.persists_batch')
     @patch('booksoai.sync.get_data_from_api')
     @patch('booksoai.sync.get_updates')
     def test_update_from_api_with_updates(self, mock_update, mock_api_data, mock_persists, mock_datetime):
@@ -82,21 +200,275 @@ class SyncTests(unittest.TestCase):
         update_from_api(settings)
 
         uri = '%s/book/%s/' % (settings['scielo_uri'], 1)
-        api_data_call = call(uri, {'rev':'2'})
-        persists_call = call({'datestamp': test_datetime, 'identifier':10, 'publisher': 'teste'}, settings['db_conn'])
+        api_data_call = call(uri, {'rev':'2'}, get_api_client(settings))
+        adapted = {'datestamp': test_datetime, 'identifier':10, 'publisher': 'teste', 'set': 'teste',
+                   'revision': '2'}
+        adapted['content_hash'] = content_hash(adapted)
+        persists_call = call([adapted], [], settings['storage'], None)
 
         self.assertEquals(mock_api_data.call_args_list, [api_data_call])
         self.assertEquals(mock_persists.call_args_list, [persists_call])
 
-    @patch('booksoai.sync.mark_as_deleted')
+    @patch('booksoai.sync.persists_batch')
     @patch('booksoai.sync.get_updates')
-    def test_update_from_api_with_deletions(self, mock_update, mock_mark_as_deleted):
-        mock_update.return_value = [{'a':1, 'b':2, 'deleted':True}]
+    def test_update_from_api_with_deletions(self, mock_update, mock_persists):
+        mock_update.return_value = [{'seq': 2, 'id': 1, 'deleted': True}]
 
         update_from_api(settings)
 
-        mock_call = call({'a':1, 'b':2, 'deleted':True}, settings['db_conn'])
-        self.assertEquals(mock_mark_as_deleted.call_args_list, [mock_call])
+        mock_call = call([], [1], settings['storage'], None)
+        self.assertEquals(mock_persists.call_args_list, [mock_call])
+
+    @patch('booksoai.sync.get_data_from_api')
+    def test_get_updates_with_limit(self, mock_data):
+        mock_data.return_value = {'results': [], 'last_seq': 3}
+
+        get_updates(settings['scielo_uri'], settings['storage'], since=2, limit=10)
+
+        api_data_call = call('%s/changes/?since=2&limit=10' % settings['scielo_uri'], client=None)
+        self.assertEquals(mock_data.call_args_list, [api_data_call])
+
+    @patch('booksoai.sync.get_data_from_api')
+    def test_get_updates_with_longpoll(self, mock_data):
+        mock_data.return_value = {'results': [], 'last_seq': 3}
+
+        get_updates(settings['scielo_uri'], settings['storage'], since=3, longpoll=20000)
+
+        api_data_call = call('%s/changes/?since=3&feed=longpoll&timeout=20000'
+                             % settings['scielo_uri'], client=None)
+        self.assertEquals(mock_data.call_args_list, [api_data_call])
+
+    @patch('booksoai.sync.get_updates')
+    def test_iter_update_pages_resumes_after_last_seq_of_each_page(self, mock_update):
+        mock_update.side_effect = [
+            [{'seq': 1}, {'seq': 2}],
+            [{'seq': 3}, {'seq': 4}],
+            [{'seq': 5}],
+        ]
+
+        pages = list(iter_update_pages(settings['scielo_uri'], settings['storage'], limit=2))
+
+        self.assertEquals(pages, [[{'seq': 1}, {'seq': 2}], [{'seq': 3}, {'seq': 4}], [{'seq': 5}]])
+        self.assertEquals([c[0][2] for c in mock_update.call_args_list], [None, 2, 4])
+
+    @patch('booksoai.sync.get_updates')
+    def test_iter_update_pages_stops_at_empty_page(self, mock_update):
+        mock_update.side_effect = [[{'seq': 1}, {'seq': 2}], []]
+
+        pages = list(iter_update_pages(settings['scielo_uri'], settings['storage'], limit=2))
+
+        self.assertEquals(pages, [[{'seq': 1}, {'seq': 2}]])
+
+    def test_coalesce_updates_keeps_last_change_of_each_book(self):
+        updates = [
+            {'seq': 1, 'id': 'a', 'changes': [{'rev': '1'}]},
+            {'seq': 2, 'id': 'b', 'changes': [{'rev': '1'}]},
+            {'seq': 3, 'id': 'a', 'changes': [{'rev': '2'}]},
+            {'seq': 4, 'id': 'b', 'deleted': True},
+            {'seq': 5, 'id': 'c', 'changes': [{'rev': '1'}]},
+        ]
+
+        coalesced, skipped = coalesce_updates(updates)
+
+        self.assertEquals([u['seq'] for u in coalesced], [3, 4, 5])
+        self.assertEquals(skipped, 2)
+
+    @patch('booksoai.sync.persists_batch')
+    @patch('booksoai.sync.get_data_from_api')
+    @patch('booksoai.sync.get_updates')
+    def test_update_from_api_fetches_each_book_once(self, mock_update, mock_api_data,
+            mock_persists):
+        mock_update.return_value = [
+            {'seq': 1, 'id': 1, 'changes': [{'rev': '1'}]},
+            {'seq': 2, 'id': 1, 'changes': [{'rev': '2'}]},
+            {'seq': 3, 'id': 1, 'deleted': True},
+        ]
+        stats = {}
+
+        update_from_api(settings, stats=stats)
+
+        self.assertFalse(mock_api_data.called)
+        self.assertEquals(mock_persists.call_args_list, [call([], [1], settings['storage'], None)])
+        self.assertEquals(stats['duplicates'], 2)
+        self.assertEquals(stats['changes'], 1)
+
+    @patch('booksoai.sync.update_last_seq')
+    @patch('booksoai.sync.persists_batch')
+    def test_batch_writer_flushes_every_size_changes(self, mock_persists, mock_last_seq):
+        writer = BatchWriter(settings['storage'], size=2, write_concern={'w': 1})
+
+        writer.add_book({'identifier': 1}, 1)
+        writer.add_deletion(2, 2)
+        writer.add_book({'identifier': 3}, 3)
+
+        self.assertEquals(mock_persists.call_args_list,
+                          [call([{'identifier': 1}], [2], settings['storage'], {'w': 1})])
+        self.assertEquals(mock_last_seq.call_args_list, [call(settings['storage'], 2)])
+
+        writer.flush()
+        self.assertEquals(mock_last_seq.call_args_list[-1], call(settings['storage'], 3))
+
+    @patch('booksoai.sync.update_last_seq')
+    @patch('booksoai.sync.persists_batch')
+    def test_batch_writer_flushes_repeated_identifiers(self, mock_persists, mock_last_seq):
+        writer = BatchWriter(settings['storage'], size=10)
+
+        writer.add_book({'identifier': 1, 'title': 'a'}, 1)
+        writer.add_book({'identifier': 1, 'title': 'b'}, 2)
+        writer.flush()
+
+        self.assertEquals([c[0][0] for c in mock_persists.call_args_list],
+                          [[{'identifier': 1, 'title': 'a'}], [{'identifier': 1, 'title': 'b'}]])
+
+    @patch('booksoai.sync.update_last_seq')
+    @patch('booksoai.sync.persists_batch')
+    def test_batch_writer_skips_unchanged_books(self, mock_persists, mock_last_seq):
+        book = {'identifier': 'hash1', 'title': 'a'}
+        book['content_hash'] = content_hash(book)
+        settings['storage'].upsert_book(book)
+        stats = {}
+        writer = BatchWriter(settings['storage'], stats=stats)
+
+        writer.add_book(dict(book, updated='2014-05-01'), 7)
+        writer.flush()
+
+        self.assertFalse(mock_persists.called)
+        self.assertEquals(mock_last_seq.call_args_list, [call(settings['storage'], 7)])
+        self.assertEquals(stats['unchanged'], 1)
+
+    @patch('booksoai.sync.update_last_seq')
+    @patch('booksoai.sync.persists_batch')
+    def test_batch_writer_times_writes(self, mock_persists, mock_last_seq):
+        latency = Histogram()
+        writer = BatchWriter(settings['storage'], size=1, latency=latency)
+
+        writer.add_book({'identifier': 'timed1'}, 1)
+        writer.add_deletion('timed2', 2)
+
+        self.assertEquals(latency.count, 2)
+
+    @patch('booksoai.sync.get_data_from_api')
+    def test_get_feed_head(self, mock_api_data):
+        mock_api_data.return_value = {'results': [{'seq': 40, 'id': 'x'}], 'last_seq': 40}
+
+        self.assertEquals(get_feed_head(settings['scielo_uri']), 40)
+        self.assertIn('descending=true&limit=1', mock_api_data.call_args[0][0])
+
+        mock_api_data.side_effect = ConnectionError('refused')
+        self.assertIsNone(get_feed_head(settings['scielo_uri']))
+
+    @patch('booksoai.sync.get_data_from_api')
+    def test_fetch_update_times_requests(self, mock_api_data):
+        mock_api_data.side_effect = http_error(404)
+        latency = Histogram()
+
+        fetch_update(settings['scielo_uri'], {'id': 1, 'changes': [{'rev': '1'}]},
+                     latency=latency)
+
+        self.assertEquals(latency.count, 1)
+
+    @patch('booksoai.sync.get_feed_head')
+    @patch('booksoai.sync.persists_batch')
+    @patch('booksoai.sync.get_data_from_api')
+    @patch('booksoai.sync.get_updates')
+    def test_update_from_api_records_sync_run(self, mock_update, mock_api_data,
+            mock_persists, mock_head):
+        mock_update.return_value = [
+            {'seq': 31, 'id': 'run1', 'changes': [{'rev': '1'}]},
+            {'seq': 32, 'id': 'run2', 'deleted': True},
+        ]
+        mock_api_data.return_value = {'_id': 'run1', 'title': 'a'}
+        # changes that arrived during the run
+        mock_head.return_value = 35
+
+        update_from_api(dict(settings, sync_concurrency=1))
+
+        run = settings['storage'].find_sync_runs(1)[0]
+        self.assertEquals(run['result'], 'ok')
+        self.assertEquals((run['changes'], run['books'], run['deleted'], run['written']),
+                          (2, 1, 1, 1))
+        self.assertEquals((run['api_seq'], run['last_seq'], run['lag']), (35, 32, 3))
+        # the changes feed and the book
+        self.assertEquals(run['http_latency']['count'], 2)
+        self.assertEquals(run['batch_latency']['count'], 1)
+
+    @patch('booksoai.sync.get_updates')
+    def test_update_from_api_records_failed_sync_run(self, mock_update):
+        mock_update.side_effect = ConnectionError('refused')
+
+        self.assertFalse(update_from_api(settings))
+
+        run = settings['storage'].find_sync_runs(1)[0]
+        self.assertEquals(run['result'], 'failed')
+        self.assertEquals(run['error'], 'ConnectionError: refused')
+        self.assertIsNone(run['lag'])
+
+    @patch('booksoai.sync.get_data_from_api')
+    @patch('booksoai.sync.get_updates')
+    def test_update_from_api_dry_run_is_not_recorded(self, mock_update, mock_api_data):
+        mock_update.return_value = []
+        runs = len(settings['storage'].find_sync_runs(100))
+
+        update_from_api(settings, dry_run=True)
+
+        self.assertEquals(len(settings['storage'].find_sync_runs(100)), runs)
+
+    @patch('booksoai.sync.get_data_from_api')
+    def test_fetch_update_skips_stored_revisions(self, mock_api_data):
+        update = {'seq': 3, 'id': 'rev1', 'changes': [{'rev': '2-a'}]}
+
+        self.assertEquals(fetch_update(settings['scielo_uri'], update, revisions={'rev1': '2-a'}),
+                          (update, NOT_MODIFIED, None))
+        fetch_update(settings['scielo_uri'], update, revisions={'rev1': '1-a'})
+
+        self.assertEquals(mock_api_data.call_count, 1)
+
+    @patch('booksoai.sync.get_data_from_api')
+    @patch('booksoai.sync.get_updates')
+    def test_update_from_api_replay_skips_stored_revisions(self, mock_update, mock_api_data):
+        mock_update.return_value = [
+            {'seq': 41, 'id': 'rev2', 'changes': [{'rev': '1-a'}]},
+            {'seq': 42, 'id': 'rev3', 'changes': [{'rev': '1-b'}]},
+        ]
+        mock_api_data.side_effect = lambda uri, revision, client: {
+            '_id': uri.rstrip('/').split('/')[-1], 'title': 'a'}
+        update_from_api(dict(settings, sync_concurrency=1))
+        mock_api_data.reset_mock()
+        stats = {}
+
+        update_from_api(dict(settings, sync_concurrency=1), since=40, stats=stats)
+
+        self.assertFalse(mock_api_data.called)
+        self.assertEquals(stats['not_modified'], 2)
+        self.assertEquals(settings['storage'].get_last_update()['last_seq'], 42)
+
+    @patch('booksoai.sync.update_last_seq')
+    @patch('booksoai.sync.persists_batch')
+    def test_batch_writer_stores_revision_of_unchanged_books(self, mock_persists, mock_last_seq):
+        book = {'identifier': 'rev4', 'title': 'a'}
+        book['content_hash'] = content_hash(book)
+        settings['storage'].upsert_book(dict(book, datestamp=datetime(2014, 1, 1)))
+        writer = BatchWriter(settings['storage'])
+
+        writer.add_book(dict(book, revision='2-a', datestamp=datetime.now()), 8)
+        writer.flush()
+
+        stored = settings['storage'].find_book('rev4')
+        self.assertFalse(mock_persists.called)
+        self.assertEquals(stored['revision'], '2-a')
+        self.assertEquals(stored['datestamp'].year, 2014)
+
+    def test_content_hash_ignores_updated_and_datestamp(self):
+        book = {'identifier': 1, 'title': 'a', 'updated': '2014-01-01', 'datestamp': datetime.now()}
+
+        self.assertEquals(content_hash(book),
+                          content_hash(dict(book, updated='2014-02-01', datestamp=None)))
+        self.assertNotEquals(content_hash(book), content_hash(dict(book, title='b')))
+
+    def test_parse_write_concern(self):
+        self.assertEquals(parse_write_concern('1'), {'w': 1})
+        self.assertEquals(parse_write_concern('majority'), {'w': 'majority'})
+        self.assertEquals(parse_write_concern(''), None)
 
     @patch('booksoai.sync.datetime')
     def test_adapt_data_ignore_non_mapped_fields(self, mock_datetime):
@@ -121,18 +493,13 @@ class SyncTests(unittest.TestCase):
         self.assertEquals(adapted, {'datestamp': test_datetime, 'identifier':4, 'formats': ['pdf', 'epub']})
 
     @patch('booksoai.sync.datetime')
-    def test_mark_as_deleted_update_register(self, mock_datetime):
+    def test_adapt_data_store_publisher_set_slug(self, mock_datetime):
         test_datetime = datetime(2014, 01, 31, 0, 0)
         mock_datetime.now.return_value = test_datetime
-        book = {'identifier':1}
-        
-        db = settings['db_conn']
-        db.books.insert(book)
-
-        update = {'id':1, 'deleted': True}
-        mark_as_deleted(update, db)
+        data = {
+            '_id':4, 'publisher': 'Editora UNESP'
+        }
+        adapted = adapt_data(data)
 
-        book = db.books.find_one({'identifier': 1})
-        self.assertEquals(book['deleted'], True)
-        self.assertEquals(book['datestamp'], test_datetime)
+        self.assertEquals(adapted['set'], 'editora-unesp')
 
@@ -0,0 +1,52 @@
+import unittest
+
+from booksoai.telemetry import Histogram, SyncRun, seq_lag
+
+
+class HistogramTests(unittest.TestCase):
+
+    def test_observe_counts_values_per_bucket(self):
+        histogram = Histogram(bounds=(0.1, 1))
+
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+
+        summary = histogram.as_dict()
+        self.assertEqual(summary['buckets'], [{'le': 0.1, 'count': 2},
+                                              {'le': 1, 'count': 1},
+                                              {'le': None, 'count': 1}])
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['max'], 3)
+        self.assertAlmostEqual(summary['mean'], 0.9125)
+
+    def test_empty_histogram(self):
+        summary = Histogram().as_dict()
+
+        self.assertEqual(summary['count'], 0)
+        self.assertIsNone(summary['mean'])
+
+
+class SyncRunTests(unittest.TestCase):
+
+    def test_seq_lag(self):
+        self.assertEqual(seq_lag(10, 7), 3)
+        self.assertEqual(seq_lag(10, None), 10)
+        self.assertEqual(seq_lag(7, 10), 0)
+        self.assertIsNone(seq_lag('12-abc', 7))
+
+    def test_as_dict_includes_stats_and_lag(self):
+        run = SyncRun({'changes': 5, 'books': 4, 'unchanged': 1}, since=2)
+        run.api_seq = 20
+
+        record = run.as_dict('ok', last_seq=15)
+
+        self.assertEqual(record['lag'], 5)
+        self.assertEqual(record['written'], 3)
+        self.assertEqual(record['since'], 2)
+        self.assertEqual(record['changes'], 5)
+        self.assertGreaterEqual(record['finished_at'], record['started_at'])
+
+    def test_lag_is_unknown_without_the_feed_head(self):
+        run = SyncRun({})
+
+        self.assertIsNone(run.as_dict('ok', last_seq=15)['lag'])
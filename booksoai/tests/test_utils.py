@@ -0,0 +1,109 @@
+import unittest
+
+from datetime import datetime
+
+from mock import patch, Mock
+from pymongo.errors import OperationFailure
+from pymongo.read_preferences import ReadPreference
+
+from booksoai import utils, parse_settings
+
+
+settings = {}
+settings['mongo_uri'] = 'mongodb://localhost:27017/scielobooks-test'
+
+
+class ConnectionRegistryTests(unittest.TestCase):
+
+    def tearDown(self):
+        utils._clients.clear()
+
+    def test_get_db_connection_reuses_client_in_same_process(self):
+        db1 = utils.get_db_connection(settings)
+        db2 = utils.get_db_connection(settings)
+
+        self.assertIs(db1.connection, db2.connection)
+
+    def test_get_db_connection_returns_db_from_uri_path(self):
+        db = utils.get_db_connection(settings)
+
+        self.assertEqual(db.name, 'scielobooks-test')
+
+    @patch('booksoai.utils.os.getpid')
+    def test_get_mongo_client_creates_new_client_after_fork(self, mock_getpid):
+        mock_getpid.return_value = 1
+        parent_client = utils.get_mongo_client(settings)
+
+        mock_getpid.return_value = 2
+        child_client = utils.get_mongo_client(settings)
+
+        self.assertIsNot(parent_client, child_client)
+        self.assertEqual(len(utils._clients), 1)
+
+    def test_get_mongo_client_uses_pool_settings(self):
+        custom = dict(settings, mongo_max_pool_size=7)
+        client = utils.get_mongo_client(custom)
+
+        self.assertEqual(client.max_pool_size, 7)
+
+    def test_get_db_connection_uses_primary_by_default(self):
+        db = utils.get_db_connection(settings)
+
+        self.assertEqual(db.read_preference, ReadPreference.PRIMARY)
+
+    def test_get_db_connection_with_read_preference_shares_client(self):
+        db = utils.get_db_connection(settings)
+        read_db = utils.get_db_connection(settings, ReadPreference.SECONDARY_PREFERRED)
+
+        self.assertEqual(read_db.read_preference, ReadPreference.SECONDARY_PREFERRED)
+        self.assertIs(db.connection, read_db.connection)
+
+
+class ReadPreferenceTests(unittest.TestCase):
+
+    def test_get_read_preference_from_uri_option_names(self):
+        custom = dict(settings, mongo_read_preference='secondaryPreferred')
+
+        self.assertEqual(utils.get_read_preference(custom),
+                         ReadPreference.SECONDARY_PREFERRED)
+
+    def test_get_read_preference_defaults_to_primary(self):
+        self.assertEqual(utils.get_read_preference(settings), ReadPreference.PRIMARY)
+
+    def test_get_read_preference_rejects_unknown_names(self):
+        custom = dict(settings, mongo_read_preference='fastest')
+
+        self.assertRaises(ValueError, utils.get_read_preference, custom)
+
+    @patch.dict('os.environ', {'BOOKSOAI_MONGO_READ_PREFERENCE': 'fastest'})
+    def test_parse_settings_rejects_unknown_names(self):
+        self.assertRaises(ValueError, parse_settings, {})
+
+
+class ReplicationLagTests(unittest.TestCase):
+
+    def _client(self, members):
+        client = Mock()
+        client.admin.command.return_value = {'members': members}
+        return client
+
+    def test_lag_of_most_outdated_secondary(self):
+        client = self._client([
+            {'state': 1, 'optimeDate': datetime(2014, 1, 1, 0, 1, 0)},
+            {'state': 2, 'optimeDate': datetime(2014, 1, 1, 0, 0, 50)},
+            {'state': 2, 'optimeDate': datetime(2014, 1, 1, 0, 0, 30)},
+            {'state': 8, 'optimeDate': datetime(2013, 1, 1)},
+        ])
+
+        self.assertEqual(utils.replication_lag(client), 30)
+
+    def test_lag_without_primary_is_unknown(self):
+        client = self._client([{'state': 2, 'optimeDate': datetime(2014, 1, 1)}])
+
+        self.assertIsNone(utils.replication_lag(client))
+
+    def test_lag_of_standalone_server_is_unknown(self):
+        client = Mock()
+        client.admin.command.side_effect = OperationFailure('not running with --replSet')
+
+        self.assertIsNone(utils.replication_lag(client))
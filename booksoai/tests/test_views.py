@@ -1,18 +1,21 @@
 from __future__ import unicode_literals
 
+import re
 import unittest
 
+from datetime import datetime
+
 from bson import json_util
 from pyramid import testing
 
 from booksoai import oaipmh
-from booksoai.views import oai_pmh, filter_books
-from booksoai.utils import get_db_connection
+from booksoai.views import oai_pmh, filter_books, sync_status, sync_runs
+from booksoai.storage import get_storage
 
 settings = {}
 settings['mongo_uri'] = 'mongodb://localhost:27017/scielobooks-test'
 settings['scielo_uri'] = 'http://books.scielo.org/api/v1/'
-settings['db_conn'] = get_db_connection(settings)
+settings['storage'] = get_storage(settings)
 settings['items_per_page'] = 2
 
 
@@ -20,15 +23,16 @@ class ViewTests(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        db = settings['db_conn']
+        db = settings['storage'].db
         with open('booksoai/tests/fixtures/books.bson') as fixture:
             for line in fixture:
                 book = json_util.loads(line)
                 db.books.insert(book)
+        settings['storage'].refresh_sets()
 
     @classmethod
     def tearDownClass(cls):
-        db = settings['db_conn']
+        db = settings['storage'].db
         db.connection.drop_database(db.name)
 
     def setUp(self):
@@ -46,7 +50,7 @@ class ViewTests(unittest.TestCase):
 
     def test_get_record_with_identifier(self):
         request = testing.DummyRequest()
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.url = 'http://localhost:6543/oai-pmh?'
         request.params = {'verb': 'GetRecord', 'identifier': '37t', 'metadataPrefix': 'oai_dc'}
         resp = oai_pmh(request)
@@ -60,7 +64,7 @@ class ViewTests(unittest.TestCase):
     def test_list_records_with_from(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListRecords', 'from': '2014-02-04', 'metadataPrefix': 'oai_dc'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -71,7 +75,7 @@ class ViewTests(unittest.TestCase):
     def test_list_records_with_from_and_until(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListRecords', 'from': '2014-02-04', 'until': '2014-02-04', 'metadataPrefix': 'oai_dc'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -81,7 +85,7 @@ class ViewTests(unittest.TestCase):
     def test_list_records_with_set(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListRecords', 'set': 'bla-x-ble', 'metadataPrefix': 'oai_dc'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -91,25 +95,48 @@ class ViewTests(unittest.TestCase):
     def test_any_verb_return_id_not_exist_if_inexistent_id(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
+        request.params = {'verb': 'GetRecord', 'identifier': 'bla', 'metadataPrefix': 'oai_dc'}
+        resp = oai_pmh(request)
+        resp = str(resp)
+        self.assertIn('<error code="idDoesNotExist">No matching identifier</error>', resp)
+
+    def test_get_record_return_id_not_exist_from_identifier_filter(self):
+        request = testing.DummyRequest()
+        request.registry.settings = dict(settings, id_filter=True)
+        request.storage = settings['storage']
         request.params = {'verb': 'GetRecord', 'identifier': 'bla', 'metadataPrefix': 'oai_dc'}
         resp = oai_pmh(request)
         resp = str(resp)
         self.assertIn('<error code="idDoesNotExist">No matching identifier</error>', resp)
 
+        request.params = {'verb': 'GetRecord', 'identifier': '38t', 'metadataPrefix': 'oai_dc'}
+        resp = oai_pmh(request)
+        resp = str(resp)
+        self.assertIn('<identifier>38t</identifier>', resp)
+
     def test_any_verb_return_no_record_match_if_search_returns_empty(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListRecords', 'from': '2014-02-07', 'until': '2014-02-08', 'metadataPrefix': 'oai_dc'}
         resp = oai_pmh(request)
         resp = str(resp)
         self.assertIn('<error code="noRecordsMatch"/>', resp)
 
+    def test_identify_verb_return_earliest_datestamp(self):
+        request = testing.DummyRequest()
+        request.registry.settings = settings
+        request.storage = settings['storage']
+        request.params = {'verb': 'Identify'}
+        resp = oai_pmh(request)
+        resp = str(resp)
+        self.assertIn('<earliestDatestamp>2014-02-01</earliestDatestamp>', resp)
+
     def test_identify_verb_return_bad_argument_if_invalid_argument(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'Identify', 'x': 'a'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -118,7 +145,7 @@ class ViewTests(unittest.TestCase):
     def test_list_metadata_formats_verb_return_bad_argument_if_invalid_argument(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListMetadataFormats', 'x': 'a'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -127,7 +154,7 @@ class ViewTests(unittest.TestCase):
     def test_list_metadata_formats_verb_with_identifier_returns_success(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListMetadataFormats', 'identifier': '38t'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -136,7 +163,7 @@ class ViewTests(unittest.TestCase):
     def test_list_identifiers_verb_return_bad_argument_if_invalid_argument(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListIdentifiers', 'x': 'a'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -145,7 +172,7 @@ class ViewTests(unittest.TestCase):
     def test_list_identifiers_verb_return_bad_argument_without_metadata_prefix(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListIdentifiers'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -154,7 +181,7 @@ class ViewTests(unittest.TestCase):
     def test_list_identifiers_verb_return_success_with_metadata_prefix(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -163,7 +190,7 @@ class ViewTests(unittest.TestCase):
     def test_list_sets_verb_return_bad_argument_if_invalid_argument(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListSets', 'x': 'a'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -172,15 +199,48 @@ class ViewTests(unittest.TestCase):
     def test_list_sets_verb_return_success_without_invalid_argument(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListSets'}
         resp = oai_pmh(request)
         resp = str(resp)
         self.assertIn('<setSpec>edufba</setSpec>', resp)
 
+    def test_list_sets_verb_return_set_names(self):
+        request = testing.DummyRequest()
+        request.registry.settings = settings
+        request.storage = settings['storage']
+        request.params = {'verb': 'ListSets'}
+        resp = oai_pmh(request)
+        resp = str(resp)
+        self.assertEqual(resp.count('<set>'), 2)
+        self.assertIn('<setName>Bla X Ble</setName>', resp)
+        self.assertNotIn('<setDescription>', resp)
+
+    def test_list_sets_verb_return_set_descriptions_if_enabled(self):
+        request = testing.DummyRequest()
+        request.registry.settings = dict(settings, set_descriptions=True)
+        request.storage = settings['storage']
+        request.params = {'verb': 'ListSets'}
+        resp = oai_pmh(request)
+        resp = str(resp)
+        self.assertIn('4 records, from 2014-02-02 to 2014-02-05', resp)
+
+    def test_list_sets_verb_paginate_sets(self):
+        request = testing.DummyRequest()
+        request.registry.settings = dict(settings, items_per_page=1)
+        request.storage = settings['storage']
+        request.params = {'verb': 'ListSets'}
+        resp = str(oai_pmh(request))
+        self.assertIn('<setSpec>bla-x-ble</setSpec>', resp)
+
+        request.params = {'verb': 'ListSets', 'resumptionToken': self._next_token(resp)}
+        resp = str(oai_pmh(request))
+        self.assertIn('<setSpec>edufba</setSpec>', resp)
+        self.assertIn('<resumptionToken completeListSize="2" cursor="1"/>', resp)
+
     def test_get_record_verb_return_bad_argument_if_invalid_argument(self):
         request = testing.DummyRequest()
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'GetRecord', 'x': 'a'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -188,7 +248,7 @@ class ViewTests(unittest.TestCase):
 
     def test_get_record_verb_return_bad_argument_without_metadata_prefix(self):
         request = testing.DummyRequest()
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'GetRecord', 'identifier': '38t'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -196,7 +256,7 @@ class ViewTests(unittest.TestCase):
 
     def test_get_record_verb_return_bad_argument_without_identifier(self):
         request = testing.DummyRequest()
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'GetRecord', 'metadataPrefix': 'oai_dc'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -204,7 +264,7 @@ class ViewTests(unittest.TestCase):
 
     def test_list_records_verb_return_bad_argument_if_invalid_argument(self):
         request = testing.DummyRequest()
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListRecords', 'x': 'a'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -212,7 +272,7 @@ class ViewTests(unittest.TestCase):
 
     def test_list_records_verb_return_bad_argument_without_metadata_prefix(self):
         request = testing.DummyRequest()
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListRecords'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -220,7 +280,7 @@ class ViewTests(unittest.TestCase):
 
     def test_any_verb_return_bad_argument_if_cant_parse_dates(self):
         request = testing.DummyRequest()
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListRecords', 'from': '2014-0207', 'metadataPrefix': 'oai_dc'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -228,7 +288,7 @@ class ViewTests(unittest.TestCase):
 
     def test_any_verb_return_cannot_diss_format_if_metadata_prefix_is_not_oai_dc(self):
         request = testing.DummyRequest()
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_marc'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -237,30 +297,38 @@ class ViewTests(unittest.TestCase):
     def test_filter_books_raise_exception_when_unsupported_metadataformat(self):
         request_params = {'metadataPrefix': 'oai_marc'}
         self.assertRaises(oaipmh.CannotDisseminateFormatError, filter_books, 
-            request_params, settings['db_conn'], settings)
+            request_params, settings['storage'], settings)
 
     def test_filter_books_raise_exception_when_inexistent_id(self):
         request_params = {'identifier': '72t'}
         self.assertRaises(oaipmh.IDDoesNotExistError, filter_books, request_params, 
-            settings['db_conn'], settings)
+            settings['storage'], settings)
 
     def test_filter_books_raise_exception_when_no_books_find(self):
         request_params = {'set':'teste'}
         self.assertRaises(oaipmh.NoRecordsMatchError, filter_books, 
-            request_params, settings['db_conn'], settings)
+            request_params, settings['storage'], settings)
     
     def test_filter_books_raise_exception_when_invalid_data_format(self):
         request_params = {'from':'20140310'}
-        self.assertRaises(ValueError, filter_books, request_params, settings['db_conn'], settings)
+        self.assertRaises(ValueError, filter_books, request_params, settings['storage'], settings)
 
     def test_filter_books_return_books_if_ok(self):
         request_params = {'identifier': '38t', 'metadataPrefix': 'oai_dc'}
-        books = filter_books(request_params, settings['db_conn'], settings)
-        self.assertEqual(books.next()['identifier'], '38t')
+        books, token = filter_books(request_params, settings['storage'], settings)
+        self.assertEqual(books[0]['identifier'], '38t')
+        self.assertEqual(token, None)
+
+    def test_filter_books_load_only_requested_fields(self):
+        request_params = {'metadataPrefix': 'oai_dc'}
+        books, resumption = filter_books(request_params, settings['storage'], settings,
+            fields=oaipmh.ListIdentifiersVerb.fields)
+        self.assertEqual(set(books[0]), set(['identifier', 'updated', 'set']))
+        self.assertEqual(set(books[1]), set(['identifier', 'updated', 'set', 'deleted']))
 
     def test_deleted_register_show_only_header_info(self):
         request = testing.DummyRequest()
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'GetRecord', 'metadataPrefix': 'oai_dc', 'identifier': '37t'}
         resp = oai_pmh(request)
         resp = str(resp)
@@ -270,19 +338,26 @@ class ViewTests(unittest.TestCase):
     def test_resumption_token_limit_results(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}
         resp = oai_pmh(request)
         resp = str(resp)
         self.assertEqual(resp.count('<record>'), 2)
         self.assertIn('36t', resp)
         self.assertIn('37t', resp)
+        self.assertIn('completeListSize="5" cursor="0"', resp)
+
+    def _next_token(self, resp):
+        return re.search('<resumptionToken[^>]*>([^<]+)</resumptionToken>', resp).group(1)
 
     def test_resumption_token_paginate_results(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
-        request.params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'resumptionToken': '1'}
+        request.storage = settings['storage']
+        request.params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}
+        token = self._next_token(str(oai_pmh(request)))
+
+        request.params = {'verb': 'ListRecords', 'resumptionToken': token}
         resp = oai_pmh(request)
         resp = str(resp)
         self.assertEqual(resp.count('<record>'), 2)
@@ -292,19 +367,60 @@ class ViewTests(unittest.TestCase):
     def test_resumption_token_show_last_page(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
-        request.params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'resumptionToken': '2'}
+        request.storage = settings['storage']
+        request.params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}
+        token = self._next_token(str(oai_pmh(request)))
+        request.params = {'verb': 'ListRecords', 'resumptionToken': token}
+        token = self._next_token(str(oai_pmh(request)))
+
+        request.params = {'verb': 'ListRecords', 'resumptionToken': token}
         resp = oai_pmh(request)
         resp = str(resp)
         self.assertEqual(resp.count('<record>'), 1)
         self.assertIn('40t', resp)
+        self.assertIn('<resumptionToken completeListSize="5" cursor="4"/>', resp)
+
+    def test_resumption_token_keeps_original_arguments(self):
+        request = testing.DummyRequest()
+        request.registry.settings = settings
+        request.storage = settings['storage']
+        request.params = {'verb': 'ListIdentifiers', 'set': 'edufba', 'metadataPrefix': 'oai_dc'}
+        token = self._next_token(str(oai_pmh(request)))
+
+        request.params = {'verb': 'ListIdentifiers', 'resumptionToken': token}
+        resp = oai_pmh(request)
+        resp = str(resp)
+        self.assertEqual(resp.count('<header'), 2)
+        self.assertIn('39t', resp)
+        self.assertIn('40t', resp)
+        self.assertNotIn('36t', resp)
 
     def test_any_verb_returns_bad_resumption_token_with_invalid_resumption_token(self):
         request = testing.DummyRequest()
         request.registry.settings = settings
-        request.db = settings['db_conn']
+        request.storage = settings['storage']
         request.params = {'verb': 'ListRecords', 'metadataPrefix': 'oai_dc', 'resumptionToken': '3'}
         resp = oai_pmh(request)
         resp = str(resp)
         self.assertIn('<error code="badResumptionToken"/>', resp)
-        
+
+    def test_sync_status_without_scheduler(self):
+        request = testing.DummyRequest()
+        request.registry.settings = dict(settings, auto_sync=False)
+
+        self.assertEqual(sync_status(request), {'auto_sync': False, 'scheduler': None})
+
+    def test_sync_runs(self):
+        storage = settings['storage']
+        storage.set_last_seq(12)
+        storage.add_sync_run({'started_at': datetime(2014, 5, 1), 'lag': 3})
+        storage.add_sync_run({'started_at': datetime(2014, 5, 2), 'lag': 0})
+        request = testing.DummyRequest(params={'limit': '1'})
+        request.storage = storage
+
+        resp = sync_runs(request)
+
+        self.assertEqual(resp['last_seq'], 12)
+        self.assertEqual(resp['lag'], 0)
+        self.assertEqual(len(resp['runs']), 1)
+        self.assertTrue(resp['runs'][0]['started_at'].startswith('2014-05-02T00:00:00'))
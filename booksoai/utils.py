@@ -1,16 +1,105 @@
+import os
 import sys
 import pymongo
 import logging
+import threading
 
-from urlparse import urlparse
+from pymongo import uri_parser
+from pymongo.read_preferences import ReadPreference, mongos_enum
 
 
-def get_db_connection(settings):
-    db_url = urlparse(settings['mongo_uri'])
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _timeout_ms(value):
+    """Zero or negative timeouts mean `no timeout` for pymongo."""
+    return value if value and value > 0 else None
+
+
+def get_mongo_client(settings):
+    """Return the ``MongoClient`` shared by the current process.
+
+    Clients are registered by pid, so a process forked after the registry was
+    populated (e.g. gunicorn workers with ``preload = true``) never reuses the
+    sockets inherited from its parent and builds its own pool instead.
+
+    :param settings: App settings, as returned by ``parse_settings``.
+    :returns: pymongo.MongoClient.
+    """
+    uri = settings['mongo_uri']
+    options = {
+        'max_pool_size': settings.get('mongo_max_pool_size', 100),
+        'connectTimeoutMS': _timeout_ms(settings.get('mongo_connect_timeout_ms', 20000)),
+        'socketTimeoutMS': _timeout_ms(settings.get('mongo_socket_timeout_ms', 30000)),
+        'waitQueueTimeoutMS': _timeout_ms(settings.get('mongo_wait_queue_timeout_ms', 5000)),
+    }
+    key = (os.getpid(), uri, tuple(sorted(options.items())))
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            # sockets inherited from the parent process must not be shared
+            for stale_key in [k for k in _clients if k[0] != key[0]]:
+                del _clients[stale_key]
+
+            if uri_parser.parse_uri(uri)['options'].get('replicaset'):
+                # only replica set clients route reads to secondaries
+                client = pymongo.MongoReplicaSetClient(uri, **options)
+            else:
+                client = pymongo.MongoClient(uri, **options)
+            _clients[key] = client
+
+    return client
+
+
+def read_preference_name(value):
+    """Validate the name of a read preference, failing at startup instead
+    of in the first request that needs the storage."""
     try:
-        conn = pymongo.MongoClient(host=db_url.hostname, port=db_url.port)
+        mongos_enum(value)
+    except ValueError:
+        raise ValueError('Unknown mongo_read_preference: %s' % value)
+    return value
+
+
+def get_read_preference(settings):
+    """Return the pymongo mode named by the `mongo_read_preference` setting.
+
+    Names are the ones of the MongoDB URI ``readPreference`` option, e.g.
+    ``secondaryPreferred``.
+    """
+    return mongos_enum(settings.get('mongo_read_preference', 'primary'))
+
+
+def get_db_connection(settings, read_preference=ReadPreference.PRIMARY):
+    try:
+        conn = get_mongo_client(settings)
     except pymongo.errors.ConnectionFailure as e:
         logging.getLogger(__name__).error('MongoDB: %s' % e.message)
         sys.exit(1)
-    db = conn[db_url.path[1:]]
+    db = conn[uri_parser.parse_uri(settings['mongo_uri'])['database']]
+    db.read_preference = read_preference
     return db
+
+
+def replication_lag(client):
+    """Return how many seconds the most outdated secondary is behind the
+    primary.
+
+    None is returned when the lag can't be known: standalone servers, sets
+    without a primary or users without the ``replSetGetStatus`` privilege.
+    """
+    try:
+        status = client.admin.command('replSetGetStatus')
+    except pymongo.errors.OperationFailure:
+        return None
+
+    members = status.get('members', [])
+    primary = [m['optimeDate'] for m in members if m.get('state') == 1]
+    secondaries = [m['optimeDate'] for m in members if m.get('state') == 2]
+    if not primary:
+        return None
+
+    lags = [(primary[0] - optime).total_seconds() for optime in secondaries]
+    return max(lags + [0])
@@ -1,7 +1,10 @@
 from __future__ import unicode_literals
 
-import re
+import counts
 import oaipmh
+import idfilter
+import scheduler
+import resumption
 
 from datetime import datetime
 from pyramid.view import view_config
@@ -16,6 +19,10 @@ VERBS = {
     'ListRecords': (oaipmh.ListRecordsVerb, True),
 }
 
+# request arguments that select the books of a list request
+FILTER_ARGS = ('metadataPrefix', 'identifier', 'set', 'from', 'until')
+
+
 @view_config(route_name='oai_pmh', renderer='oai')
 def oai_pmh(request):
     request_verb = request.params.get('verb')
@@ -31,11 +38,17 @@ def oai_pmh(request):
     params = {'request_kwargs': request_kwargs, 'base_url': base_url}
 
     if not need_books and request_verb == 'Identify':
-        params['last_book'] = filter_last_book(request.db)
+        params['stats'] = request.storage.get_repository_stats()
 
     if need_books:
         try:
-            params['books'] = filter_books(request_kwargs, request.db, request.registry.settings, base_url)
+            if request_verb == 'ListSets':
+                params['sets'], params['resumption'] = filter_sets(
+                    request_kwargs, request.storage, request.registry.settings)
+            else:
+                params['books'], params['resumption'] = filter_books(
+                    request_kwargs, request.storage, request.registry.settings, base_url,
+                    fields=getattr(OaiVerb, 'fields', None))
         except oaipmh.CannotDisseminateFormatError:
             OaiVerb = oaipmh.CannotDisseminateFormat
         except oaipmh.IDDoesNotExistError:
@@ -55,70 +68,201 @@ def oai_pmh(request):
         return oaipmh.BadArgument(request_kwargs=request_kwargs, base_url=base_url)
 
 
-def filter_last_book(db):
-    last_book = db.books.find().sort('updated', 1)[0]
+@view_config(route_name='sync_status', renderer='json')
+def sync_status(request):
+    """State of the sync scheduler running in this process."""
+    sync_scheduler = scheduler.get_scheduler()
+    return {
+        'auto_sync': request.registry.settings['auto_sync'],
+        'scheduler': sync_scheduler.state() if sync_scheduler else None,
+    }
 
-    if len(last_book) == 0:
-        raise oaipmh.NoRecordsMatchError
 
-    return last_book
+# most sync runs listed by /sync-runs
+MAX_SYNC_RUNS = 100
 
 
-def filter_books(request_kwargs, db, settings, base_url):
-    start = 0
-    search = {}
-    resumptionToken = 0
-    metadata_prefix = request_kwargs.get('metadataPrefix', 'oai_dc')
-    items_per_page = settings['items_per_page']
+def _isoformat(value):
+    return value.isoformat() if isinstance(value, datetime) else value
 
-    if metadata_prefix and metadata_prefix != u'oai_dc':
-        raise oaipmh.CannotDisseminateFormatError
 
-    if 'identifier' in request_kwargs:
-        search['identifier'] = request_kwargs['identifier']
-        if not db.books.find_one(search):
-            raise oaipmh.IDDoesNotExistError
+@view_config(route_name='sync_runs', renderer='json')
+def sync_runs(request):
+    """
+    Telemetry of the last sync runs, the latest first, and the current sync
+    lag. `lag` is the number of changes of the feed the last run didn't
+    apply; it is None when unknown.
+    """
+    try:
+        limit = min(max(int(request.params.get('limit', 10)), 1), MAX_SYNC_RUNS)
+    except ValueError:
+        limit = 10
 
-    if 'set' in request_kwargs:
-        _set = request_kwargs['set']
-        _set = '^%s$' % _set.replace('-', ' ')
-        search['publisher'] = re.compile(_set, re.IGNORECASE)
+    runs = [dict((key, _isoformat(value)) for key, value in run.items())
+            for run in request.storage.find_sync_runs(limit)]
+    last_update = request.storage.get_last_update()
 
-    if 'from' in request_kwargs:
-        _from = request_kwargs['from']
+    return {
+        'last_seq': last_update['last_seq'] if last_update else None,
+        'updated_at': _isoformat(last_update['updated_at']) if last_update else None,
+        'lag': runs[0]['lag'] if runs else None,
+        'runs': runs,
+    }
 
-        try:
-            _from = datetime.strptime(_from, '%Y-%m-%d')
-        except ValueError:
-            raise oaipmh.BadArgumentError
 
-        search['updated'] = {'$gte': _from.date().isoformat()}
+def filter_sets(request_kwargs, storage, settings):
+    """
+    Return a page of the sets materialized by sync, or at startup for
+    repositories that have none, and the token to resume the list after it.
 
-    if 'until' in request_kwargs:
-        until = request_kwargs['until']
+    :returns: (sets, resumption) tuple, as in ``filter_books``.
+    """
+    after = None
+    cursor = 0
+    total = None
+    items_per_page = settings['items_per_page']
 
+    if 'resumptionToken' in request_kwargs:
         try:
-            until = datetime.strptime(until, '%Y-%m-%d')
-        except ValueError:
-            raise oaipmh.BadArgumentError
+            state = resumption.decode_token(request_kwargs['resumptionToken'])
+            after, = state['after']
+        except (ValueError, KeyError, TypeError):
+            raise oaipmh.BadResumptionTokenError
+
+        cursor = state.get('cursor', 0)
+        total = state.get('total')
+
+    fields = ['name']
+    if settings.get('set_descriptions'):
+        fields += ['total_records', 'earliest_datestamp', 'latest_datestamp']
+
+    sets = storage.find_sets(after, items_per_page + 1, fields)
+
+    if not sets and after is not None:
+        raise oaipmh.BadResumptionTokenError
+
+    token = None
+    if len(sets) > items_per_page:
+        sets = sets[:items_per_page]
+
+        if total is None:
+            total = storage.count_sets()
+
+        token = resumption.encode_token({
+            'args': {},
+            'after': [sets[-1]['set']],
+            'cursor': cursor + len(sets),
+            'total': total,
+        })
+    elif after is None:
+        total = len(sets)
+
+    return sets, {'token': token, 'cursor': cursor, 'completeListSize': total}
+
+
+def filter_book(identifier, storage, settings, fields=None):
+    """
+    Return the book with ``identifier`` in a single lookup, as a one item
+    list of books.
 
-        search.setdefault('updated', {})['$lte'] = until.date().isoformat()
+    Unknown identifiers are answered by the per-process identifier filter
+    when it is enabled, without querying the books, as long as no sync
+    checkpoint was written since the filter was built.
+    """
+    if settings.get('id_filter') and not idfilter.might_exist(storage, identifier, settings):
+        raise oaipmh.IDDoesNotExistError
+
+    book = storage.find_book(identifier, fields)
+    if book is None:
+        raise oaipmh.IDDoesNotExistError
+
+    return [book], {'token': None, 'cursor': 0, 'completeListSize': 1}
+
+
+def filter_books(request_kwargs, storage, settings, base_url=None, fields=None):
+    """
+    Return a page of books matching the OAI request arguments and the token
+    to resume the list after it.
+
+    Pages are fetched with a keyset seek on (updated, identifier) instead of
+    skipping the preceding items, so every page costs the same. The token
+    carries the original filter arguments, allowing harvesters to send only
+    the resumptionToken.
+
+    The size of the complete list is counted once, on the first page of lists
+    that don't fit in a single page, and travels in the token along with the
+    cursor. Counts are cached per query signature until the next sync run.
+
+    Only ``fields`` are loaded from the storage, when given.
+
+    :returns: (books, resumption) tuple; resumption is a dict with the
+              `token` (None on the last page), `cursor` and `completeListSize`.
+    """
+    filters = {}
+    after = None
+    cursor = 0
+    total = None
+    items_per_page = settings['items_per_page']
 
     if 'resumptionToken' in request_kwargs:
         try:
-            resumptionToken = int(request_kwargs['resumptionToken'])
+            state = resumption.decode_token(request_kwargs['resumptionToken'])
         except ValueError:
             raise oaipmh.BadResumptionTokenError
 
-        start = items_per_page * resumptionToken
+        args = state['args']
+        after = state.get('after')
+        if after is not None and len(after) != 2:
+            raise oaipmh.BadResumptionTokenError
+
+        cursor = state.get('cursor', 0)
+        total = state.get('total')
+    else:
+        args = dict((k, request_kwargs[k]) for k in FILTER_ARGS if k in request_kwargs)
 
-    books = db.books.find(search).sort('updated')[start: start + items_per_page]
-    count = books.count()
+    metadata_prefix = args.get('metadataPrefix', 'oai_dc')
 
-    if not count:
+    if metadata_prefix and metadata_prefix != u'oai_dc':
+        raise oaipmh.CannotDisseminateFormatError
+
+    if 'identifier' in args:
+        return filter_book(args['identifier'], storage, settings, fields)
+
+    if 'set' in args:
+        filters['set'] = args['set']
+
+    for arg in ('from', 'until'):
+        if arg in args:
+            try:
+                date = datetime.strptime(args[arg], '%Y-%m-%d')
+            except ValueError:
+                raise oaipmh.BadArgumentError
+
+            filters[arg] = date.date().isoformat()
+
+    # one extra book tells whether the list goes on after this page
+    books = storage.find_books(filters, after, items_per_page + 1, fields)
+
+    if not books:
+        if after is not None:
+            raise oaipmh.BadResumptionTokenError
         raise oaipmh.NoRecordsMatchError
 
-    if count < start:
-        raise oaipmh.BadResumptionTokenError
+    token = None
+    if len(books) > items_per_page:
+        books = books[:items_per_page]
+
+        if total is None:
+            total = counts.count_books(storage, filters)
+
+        last = books[-1]
+        token = resumption.encode_token({
+            'args': args,
+            'after': [last.get('updated'), last['identifier']],
+            'cursor': cursor + len(books),
+            'total': total,
+        })
+    elif after is None:
+        total = len(books)
 
-    return books
+    return books, {'token': token, 'cursor': cursor, 'completeListSize': total}
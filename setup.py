@@ -42,5 +42,11 @@ setup(name='booksoai',
       entry_points="""\
       [paste.app_factory]
       main = booksoai:main
+      [console_scripts]
+      booksoai-ensure-indexes = booksoai.scripts.indexes:main
+      booksoai-sync = booksoai.scripts.sync:main
+      booksoai-follow = booksoai.scripts.follow:main
+      booksoai-benchmark = booksoai.scripts.benchmark:main
+      booksoai-import = booksoai.scripts.importer:main
       """,
       )